@@ -0,0 +1,14 @@
+#!/bin/bash
+
+gen_pw () {
+    head /dev/urandom | tr -dc A-Za-z0-9 | head -c10
+}
+
+echo '@Creating the users woofdawg & meowcat on localhost'
+# With --matrix every line of stdin is one set of variables, and the template
+# is run once for each line. --vars are shared by all lines.
+# --batch runs all lines as one playbook, otherwise --forks lines run at a time.
+isna --matrix --batch --vars='is_admin=no' --sudo=root create-user.yml <<EOF_ROWS
+{"username": "woofdawg", "new_usr_password": "$(gen_pw)"}
+{"username": "meowcat", "new_usr_password": "$(gen_pw)"}
+EOF_ROWS
@@ -46,7 +46,11 @@ setup(
         'Operating System :: Microsoft :: Windows',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy',
         # uncomment if you test on these interpreters:
@@ -55,6 +59,7 @@ setup(
         # 'Programming Language :: Python :: Implementation :: Stackless',
         'Topic :: Utilities',
     ],
+    python_requires='>=3.7',
     keywords=[
         # eg: 'keyword1', 'keyword2', 'keyword3',
     ],
@@ -63,8 +68,11 @@ setup(
         'ansible',
         'docopt',
         'schema',
+        'pyyaml',
     ],
-    extras_require={},
+    extras_require={
+        'bench': ['pytest-benchmark'],
+    },
     entry_points={
         'console_scripts': [
             'isna = isna.cli2:main',
@@ -0,0 +1,100 @@
+# isna_report -- an ansible callback plugin shipped with isna
+#
+# isna adds this directory to ANSIBLE_CALLBACK_PLUGINS for the ansible-playbook
+# processes it starts. The plugin writes one json object per line to the file
+# descriptor in the environment variable ISNA_REPORT_FD (a pipe which isna
+# reads while ansible runs), or else to the file named by ISNA_REPORT_FILE,
+# which isna reads back to report per-play and per-host results.
+# Without either variable the plugin does nothing.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: isna_report
+    callback: isna_report
+    type: notification
+    short_description: Write play & task results as json lines for isna
+    description:
+      - Writes one json object per event to the file descriptor in $ISNA_REPORT_FD
+        or the file in $ISNA_REPORT_FILE
+'''
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'isna_report'
+    CALLBACK_NEEDS_ENABLED = False
+    CALLBACK_NEEDS_WHITELIST = False
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        fd = os.environ.get('ISNA_REPORT_FD')
+        path = os.environ.get('ISNA_REPORT_FILE')
+        if fd:
+            # The file descriptor is closed by its owner (the process end
+            # for ansible-playbook, or isna for runs in its own process)
+            self._out = os.fdopen(int(fd), 'w', closefd=False)
+        elif path:
+            self._out = open(path, 'a')
+        else:
+            self._out = None
+        self._started = {}
+
+    def _write(self, event, **kwargs):
+        if self._out is None:
+            return
+        kwargs['event'] = event
+        kwargs['time'] = time.time()
+        self._out.write(json.dumps(kwargs) + '\n')
+        self._out.flush()
+
+    def _write_result(self, event, result):
+        host = result._host.get_name()
+        start = self._started.pop((host, result._task._uuid), None)
+        msg = result._result.get('msg') if event in ('failed', 'unreachable') else None
+        self._write(
+            event,
+            host=host,
+            task=result._task.get_name(),
+            duration=time.time() - start if start is not None else None,
+            text=str(msg) if msg else None,
+        )
+
+    def v2_playbook_on_play_start(self, play):
+        self._write('play_start', play=play.get_name())
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._write('task_start', task=task.get_name())
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._write('task_start', task=task.get_name())
+
+    def v2_runner_on_start(self, host, task):
+        self._started[(host.get_name(), task._uuid)] = time.time()
+        self._write('start', host=host.get_name(), task=task.get_name())
+
+    def v2_runner_on_ok(self, result):
+        changed = result._result.get('changed', False)
+        self._write_result('changed' if changed else 'ok', result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._write_result('ignored' if ignore_errors else 'failed', result)
+
+    def v2_runner_on_skipped(self, result):
+        self._write_result('skipped', result)
+
+    def v2_runner_on_unreachable(self, result):
+        self._write_result('unreachable', result)
+
+    def v2_playbook_on_stats(self, stats):
+        self._write('stats')
+        if self._out is not None:
+            self._out.close()
+            self._out = None
@@ -9,9 +9,10 @@ They are split like this so that printing out the program's
 usage & help statements occur quickly.
 """
 import os
-from schema import Schema, And, Or, Use, SchemaError, Regex
+import sys
 from collections import namedtuple, ChainMap
 from isna.config import cfg
+from isna.util import timed
 
 
 DEBUG = False
@@ -66,17 +67,25 @@ class Validate:
     here.
     """
     err_msg = 'Validation failed for {key!r} with data {data!r}'
+    keys = ('--ssh', '--dir', 'TEMPLATE', '--vars', '--forks', '--engine', '--temp-storage',
+            '--unchanged', '--days')
 
     def __init__(self, d_args):
         """Validate arguments/options given by docopt
 
         d_args is the dictionary of options & arguments made by docopt
         It also does some transformation of the data.
+        Options which weren't given (None or []) are valid as they are.
+        If no option needs validation the schema module isn't imported,
+        which keeps commands like 'isna ls hosts' quick.
         """
         self.data = d_args
-        for k, v in self.schema.items():
+        for k in self.keys:
+            if self.data[k] in (None, []):
+                continue
+            from schema import SchemaError
             try:
-                self.data[k] = v.validate(self.data[k])
+                self.data[k] = self.schema[k].validate(self.data[k])
             except SchemaError as e:
                 msg = self.err_msg.format(key=k, data=self.data[k])
                 raise ValueError(msg) from e
@@ -86,16 +95,23 @@ class Validate:
         try:
             return self._schema
         except AttributeError:
+            from schema import Schema
             d = {
                 '--ssh': self._schema_ssh(),
                 '--dir': self._schema_dir(),
                 'TEMPLATE': self._schema_template(),
                 '--vars': self._schema_vars(),
+                '--forks': self._schema_forks(),
+                '--engine': self._schema_engine(),
+                '--temp-storage': self._schema_temp_storage(),
+                '--unchanged': self._schema_unchanged(),
+                '--days': self._schema_days(),
             }
             self._schema = {k: Schema(v) for k, v in d.items()}
             return self._schema
 
     def _schema_ssh(self):
+        from schema import And, Or, Use, Regex
         cuser = r'[a-zA-Z_]'
         chost = r'[a-zA-Z0-9_\.]'
         cport = r'[0-9]{1,5}'
@@ -106,28 +122,52 @@ class Validate:
             r'^{host}+:{port}$'.format(host=chost, port=cport),
         )
         regexes = [Regex(v) for v in re_pats]
-        return Or(type(None), *regexes)
+
+        def split_hosts(sshargs):
+            return [x for arg in sshargs for x in arg.split(',')]
+        return And(Use(split_hosts), [Or(*regexes)])
+
+    def _schema_forks(self):
+        from schema import And, Use
+        return And(Use(int), lambda n: n > 0)
+
+    def _schema_days(self):
+        from schema import And, Use
+        return And(Use(float), lambda n: n > 0)
+
+    def _schema_engine(self):
+        from schema import Or
+        return Or(*_engines)
+
+    def _schema_temp_storage(self):
+        from schema import Or
+        return Or('disk', 'tmpfs', 'memfd')
+
+    def _schema_unchanged(self):
+        from schema import Or
+        return Or('skip', 'check', 'run')
 
     def _schema_dir(self):
         return [os.path.isdir]
 
     def _schema_vars(self):
+        from schema import And, Or, Use
         from isna.util import dict_from_str
         return Or(None, And(Use(dict_from_str), dict))
 
     def _schema_template(self):
+        from schema import Or
         td = get_templ_dirs(self.data['--dir'])
-        from isna.playbook import get_env
-        env = get_env(*td)
+        from isna.index import TemplateIndex
+        index = TemplateIndex(*td)
 
         def is_template(name):
-            if name in env.list_templates(cfg['templ_ext']):
-                return True
-            return False
+            return index.is_template(name, cfg['templ_ext'])
         return [Or(os.path.isfile, is_template)]
 
 
 _tr_ssh = namedtuple('_tr_ssh', 'user host port')
+_engines = {'exec': 'AnsiblePlaybook', 'inprocess': 'InProcessPlaybook'}
 _tr_templs = namedtuple('_tr_templs', 'name dir')
 
 
@@ -140,6 +180,15 @@ class Transform:
         '--dir': 'templ_dirs',
         'TEMPLATE': 'templs',
         '--vars': 'exvars',
+        '--batch': 'batch',
+        '--matrix': 'matrix',
+        '--forks': 'forks',
+        '--engine': 'engine',
+        '--temp-storage': 'temp_storage',
+        '--unchanged': 'unchanged',
+        '--days': 'days',
+        '--out': 'out',
+        '--diff': 'diff',
         'vars': 'ls_vars',
         'hosts': 'ls_hosts',
         'temp': 'ls_temp',
@@ -163,7 +212,7 @@ class Transform:
 
     @property
     def ssh(self):
-        return self._tr_ssh(self.raw_dat['ssh'])
+        return [self._tr_ssh(x) for x in self.raw_dat['ssh']]
 
     @staticmethod
     def _tr_ssh(ssharg):
@@ -211,14 +260,17 @@ def main(debug=False, **kwargs):
         global DEBUG
         DEBUG = True
     dprint('docopt produced the args:\n', kwargs)
-    val = Validate(kwargs)
-    tr = Transform(val.data)
-    dat = tr.data
+    with timed('validate'):
+        val = Validate(kwargs)
+    with timed('transform'):
+        tr = Transform(val.data)
+        dat = tr.data
     dpprint('validated & transformed args are:', dat)
-    ls = [k for k, v in dat.items() if k.startswith('ls_') and v]
-    for func in ls:
-        print(*globals()[func](**dat), sep='\n', flush=True)
-        return 0
+    for func in ('ls_hosts', 'ls_temp', 'ls_vars', 'stats', 'render'):
+        if dat.get(func):
+            for line in globals()[func](**dat):
+                print(line, flush=True)
+            return 0
     runner = Runner(**dat)
     return runner.run()
 
@@ -232,57 +284,538 @@ class Runner:
         exvars = kwargs['exvars']
         exvars = exvars if exvars else {}
         self.exvars = exvars
-        self.inpq = InputQuery()
+        # In matrix mode stdin holds the rows, see matrix_rows()
+        self.inpq = InputQuery(read_pipe=not kwargs.get('matrix'))
 
     @property
     def templates(self):
         return [x.name for x in self.kwargs['templs']]
 
+    @property
+    def pbmaker(self):
+        "The PBMaker shared by variable discovery and rendering"
+        try:
+            return self._pbmaker
+        except AttributeError:
+            from isna.playbook import PBMaker
+            self._pbmaker = PBMaker.shared(*self.kwargs['templ_dirs'])
+            return self._pbmaker
+
+    @property
+    def targets(self):
+        "The ssh targets to run on. A target with host None means localhost"
+        return self.kwargs['ssh'] or [_tr_ssh(None, None, None)]
+
+    @property
+    def mode(self):
+        "How the templates are run: matrix, fanout, batch or each"
+        if self.kwargs.get('matrix'):
+            return 'matrix'
+        if len(self.targets) > 1:
+            return 'fanout'
+        if self.kwargs.get('batch'):
+            return 'batch'
+        return 'each'
+
     def run(self):
-        tdirs = [x for x in self.kwargs['templ_dirs']]
-        from isna.playbook import PBMaker, AnsiblePlaybook
-        pbm = PBMaker(*tdirs)
+        from isna import util
+        timings = util.timings
+        if timings is None and self.history is not None:
+            util.timings = util.Timings()  # For the phases in the history
+        returncode = None
+        try:
+            returncode = getattr(self, 'run_' + self.mode)()
+            return returncode
+        finally:
+            if cfg['ssh_control_persist'] == 'no':
+                self.close_connections()
+            if self.history is not None:
+                self.history.close(returncode, util.timings.phases)
+            util.timings = timings
+
+    def playbook(self, playbook_str, host_list, avars, engine=None):
+        """Return an AnsiblePlaybook running playbook_str on host_list with the extra vars avars
+
+        Its class is that of engine (default: the --engine option or
+        cfg['engine']). Its temporary files are kept on the --temp-storage
+        option, or else cfg['temp_storage'].
+        """
+        import isna.playbook
+        engine = engine or self.kwargs.get('engine') or cfg['engine']
+        apb = getattr(isna.playbook, _engines[engine])(playbook_str, host_list, **avars)
+        if self.kwargs.get('temp_storage'):
+            apb.storage = self.kwargs['temp_storage']
+        return apb
+
+    def run_each(self):
+        """Run the templates one after another, each with its own ansible-playbook
+
+        Returns the largest return code of the runs.
+        """
+        from time import monotonic
+        pbm = self.pbmaker
         pbm.update(self.template_vars)
         avars = self.get_ansible_vars()
+        returncodes = [0]
         for name in self.templates:
+            key = self.run_key([name], self.host_list, avars)
+            options = self.unchanged_options(key)
+            if options is None:
+                print(self.skip_msg.format(name), flush=True)
+                continue
             dprint('Running playbook', name)
             txt = pbm.render(name)
             dprint(txt)
-            with AnsiblePlaybook(txt, self.host_list, **avars) as apb:
-                out = apb.run()
-                return out.returncode
+            start = monotonic()
+            with self.playbook(txt, self.host_list, avars) as apb:
+                apb.options = options
+                events = list(apb.stream())
+            self.forget_unreachable(events)
+            self.record_run(key, apb.returncode, options)
+            self.record_history(self.host_list[0], {name: (apb.returncode, monotonic() - start)})
+            self.report_tasks(events)
+            returncodes.append(apb.returncode)
+        return max(returncodes)
+
+    def run_batch(self):
+        """Render all templates into one playbook and run it with a single ansible-playbook
+
+        Prints the return code & duration of each play and returns
+        the return code of ansible-playbook.
+        """
+        from isna.playbook import merge_playbooks, play_results, template_results
+        pbm = self.pbmaker
+        pbm.update(self.template_vars)
+        avars = self.get_ansible_vars()
+        key = self.run_key(self.templates, self.host_list, avars)
+        options = self.unchanged_options(key)
+        if options is None:
+            print(self.skip_msg.format(' '.join(self.templates)), flush=True)
+            return 0
+        rendered = [(name, pbm.render(name)) for name in self.templates]
+        txt, play_templs = merge_playbooks(rendered)
+        dprint('Running batched playbook', self.templates)
+        dprint(txt)
+        with self.playbook(txt, self.host_list, avars) as apb:
+            apb.options = options
+            events = [ev for ev in apb.stream() if ev.kind != 'start']
+        self.record_run(key, apb.returncode, options)
+        self.forget_unreachable(events)
+        results = play_results(events, play_templs)
+        self.record_history(self.host_list[0], template_results(results))
+        self.report_tasks(events)
+        from isna.util import format_table
+        print(format_table(results, ('TEMPLATE', 'PLAY', 'RC', 'SECONDS')), flush=True)
+        return apb.returncode
+
+    def run_fanout(self):
+        """Run the templates on every target using a pool of --forks workers
+
+        Each target gets its own ansible-playbook process. Their output is
+        printed once a target finishes, followed by a summary of all targets.
+        Failed tasks are reported on stderr as soon as they happen.
+        The targets always run ansible-playbook, whatever the --engine.
+        Returns the largest return code of all runs.
+        """
+        from isna.playbook import merge_playbooks, play_results, template_results
+        pbm = self.pbmaker
+        pbm.update(self.template_vars)
+        rendered = [(name, pbm.render(name)) for name in self.templates]
+        txt, play_templs = merge_playbooks(rendered)
+        dprint(txt)
+        probes = self.preflight(self.targets)
+        jobs = []
+        rows = []
+        for ssh in self.targets:
+            avars = self.get_ansible_vars(ssh, probes[ssh])
+            host = ssh.host if ssh.host else cfg['default_host']
+            key = self.run_key(self.templates, [host], avars)
+            options = self.unchanged_options(key)
+            if options is None:
+                print('==> {} <=='.format(host), self.skip_msg.format(' '.join(self.templates)),
+                      sep='\n', flush=True)
+                rows.append((host, 0, 0, 0, 0, 0, 0, 0.0))
+            else:
+                jobs.append((ssh, avars, key, options))
+
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from isna.util import format_table
+        forks = self.kwargs['forks'] or cfg['forks']
+        all_events = []
+        with ThreadPoolExecutor(max_workers=forks) as pool:
+            futures = {
+                pool.submit(self._run_target, txt, ssh, avars, options): (key, options)
+                for ssh, avars, key, options in jobs
+            }
+            for fut in as_completed(futures):
+                row, output, events = fut.result()
+                key, options = futures[fut]
+                self.record_run(key, row[1], options)
+                self.record_history(row[0], template_results(play_results(events, play_templs)))
+                self.forget_unreachable(events)
+                print('==> {} <=='.format(row[0]), output, sep='\n', flush=True)
+                rows.append(row)
+                all_events.extend(events)
+        self.report_tasks(all_events)
+        header = ('HOST', 'RC', 'OK', 'CHANGED', 'FAILED', 'UNREACHABLE', 'SKIPPED', 'SECONDS')
+        print(format_table(sorted(rows), header), flush=True)
+        return max(x[1] for x in rows)
+
+    def matrix_rows(self):
+        """Yield (number, variables) for each line of the rows read from stdin
+
+        Each non-empty line is a json object, or key=value pairs (see
+        isna.util.dict_from_str). Rows are numbered by their line.
+        """
+        from isna.util import dict_from_str
+        for number, line in enumerate(self.inpq.input_file, 1):
+            if line.strip():
+                yield number, dict_from_str(line)
+
+    def run_matrix(self):
+        """Run the templates once for each row of variables read from stdin
+
+        Every row is rendered with the template variables of the row and
+        --vars (the row wins). Its other variables become play vars of the
+        row's plays, with or without --batch. So they lose to --vars and the
+        connection variables, which ansible gets as extra vars.
+        With --batch all rows are run as one playbook, where a row
+        which fails on the host stops the rows after it. Otherwise each row
+        is run with its own ansible-playbook, --forks of them at a time.
+        Prints the status of each row and returns the largest return code.
+        """
+        if len(self.targets) > 1:
+            raise ValueError('--matrix runs on a single --ssh target')
+        if self.kwargs.get('unchanged'):
+            raise ValueError('--unchanged is not supported with --matrix')
+        from isna.util import format_table, maybe_bool
+        pbm = self.pbmaker
+        templ_vars = self.all_templ_vars
+        jobs, errors = [], []
+        for number, row in self.matrix_rows():
+            values = ChainMap(row, self.exvars)
+            missing = [x for x in templ_vars if x not in values]
+            if missing:
+                print('row {}: missing {}'.format(number, ', '.join(missing)),
+                      file=sys.stderr, flush=True)
+                errors.append(number)
+                continue
+            tvars = {k: maybe_bool(values[k]) for k in templ_vars}
+            rendered = [(name, pbm.render(name, **tvars)) for name in self.templates]
+            rvars = {k: v for k, v in row.items() if k not in tvars}
+            jobs.append((number, rendered, rvars, tvars))
+        avars = self.get_ansible_vars()
+        dprint('Running {} rows of {}'.format(len(jobs), self.templates))
+        if self.kwargs.get('batch'):
+            rows, header, events = self._run_matrix_batch(jobs, avars)
+        else:
+            rows, header, events = self._run_matrix_fanout(jobs, avars)
+        self.report_tasks(events)
+        rows.extend((number,) + (None,) * (len(header) - 1) for number in errors)
+        print(format_table(sorted(rows), header), flush=True)
+        returncodes = [x[1] for x in rows if x[1] is not None]
+        return max(returncodes + [1 if errors else 0])
+
+    def _run_matrix_batch(self, jobs, avars):
+        "Run the rendered rows of jobs as one playbook. Return the rows & header of the summary, and the events"
+        from isna.playbook import merge_playbooks, play_results, template_results
+        playbooks, variables = [], []
+        for number, rendered, rvars, tvars in jobs:
+            playbooks.extend(((number, name), txt) for name, txt in rendered)
+            variables.extend(rvars for x in rendered)
+        txt, play_rows = merge_playbooks(playbooks, variables)
+        dprint(txt)
+        with self.playbook(txt, self.host_list, avars) as apb:
+            events = [ev for ev in apb.stream() if ev.kind != 'start']
+        self.forget_unreachable(events)
+        results = template_results(play_results(events, play_rows))
+        rows = []
+        for number, rendered, rvars, tvars in jobs:
+            row_results = {name: results.get((number, name), (None, 0.0)) for name, _ in rendered}
+            self.record_history(self.host_list[0], row_results, tvars)
+            returncodes = [x[0] for x in row_results.values() if x[0] is not None]
+            duration = sum(x[1] for x in row_results.values())
+            rows.append((number, max(returncodes) if returncodes else None, duration))
+        return rows, ('ROW', 'RC', 'SECONDS'), events
+
+    def _run_matrix_fanout(self, jobs, avars):
+        """Run the rendered rows of jobs using a pool of --forks workers
+
+        Returns the rows & header of the summary, and the events of all rows.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from isna.playbook import merge_playbooks, play_results, template_results
+        ssh = self.targets[0]
+        forks = self.kwargs['forks'] or cfg['forks']
+        rows, all_events = [], []
+        with ThreadPoolExecutor(max_workers=forks) as pool:
+            futures = {}
+            for number, rendered, rvars, tvars in jobs:
+                txt, play_templs = merge_playbooks(rendered, [rvars] * len(rendered))
+                fut = pool.submit(self._run_target, txt, ssh, avars)
+                futures[fut] = number, play_templs, tvars
+            for fut in as_completed(futures):
+                row, output, events = fut.result()
+                number, play_templs, tvars = futures[fut]
+                self.record_history(row[0], template_results(play_results(events, play_templs)),
+                                    tvars)
+                self.forget_unreachable(events)
+                print('==> row {} <=='.format(number), output, sep='\n', flush=True)
+                rows.append((number,) + row[1:])
+                all_events.extend(events)
+        header = ('ROW', 'RC', 'OK', 'CHANGED', 'FAILED', 'UNREACHABLE', 'SKIPPED', 'SECONDS')
+        return rows, header, all_events
+
+    def _run_target(self, playbook_str, ssh, avars, options=()):
+        """Run playbook_str on one target. Return its summary row, output & events
+
+        options are additional options for ansible-playbook.
+        """
+        from time import monotonic
+        from isna.playbook import host_results, run_event
+        host = ssh.host if ssh.host else cfg['default_host']
+        start = monotonic()
+        output, events = [], []
+        with self.playbook(playbook_str, [host], avars, engine='exec') as apb:
+            apb.options = list(options)
+            for ev in apb.stream(capture=True):
+                if ev.kind == 'output':
+                    output.append(ev.text)
+                elif ev.kind in run_event.results or ev.kind == 'play_start':
+                    events.append(ev)
+                    if ev.kind in ('failed', 'unreachable'):
+                        print('{}: {} [{}]'.format(host, ev.kind, ev.task),
+                              file=sys.stderr, flush=True)
+        duration = monotonic() - start
+        counts = host_results(events).get(host, {})
+        statuses = ('ok', 'changed', 'failed', 'unreachable', 'skipped')
+        row = (host, apb.returncode) + tuple(counts.get(x, 0) for x in statuses) + (duration,)
+        return row, '\n'.join(output), events
+
+    def report_tasks(self, events):
+        """Print the cfg['slowest_tasks'] slowest tasks on any host in the events of a run
+
+        All the task durations are recorded in the history.
+        """
+        from isna.playbook import task_times
+        times = task_times(events)
+        if self.history is not None:
+            self.history.record_tasks(times)
+        slowest = times[:cfg['slowest_tasks']]
+        if slowest:
+            from isna.util import format_table
+            print(format_table(slowest, ('PLAY', 'TASK', 'HOST', 'SECONDS')), flush=True)
 
-    def get_ansible_vars(self):
+    @property
+    def history(self):
+        "The History recording this command, or None if cfg['history'] is false"
+        try:
+            return self._history
+        except AttributeError:
+            from isna.history import History
+            self._history = History(self.mode) if cfg['history'] else None
+            return self._history
+
+    def record_history(self, host, results, tvars=None):
+        """Record the runs of templates on host in the history
+
+        results maps each template to its (returncode, seconds). The runs are
+        keyed by a hash of the template's sources and its variables in tvars
+        (default: the template variables of the command).
+        """
+        if self.history is None:
+            return
+        import hashlib
+        import json
+        pbm = self.pbmaker
+        tvars = self.template_vars if tvars is None else tvars
+        for name, (returncode, seconds) in results.items():
+            own = {k: v for k, v in tvars.items() if k in pbm.all_vars(name)}
+            data = json.dumps([pbm.source_hash(name), own], sort_keys=True, default=str)
+            key = hashlib.sha1(data.encode()).hexdigest()
+            self.history.record_run(name, key, host, returncode, seconds)
+
+    skip_msg = 'Skipping {}: unchanged since its last successful run'
+
+    @property
+    def run_cache(self):
+        "The RunCache, or None unless --unchanged or cfg['unchanged'] is given"
+        try:
+            return self._run_cache
+        except AttributeError:
+            from isna.util import RunCache
+            unchanged = self.kwargs.get('unchanged') or cfg['unchanged']
+            self._run_cache = RunCache() if unchanged else None
+            return self._run_cache
+
+    def run_key(self, templates, hosts, avars):
+        """Return the RunCache key of running templates on hosts with the ansible vars avars
+
+        It hashes the sources of the templates (and the templates they
+        reference), the variables of those templates, the hosts and those
+        ansible variables which aren't secrets (see cfg['pass_substrs']).
+        """
+        if self.run_cache is None:
+            return None
+        pbm = self.pbmaker
+        sources = [pbm.source_hash(x) for x in templates]
+        names = {k for x in templates for k in pbm.all_vars(x)}
+        tvars = {k: v for k, v in self.template_vars.items() if k in names}
+        public = {
+            k: v for k, v in avars.items()
+            if not any(x in k for x in cfg['pass_substrs'])
+        }
+        return self.run_cache.key(sources, tvars, sorted(hosts), public)
+
+    def unchanged_options(self, key):
+        """Return the ansible-playbook options for the run with key, or None to skip it
+
+        Runs whose key had a successful run before are skipped, run with
+        --check or run as usual, depending on --unchanged.
+        """
+        entry = self.run_cache.get(key) if key is not None else None
+        if entry is None or entry['returncode'] != 0:
+            return []
+        unchanged = self.kwargs.get('unchanged') or cfg['unchanged']
+        if unchanged == 'skip':
+            dprint('Skipping unchanged run', key)
+            return None
+        if unchanged == 'check':
+            dprint('Checking unchanged run', key)
+            return ['--check']
+        return []
+
+    def record_run(self, key, returncode, options=()):
+        "Store the returncode of the run with key in the RunCache. Runs with --check aren't stored"
+        if key is None or '--check' in options:
+            return
+        self.run_cache.put(key, returncode, templates=self.templates)
+        self.run_cache.save()
+
+    @property
+    def needs_pass_cache(self):
+        "The NeedsPassCache, or None if cfg['needs_pass_ttl'] is 0"
+        try:
+            return self._needs_pass_cache
+        except AttributeError:
+            from isna.util import NeedsPassCache
+            ttl = cfg['needs_pass_ttl']
+            self._needs_pass_cache = NeedsPassCache(ttl=ttl) if ttl else None
+            return self._needs_pass_cache
+
+    @property
+    def ssh_control(self):
+        "The SSHControl for shared ssh connections, or None if cfg['ssh_control_persist'] is None"
+        try:
+            return self._ssh_control
+        except AttributeError:
+            from isna.util import SSHControl
+            persist = cfg['ssh_control_persist']
+            self._ssh_control = SSHControl(persist=persist) if persist is not None else None
+            return self._ssh_control
+
+    def close_connections(self):
+        "Close the shared ssh connections to all targets"
+        control = self.ssh_control
+        if control is None:
+            return
+        from isna.playbook import AnsibleArgs
+        for ssh in self.targets:
+            if ssh.host is not None:
+                args = AnsibleArgs.from_ssh(**ssh._asdict())
+                control.stop(user=args['ansible_user'], hostname=ssh.host,
+                             port=args['ansible_port'])
+
+    def forget_unreachable(self, events):
+        """Drop cached NeedsPass results of hosts ansible couldn't connect to
+
+        events are the isna_report events of the run. Failed logins are
+        reported as unreachable by ansible, a missing or wrong sudo password
+        as a failed task; the next run probes these hosts again.
+        """
+        cache = self.needs_pass_cache
+        if cache is None:
+            return
+        from isna.playbook import become_failures, host_results
+        hosts = {x for x, counts in host_results(events).items() if counts.get('unreachable')}
+        for host in sorted(hosts | become_failures(events)):
+            dprint('Forgetting cached ssh test results for', host)
+            cache.invalidate(host)
+        cache.save()
+
+    def preflight(self, targets):
+        """Concurrently test whether the ssh targets need passwords
+
+        Returns a dict mapping each target to its need_pass result.
+        """
+        from isna.playbook import AnsibleArgs
+        from isna.util import NeedsPass, format_table, need_pass
+        remote = [x for x in targets if x.host is not None]
+        probes = []
+        for ssh in remote:
+            args = AnsibleArgs.from_ssh(**ssh._asdict())
+            probes.append(dict(user=args['ansible_user'], hostname=ssh.host,
+                               port=args['ansible_port'], sudo=self.kwargs['sudo']))
+        dprint('Testing ssh connections of {} hosts without password'.format(len(probes)))
+        with timed('probe'):
+            results = NeedsPass.ssh_many(probes, cache=self.needs_pass_cache,
+                                         control=self.ssh_control)
+        results = dict(zip(remote, results))
+        dprint('SSH test results:\n', format_table(results.values(), need_pass._fields))
+        return results
+
+    def get_ansible_vars(self, ssh=None, probe=None):
+        """Return the --extra-vars for ansible when connecting to ssh
+
+        probe is an optional need_pass result for ssh from preflight().
+        If it isn't given, the ssh connection is tested here.
+        """
         sudo = self.kwargs['sudo']
-        ssh = self.kwargs['ssh']
+        if ssh is None:
+            ssh = self.targets[0]
 
         ansivars = ChainMap(self.inpq.data, self.exvars)
-        ansivars = {k: v for k, v in ansivars.items() if k not in self.template_vars}
+        templ_vars = set(self.all_templ_vars)
+        ansivars = {k: v for k, v in ansivars.items() if k not in templ_vars}
         from isna.playbook import AnsibleArgs
-        ansivars.update(AnsibleArgs.from_ssh(**ssh._asdict()))
+        sshargs = AnsibleArgs.from_ssh(control=self.ssh_control, **ssh._asdict())
+        common = 'ansible_ssh_common_args'
+        if common in ansivars and common in sshargs:
+            # ssh uses the first value given for an option, so the user's args win
+            sshargs[common] = '{} {}'.format(ansivars[common], sshargs[common])
+        ansivars.update(sshargs)
         ansivars.update(AnsibleArgs.from_sudo(sudo))
         from isna.util import NeedsPass
         if ssh.host is not None:
-            dprint('Testing ssh connection without password')
-            res = NeedsPass.ssh(
-                user=ansivars['ansible_user'],
-                hostname=ssh.host,
-                port=ansivars['ansible_port'],
-                sudo=sudo,
-            )
+            if probe is None:
+                dprint('Testing ssh connection without password')
+                with timed('probe'):
+                    probe = NeedsPass.ssh(
+                        user=ansivars['ansible_user'],
+                        hostname=ssh.host,
+                        port=ansivars['ansible_port'],
+                        sudo=sudo,
+                        cache=self.needs_pass_cache,
+                        control=self.ssh_control,
+                    )
+            res = probe
             dprint('SSH test results:\n', res)
             if res.ssh_needs_pw and ('ansible_ssh_pass' not in ansivars):
-                passtupl = self.inpq('ansible_ssh_pass', hide=True)
+                with timed('prompt'):
+                    passtupl = self.inpq('ansible_ssh_pass', hide=True)
                 ansivars[passtupl.var] = passtupl.result
             if res.sudo_needs_pw and ('ansible_become_pass' not in ansivars):
-                passtupl = self.inpq('ansible_become_pass', hide=True)
+                with timed('prompt'):
+                    passtupl = self.inpq('ansible_become_pass', hide=True)
                 ansivars[passtupl.var] = passtupl.result
         elif sudo and ('ansible_become_pass' not in ansivars):
             dprint('Testing sudo without password')
-            res = NeedsPass.sudo(user=sudo)
+            with timed('probe'):
+                res = NeedsPass.sudo(user=sudo)
             dprint('Sudo test results:\n', res)
             if res.sudo_needs_pw:
-                passtupl = self.inpq('ansible_become_pass', hide=True)
+                with timed('prompt'):
+                    passtupl = self.inpq('ansible_become_pass', hide=True)
                 ansivars[passtupl.var] = passtupl.result
         dprint('Ansible --extra-vars:\n{!r}'.format(ansivars))
         return ansivars
@@ -293,12 +826,13 @@ class Runner:
             return self._template_vars
         except AttributeError:
             remaining = set(self.all_templ_vars) - set(self.exvars)
-            remaining = remaining - set(self.inpq.data)
-            for var in remaining:
-                if any(x in var for x in cfg['pass_substrs']):
-                    self.inpq(var, hide=True, repeat=True)
-                else:
-                    self.inpq(var)
+            with timed('prompt'):
+                remaining = remaining - set(self.inpq.data)
+                for var in remaining:
+                    if any(x in var for x in cfg['pass_substrs']):
+                        self.inpq(var, hide=True, repeat=True)
+                    else:
+                        self.inpq(var)
             tvs = ChainMap(self.inpq.data, self.exvars)
             from isna.util import maybe_bool
             tvs = {k: maybe_bool(tvs[k]) for k in self.all_templ_vars}
@@ -308,7 +842,7 @@ class Runner:
 
     @property
     def host_list(self):
-        ssh = self.kwargs['ssh']
+        ssh = self.targets[0]
         return [ssh.host] if ssh.host else [cfg['default_host']]
 
     @property
@@ -316,18 +850,20 @@ class Runner:
         try:
             return self._all_templ_vars
         except AttributeError:
-            self._all_templ_vars = ls_vars(**self.kwargs)
+            self._all_templ_vars = ls_vars(pbmaker=self.pbmaker, **self.kwargs)
             dprint('All template vars:\n', self._all_templ_vars)
             return self._all_templ_vars
 
 
 def ls_hosts(**kwargs):
-    hosts = ['localhost']
+    "Yield localhost and the hosts on the avahi domain, as they are found"
+    yield 'localhost'
     msg = 'Searching on the avahi domain {!r} for other hosts'
     dprint(msg.format(kwargs['domain']))
-    from isna.util import get_hosts
-    hosts.extend(get_hosts(domain=kwargs['domain']))
-    return [x for x in hosts if x]
+    from isna.util import HostsCache, iter_hosts
+    ttl = cfg['hosts_ttl']
+    cache = HostsCache(ttl=ttl) if ttl else None
+    yield from iter_hosts(domain=kwargs['domain'], cache=cache)
 
 
 def ls_temp(**kwargs):
@@ -335,16 +871,75 @@ def ls_temp(**kwargs):
     templ_dirs = kwargs['templ_dirs']
     msg = 'Listing playbook templates ending w/ {!r} in {!r}'
     dprint(msg.format(templ_ext, templ_dirs))
-    from isna.playbook import PBMaker
-    pbm = PBMaker(*templ_dirs)
-    return pbm.list_templates(templ_ext)
+    from isna.index import TemplateIndex
+    return TemplateIndex(*templ_dirs).names(templ_ext)
+
 
+def stats(**kwargs):
+    "Yield the tables of isna.history.stats, separated by empty lines"
+    from isna.history import stats as history_stats
+    from isna.util import format_table
+    for i, (header, rows) in enumerate(history_stats(days=kwargs['days'])):
+        if i:
+            yield ''
+        yield format_table(rows, header)
 
-def ls_vars(**kwargs):
-    from isna.playbook import PBMaker
-    pbm = PBMaker(*kwargs['templ_dirs'])
+
+def render(**kwargs):
+    """Render the templates without running them, and yield the lines to print
+
+    The variables come from --vars, stdin or prompts, like for a run.
+    The renders are written to --out, or else printed. With --diff the
+    changes from the last render of each template with the same
+    variables are printed instead. Renders are only kept for --diff,
+    and never if the template has secret variables (see cfg['pass_substrs']).
+    """
+    from isna.util import RenderCache, write_atomic
+    runner = Runner(**kwargs)
+    pbm = runner.pbmaker
+    tvars = runner.template_vars
+    cache = RenderCache() if kwargs['diff'] else None
+    renders = []
+    for name in runner.templates:
+        txt = pbm.render(name, **tvars)
+        renders.append(txt)
+        if cache is None:
+            if not kwargs['out']:
+                yield txt
+            continue
+        own = {k: tvars[k] for k in pbm.all_vars(name)}
+        if any(x in k for k in own for x in cfg['pass_substrs']):
+            msg = 'isna: renders of {} are not kept, it has secret variables'
+            last = None
+        else:
+            msg = 'isna: no earlier render of {} with these variables'
+            key = cache.key(name, own)
+            last = cache.get(key)
+            cache.put(key, txt)
+        if last is None:
+            print(msg.format(name), file=sys.stderr, flush=True)
+            last = ''
+        import difflib
+        yield from difflib.unified_diff(
+            last.splitlines(), txt.splitlines(),
+            '{} (last render)'.format(name), name, lineterm='',
+        )
+    if kwargs['out']:
+        write_atomic(kwargs['out'], '\n'.join(renders) + '\n', mode=0o666)
+
+
+def ls_vars(pbmaker=None, **kwargs):
+    """List the variables of the templates
+
+    Without a pbmaker the variables are looked up in the TemplateIndex.
+    """
+    if pbmaker is None:
+        from isna.index import TemplateIndex
+        get_vars = TemplateIndex(*kwargs['templ_dirs']).variables
+    else:
+        get_vars = pbmaker.all_vars
     tnames = kwargs['templs']
     all_vars = []
     for x in tnames:
-        all_vars.extend(pbm.all_vars(x.name))
+        all_vars.extend(get_vars(x.name))
     return sorted(uniq(all_vars))
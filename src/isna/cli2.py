@@ -4,32 +4,131 @@ Usage:
   isna ls temp [--dir=<dir>]...
   isna ls vars [--dir=<dir>]... TEMPLATE...
   isna ls hosts [--domain=<domain>]
-  isna [--dir=<dir>]... [--vars=<xtra>] [--ssh=<user@host:port>] [--sudo=<user>] TEMPLATE...
+  isna stats [--days=<days>]
+  isna render [--dir=<dir>]... [--vars=<xtra>] [--out=<file>] [--diff] TEMPLATE...
+  isna serve [--socket=<path>] [--dir=<dir>]...
+  isna [--dir=<dir>]... [--vars=<xtra>] [--ssh=<user@host:port>]... [--forks=<n>] [--sudo=<user>]
+       [--batch] [--matrix] [--engine=<engine>] [--temp-storage=<where>] [--unchanged=<action>]
+       TEMPLATE...
   isna (-h | --help | --version)
 
 Options:
   --dir=<dir>             Additional template directory.
-  --ssh=<user@host:port>  Connect as user to host using ssh
+  --ssh=<user@host:port>  Connect as user to host using ssh. Can be repeated
+                          or given as a comma separated list of hosts.
+  --forks=<n>             Number of hosts to run on concurrently (default: 5)
   --sudo=<user>           Sudo to this user after connection
   --domain=<domain>       Avahi-domain [default: .local]
+  --days=<days>           Only summarize the runs of the last days
+  --socket=<path>         UNIX socket of the server (default: $XDG_RUNTIME_DIR/isna/server.sock)
   --vars=<vars>           Extra variables for TEMPLATE and ansible
+  --batch                 Run all TEMPLATEs as one playbook in a single ansible run
+  --out=<file>            Write the rendered TEMPLATEs to file instead of stdout
+  --diff                  Show the changes from the last render of TEMPLATE
+                          with the same variables
+  --matrix                Read one set of variables per line of stdin (JSON Lines)
+                          and run TEMPLATEs once for each of them
+  --engine=<engine>       How to run ansible: exec runs ansible-playbook, inprocess
+                          uses ansible's python API in this process (default: exec)
+  --temp-storage=<where>  Where to keep the temporary playbook & extra vars files: disk,
+                          tmpfs (in memory) or memfd (in memory, without a path)
+                          (default: disk)
+  --unchanged=<action>    Remember successful runs, and skip, check (ansible's --check)
+                          or run again TEMPLATEs whose sources, variables & host
+                          haven't changed since their last successful run
+  --debug                 Print what isna does on stderr
+  --profile               Print the time spent in each phase of the command on stderr
+  --profile=<file>        Also write the command's cProfile statistics to file
   -h --help               Show this screen.
   --version               Show version.
+
+--debug and --profile[=<file>] can be given with any of the commands above.
+
+Environment:
+  ISNA_SERVER=yes         Run commands in a running 'isna serve' (default: no)
 """
 import sys
 from docopt import docopt
+from isna.config import cfg
+
 
+def main(argv=None, forward=True):
+    """Run the isna command line argv (default: sys.argv[1:])
 
-def main(argv=None):
+    If forward is true, $ISNA_SERVER (or else cfg['server']) is true and
+    an 'isna serve' server is running, the command runs in the server
+    (see isna.server).
+
+    Two options are accepted anywhere in argv: --debug prints what isna
+    does on stderr, and --profile prints the time spent in each phase
+    of the command on stderr. --profile=<file> also runs the command
+    under cProfile and writes its statistics to file.
+    """
     if argv is None:
         argv = sys.argv[1:]
-        if '--debug' in argv:
-            del argv[argv.index('--debug')]
-            debug = True
-        else:
-            debug = False
+    if forward and _forwarding() and argv[:1] != ['serve']:
+        from isna.server import forward as forward_to_server
+        returncode = forward_to_server(argv)
+        if returncode is not None:
+            return returncode
+    if '--debug' in argv:
+        argv = [x for x in argv if x != '--debug']
+        debug = True
+    else:
+        debug = False
+    profile = [x for x in argv if x == '--profile' or x.startswith('--profile=')]
+    if profile:
+        argv = [x for x in argv if x not in profile]
+        return _profiled(argv, debug, profile[-1].partition('=')[2] or None)
+    return _run(argv, debug)
+
 
-    args = docopt(__doc__, version='Isna v0.2.0', argv=argv)
+def _forwarding():
+    "True if commands are forwarded to 'isna serve': $ISNA_SERVER if it is set, else cfg['server']"
+    import os
+    env = os.environ.get('ISNA_SERVER')
+    if not env:
+        return cfg['server']
+    return env.lower() in cfg['true_strs'] + ['1']
+
+
+def _run(argv, debug, profiled=False):
+    if profiled:
+        from isna.util import timed
+        with timed('docopt'):
+            args = docopt(__doc__, version='Isna v0.2.0', argv=argv)
+    else:
+        args = docopt(__doc__, version='Isna v0.2.0', argv=argv)
     args.pop('--help', None), args.pop('--version', None)
+    if args.pop('serve', False):
+        from isna.server import serve
+        return serve(args['--socket'], args['--dir'])
+    args.pop('--socket', None)
     import isna.cli as cli
     return cli.main(debug=debug, **args)
+
+
+def _profiled(argv, debug, pstats_path=None):
+    """Run the command line argv and print the time spent in each of its phases on stderr
+
+    If pstats_path is given the command runs under cProfile, and its
+    statistics are written to pstats_path (see the pstats module).
+    """
+    from time import perf_counter
+    from isna import util
+    util.timings = util.Timings()
+    profiler = None
+    if pstats_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    start = perf_counter()
+    try:
+        if profiler is not None:
+            return profiler.runcall(_run, argv, debug, profiled=True)
+        return _run(argv, debug, profiled=True)
+    finally:
+        total = perf_counter() - start
+        if profiler is not None:
+            profiler.dump_stats(pstats_path)
+        print(util.timings.table(total), file=sys.stderr, flush=True)
+        util.timings = None
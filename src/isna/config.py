@@ -5,7 +5,26 @@ cfg = dict(
     default_host='localhost',
     templ_dirs=[('isna', 'playbook_templates'), ],
     templ_ext=['yml', 'json'],
+    bytecode_cache=True,
     default_ssh_port=22,
+    probe_timeout=10,
+    forks=5,
+    engine='exec',
+    temp_storage='disk',
+    unchanged=None,
+    run_cache_ttl=24 * 3600,
+    render_cache_ttl=7 * 24 * 3600,
+    index_ttl=30 * 24 * 3600,
+    server=False,
+    server_socket=None,
+    needs_pass_ttl=600,
+    ssh_control_persist='60s',
+    avahi_timeout=5,
+    hosts_ttl=60,
+    slowest_tasks=5,
+    history=True,
+    history_path=None,
+    history_ttl=90 * 24 * 3600,
 )
 
 _common_ansi_vars = dict(
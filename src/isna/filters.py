@@ -0,0 +1,223 @@
+"""isna.filters -- Jinja filters for playbook templates which ansible also provides
+
+Importing ansible's filter plugins takes much longer than rendering a
+template, so isna implements the ansible filters which templates commonly
+use itself. registry maps a filter name to the 'module:attribute' which
+implements it; a filter is imported only when a template uses it
+(see load). Filters missing here are taken from ansible.
+"""
+from functools import lru_cache as _lru_cache
+
+registry = {
+    'b64decode': 'isna.filters:b64decode',
+    'b64encode': 'isna.filters:b64encode',
+    'basename': 'os.path:basename',
+    'bool': 'isna.filters:to_bool',
+    'dirname': 'os.path:dirname',
+    'expanduser': 'os.path:expanduser',
+    'expandvars': 'os.path:expandvars',
+    'from_json': 'json:loads',
+    'from_yaml': 'isna.filters:from_yaml',
+    'hash': 'isna.filters:get_hash',
+    'password_hash': 'isna.filters:password_hash',
+    'quote': 'isna.filters:quote',
+    'realpath': 'os.path:realpath',
+    'regex_escape': 'isna.filters:regex_escape',
+    'regex_replace': 'isna.filters:regex_replace',
+    'ternary': 'isna.filters:ternary',
+    'to_json': 'isna.filters:to_json',
+    'to_nice_json': 'isna.filters:to_nice_json',
+    'to_nice_yaml': 'isna.filters:to_nice_yaml',
+    'to_yaml': 'isna.filters:to_yaml',
+}
+
+
+def load(name):
+    "Import and return the filter name from the registry. Raises KeyError if it isn't there"
+    import importlib
+    module, attr = registry[name].split(':')
+    return getattr(importlib.import_module(module), attr)
+
+
+def _text(value):
+    return value.decode('utf-8', 'surrogateescape') if isinstance(value, bytes) else str(value)
+
+
+def b64encode(string, encoding='utf-8'):
+    import base64
+    return base64.b64encode(_text(string).encode(encoding, 'surrogateescape')).decode()
+
+
+def b64decode(string, encoding='utf-8'):
+    import base64
+    return base64.b64decode(_text(string).encode()).decode(encoding, 'surrogateescape')
+
+
+def to_bool(a):
+    "Like ansible's bool filter: True for 'yes', 'on', '1', 'true' & 1"
+    if a is None or isinstance(a, bool):
+        return a
+    if isinstance(a, str):
+        a = a.lower()
+    return a in ('yes', 'on', '1', 'true', 1)
+
+
+def get_hash(data, hashtype='sha1'):
+    import hashlib
+    h = hashlib.new(hashtype)
+    h.update(_text(data).encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def quote(a):
+    import shlex
+    return shlex.quote('' if a is None else _text(a))
+
+
+def regex_escape(string, re_type='python'):
+    import re
+    if re_type != 'python':
+        from ansible.plugins.filter.core import regex_escape
+        return regex_escape(string, re_type)
+    return re.escape(_text(string))
+
+
+def regex_replace(value='', pattern='', replacement='', ignorecase=False, multiline=False,
+                  count=0, mandatory_count=0):
+    import re
+    flags = (re.I if ignorecase else 0) | (re.M if multiline else 0)
+    value = _text(value)
+    output, subs = re.subn(pattern, replacement, value, count=count, flags=flags)
+    if mandatory_count and mandatory_count != subs:
+        raise ValueError("regex_replace: '{}' should match {} times, but matches {} times in '{}'"
+                         .format(pattern, mandatory_count, subs, value))
+    return output
+
+
+def ternary(value, true_val, false_val, none_val=None):
+    if value is None and none_val is not None:
+        return none_val
+    return true_val if value else false_val
+
+
+@_lru_cache()
+def _json_encoder():
+    """A json encoder like ansible's AnsibleJSONEncoder, without importing ansible
+
+    It encodes vault & unsafe values (by their __ENCRYPTED__ & __UNSAFE__
+    markers), mappings like hostvars, and dates.
+    """
+    import datetime
+    import json
+    from collections.abc import Mapping
+
+    class JSONEncoder(json.JSONEncoder):
+
+        def __init__(self, preprocess_unsafe=False, vault_to_text=False, **kw):
+            self._preprocess_unsafe = preprocess_unsafe
+            self._vault_to_text = vault_to_text
+            super().__init__(**kw)
+
+        def default(self, o):
+            if getattr(o, '__ENCRYPTED__', False):
+                if self._vault_to_text:
+                    return _text(o)
+                return {'__ansible_vault': _text(o._ciphertext)}
+            if getattr(o, '__UNSAFE__', False):
+                return {'__ansible_unsafe': _text(o)}
+            if isinstance(o, Mapping):
+                return dict(o)
+            if isinstance(o, (datetime.date, datetime.datetime)):
+                return o.isoformat()
+            return super().default(o)
+
+        def iterencode(self, o, **kw):
+            # Unsafe strings are encoded as plain strings, without calling default
+            if self._preprocess_unsafe:
+                o = _unsafe_encode(o)
+            return super().iterencode(o, **kw)
+
+    return JSONEncoder
+
+
+def _unsafe_encode(value):
+    "Replace the unsafe values in value by their json representation, like ansible"
+    from collections.abc import Mapping, Sequence
+    if getattr(value, '__UNSAFE__', False):
+        return {'__ansible_unsafe': _text(value)}
+    if isinstance(value, Mapping):
+        return {k: _unsafe_encode(v) for k, v in value.items()}
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)) \
+            and not getattr(value, '__ENCRYPTED__', False):
+        return [_unsafe_encode(x) for x in value]
+    return value
+
+
+def to_json(a, *args, **kw):
+    import json
+    kw.setdefault('vault_to_text', True)
+    kw.setdefault('preprocess_unsafe', False)
+    return json.dumps(a, cls=_json_encoder(), *args, **kw)
+
+
+def to_nice_json(a, indent=4, sort_keys=True, *args, **kw):
+    return to_json(a, indent=indent, sort_keys=sort_keys, separators=(',', ': '), *args, **kw)
+
+
+def to_yaml(a, *args, **kw):
+    import yaml
+    kw.setdefault('default_flow_style', None)
+    return yaml.safe_dump(a, *args, allow_unicode=True, **kw)
+
+
+def to_nice_yaml(a, indent=4, *args, **kw):
+    import yaml
+    return yaml.safe_dump(a, *args, indent=indent, allow_unicode=True, default_flow_style=False, **kw)
+
+
+def from_yaml(data):
+    if not isinstance(data, str):
+        return data
+    import yaml
+    return yaml.safe_load(data)
+
+
+# hashtype -> (crypt prefix, salt size, implicit rounds)
+_crypt_methods = {
+    'md5': ('$1$', 8, None),
+    'sha256': ('$5$', 16, 5000),
+    'sha512': ('$6$', 16, 5000),
+}
+_salt_chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789./'
+
+
+def password_hash(password, hashtype='sha512', salt=None, salt_size=None, rounds=None, ident=None):
+    """Like ansible's password_hash filter
+
+    md5, sha256 & sha512 are hashed with the crypt module, when python
+    has it. Other hash types, and ident, are left to ansible.
+    """
+    hashtype = hashtype[:-len('_crypt')] if hashtype.endswith('_crypt') else hashtype
+    try:
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            import crypt
+    except ImportError:  # Removed in python 3.13
+        crypt = None
+    if crypt is None or hashtype not in _crypt_methods or ident is not None:
+        from ansible.plugins.filter.core import get_encrypted_password
+        return get_encrypted_password(password, hashtype, salt, salt_size, rounds, ident)
+
+    prefix, default_size, implicit_rounds = _crypt_methods[hashtype]
+    if salt is None:
+        import secrets
+        salt = ''.join(secrets.choice(_salt_chars) for x in range(salt_size or default_size))
+    if rounds is not None and rounds != implicit_rounds:
+        if implicit_rounds is None:
+            raise ValueError('password_hash: {} does not support rounds'.format(hashtype))
+        prefix += 'rounds={}$'.format(rounds)
+    result = crypt.crypt(_text(password), prefix + salt)
+    if not result or not result.startswith(prefix):
+        raise ValueError('password_hash: crypt does not support {}'.format(hashtype))
+    return result
@@ -0,0 +1,224 @@
+"""isna.history -- A local SQLite database of isna's runs
+
+For every command which runs templates, the Runner records
+    the command: when it started, its mode, return code & duration,
+    its phases: the time spent in each, see isna.util.Timings,
+    its runs: the return code & duration of each template on each host,
+        with a hash of the template's sources & variables,
+    its tasks: the duration of each task on each host.
+'isna stats' summarizes the runs of the last days.
+
+The database is $XDG_DATA_HOME/isna/history.sqlite (or cfg['history_path']).
+A background thread writes the records, a batch per transaction, so
+recording doesn't hold up the run. Records older than cfg['history_ttl']
+seconds are deleted.
+"""
+import os as _os
+
+from isna.config import cfg
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS commands (
+    id INTEGER PRIMARY KEY, time REAL, mode TEXT, returncode INTEGER, seconds REAL);
+CREATE TABLE IF NOT EXISTS phases (
+    command INTEGER, name TEXT, calls INTEGER, seconds REAL);
+CREATE TABLE IF NOT EXISTS runs (
+    command INTEGER, time REAL, template TEXT, key TEXT, host TEXT,
+    returncode INTEGER, seconds REAL);
+CREATE TABLE IF NOT EXISTS tasks (
+    command INTEGER, time REAL, play TEXT, task TEXT, host TEXT, seconds REAL);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (time);
+CREATE INDEX IF NOT EXISTS tasks_time ON tasks (time);
+'''
+
+_inserts = {
+    'runs': 'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+    'tasks': 'INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?)',
+    'phases': 'INSERT INTO phases VALUES (?, ?, ?, ?)',
+}
+
+
+def history_path():
+    "The history database; cfg['history_path'] or history.sqlite under $XDG_DATA_HOME/isna"
+    if cfg['history_path']:
+        return cfg['history_path']
+    data_home = _os.environ.get('XDG_DATA_HOME') or _os.path.expanduser('~/.local/share')
+    return _os.path.join(data_home, 'isna', 'history.sqlite')
+
+
+def connect(path=None):
+    "Open the history database at path (default: history_path()), creating it if needed"
+    import sqlite3
+    path = path if path is not None else history_path()
+    _os.makedirs(_os.path.dirname(_os.path.abspath(path)), mode=0o700, exist_ok=True)
+    db = sqlite3.connect(path, timeout=10)
+    db.executescript(_schema)
+    return db
+
+
+class History:
+    """Record one isna command in the history database
+
+    The record methods only queue their rows; a thread started on the
+    first record writes them. close() waits for the thread to finish.
+    """
+
+    def __init__(self, mode, path=None, ttl=cfg['history_ttl']):
+        import time
+        self.mode = mode
+        self.path = path
+        self.ttl = ttl
+        self.start = time.time()
+        self._queue = None
+        self._thread = None
+        self.error = None
+
+    def _put(self, item):
+        if self._thread is None:
+            import queue
+            import threading
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._write, name='isna-history', daemon=True)
+            self._thread.start()
+        self._queue.put(item)
+
+    def record_run(self, template, key, host, returncode, seconds):
+        "Record a run of template on host. key is the hash of its sources & variables"
+        import time
+        self._put(('runs', [(time.time(), template, key, host, returncode, seconds)]))
+
+    def record_tasks(self, times):
+        "Record the task_time tuples of a run, see isna.playbook.task_times"
+        import time
+        now = time.time()
+        rows = [(now, x.play, x.task, x.host, x.duration) for x in times]
+        if rows:
+            self._put(('tasks', rows))
+
+    def close(self, returncode, phases=None):
+        """Record the end of the command and wait until everything is written
+
+        phases is the phases dict of isna.util.Timings, if the command was timed.
+        Nothing is written for a command which recorded no run.
+        """
+        import time
+        if self._thread is None:
+            return
+        rows = [(name, calls, seconds) for name, (calls, seconds) in (phases or {}).items()]
+        self._put(('phases', rows))
+        self._put(('end', (returncode, time.time() - self.start)))
+        self._put(None)
+        self._thread.join()
+        if self.error is not None:
+            import sys
+            print('isna: could not record the run in {}: {}'.format(self.path or history_path(), self.error),
+                  file=sys.stderr)
+
+    def _write(self):
+        "Write the queued rows, in one transaction for all rows queued at a time"
+        import queue
+        import sqlite3
+        db = None
+        try:
+            db = connect(self.path)
+            with db:
+                if self.ttl:
+                    for table in ('commands', 'runs', 'tasks'):
+                        db.execute('DELETE FROM {} WHERE time < ?'.format(table),
+                                   (self.start - self.ttl,))
+                    db.execute('DELETE FROM phases WHERE command NOT IN (SELECT id FROM commands)')
+                command = db.execute('INSERT INTO commands (time, mode) VALUES (?, ?)',
+                                     (self.start, self.mode)).lastrowid
+        except (OSError, sqlite3.Error) as e:
+            self.error = e
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in batch
+            if self.error is not None:
+                continue  # Only drain the queue
+            try:
+                with db:
+                    for kind, rows in filter(None, batch):
+                        if kind == 'end':
+                            db.execute('UPDATE commands SET returncode = ?, seconds = ? WHERE id = ?',
+                                       rows + (command,))
+                        else:
+                            db.executemany(_inserts[kind], [(command,) + x for x in rows])
+            except sqlite3.Error as e:
+                self.error = e
+        if db is not None:
+            db.close()
+
+
+def percentile(values, p):
+    "The p-th percentile (0 <= p <= 100) of values, by the nearest-rank method"
+    import math
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def trend(values):
+    """The change of the median of the newer half of values, from that of the older half
+
+    values are in chronological order. Returns a str like '+12%', or
+    None if there are fewer than 4 values.
+    """
+    if len(values) < 4:
+        return None
+    half = len(values) // 2
+    old, new = percentile(values[:half], 50), percentile(values[-half:], 50)
+    if not old:
+        return None
+    return '{:+.0%}'.format(new / old - 1)
+
+
+def stats(days=None, path=None, tasks=10):
+    """Summarize the runs of the last days (default: all of them)
+
+    Returns a list of (header, rows) tables: per template, per host, and
+    the tasks with the slowest 95th percentile (at most tasks of them).
+    """
+    import time
+    since = time.time() - days * 24 * 3600 if days else 0
+    db = connect(path)
+    try:
+        runs = db.execute('SELECT template, host, returncode, seconds FROM runs '
+                          'WHERE time >= ? ORDER BY time', (since,)).fetchall()
+        task_rows = db.execute('SELECT play, task, seconds FROM tasks '
+                               'WHERE time >= ? ORDER BY time', (since,)).fetchall()
+    finally:
+        db.close()
+
+    def summarize(groups):
+        rows = []
+        for name, results in sorted(groups.items()):
+            seconds = [x[1] for x in results]
+            failed = sum(1 for x in results if x[0])
+            rows.append((name, len(results), failed, percentile(seconds, 50),
+                         percentile(seconds, 95), trend(seconds)))
+        return rows
+
+    by_template, by_host = {}, {}
+    for template, host, returncode, seconds in runs:
+        by_template.setdefault(template, []).append((returncode, seconds))
+        by_host.setdefault(host, []).append((returncode, seconds))
+    by_task = {}
+    for play, task, seconds in task_rows:
+        by_task.setdefault((play, task), []).append(seconds)
+    slowest = [
+        (play, task, len(seconds), percentile(seconds, 50), percentile(seconds, 95), trend(seconds))
+        for (play, task), seconds in by_task.items()
+    ]
+    slowest.sort(key=lambda x: -x[4])
+    header = ('RUNS', 'FAILED', 'P50', 'P95', 'TREND')
+    return [
+        (('TEMPLATE',) + header, summarize(by_template)),
+        (('HOST',) + header, summarize(by_host)),
+        (('PLAY', 'TASK', 'RUNS', 'P50', 'P95', 'TREND'), slowest[:tasks]),
+    ]
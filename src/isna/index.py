@@ -0,0 +1,237 @@
+"""isna.index -- An on-disk index of playbook templates
+
+The index stores the names & paths of the templates in a set of template
+directories, and the variables of each template (see PBMaker.all_vars).
+It is kept up to date by stat-ing the template directories; only directories
+whose mtime changed are listed again. Variables are looked up again once
+the template, or any template it references, has changed.
+
+On a warm cache 'isna ls temp', 'isna ls vars' and the validation of
+TEMPLATE arguments are answered without jinja.
+"""
+import os as _os
+
+from isna.config import cfg
+
+
+class TemplateIndex:
+    version = 1
+    touch_interval = 24 * 3600
+
+    def __init__(self, *templ_dirs, path=None, ttl=cfg['index_ttl']):
+        """Create an index for templ_dirs (see isna.playbook.get_loader)
+
+        path is the json file storing the index. By default it is in isna's
+        cache directory and specific to the set of template directories.
+        The indexes in the cache directory which weren't used for ttl
+        seconds are deleted when an index is saved.
+        """
+        self.templ_dirs = templ_dirs
+        self._path = path
+        self.ttl = ttl
+        self._dirty = False
+
+    @property
+    def roots(self):
+        """The filesystem directory of each template dir
+
+        A template dir which isn't a directory on the filesystem
+        (e.g., a package in a zip file) is None.
+        """
+        try:
+            return self._roots
+        except AttributeError:
+            self._roots = [self._root(x) for x in self.templ_dirs]
+            return self._roots
+
+    @staticmethod
+    def _root(templ_dir):
+        if isinstance(templ_dir, str):
+            return _os.path.abspath(templ_dir)
+        import importlib.util
+        package, folder = templ_dir
+        spec = importlib.util.find_spec(package)
+        locations = spec.submodule_search_locations if spec is not None else None
+        if not locations:
+            return None
+        path = _os.path.join(locations[0], folder)
+        return path if _os.path.isdir(path) else None
+
+    @property
+    def usable(self):
+        "True if all template dirs can be indexed"
+        return all(x is not None for x in self.roots)
+
+    @property
+    def path(self):
+        if self._path is None:
+            import hashlib
+            import json
+            from isna.util import cache_dir
+            key = hashlib.sha1(json.dumps(self.roots).encode()).hexdigest()
+            self._path = cache_dir('templates-{}.json'.format(key[:16]))
+        return self._path
+
+    @property
+    def data(self):
+        try:
+            return self._data
+        except AttributeError:
+            import json
+            from time import time
+            try:
+                with open(self.path) as fin:
+                    data = json.load(fin)
+                    # Written again by save(), so indexes in use aren't pruned
+                    self._dirty = time() - _os.fstat(fin.fileno()).st_mtime > self.touch_interval
+            except (OSError, ValueError):
+                data = {}
+            if data.get('version') != self.version:
+                data = {'version': self.version, 'dirs': {}, 'vars': {}}
+            self._data = data
+            return self._data
+
+    def save(self):
+        if self._dirty:
+            import json
+            from isna.util import write_atomic
+            write_atomic(self.path, json.dumps(self.data))
+            self._dirty = False
+            self.prune()
+
+    def prune(self):
+        "Delete the indexes in the cache directory which weren't used for ttl seconds"
+        import glob
+        from time import time
+        from isna.util import cache_dir
+        expired = time() - self.ttl
+        for path in glob.glob(cache_dir('templates-*.json')):
+            try:
+                if path != self.path and _os.stat(path).st_mtime < expired:
+                    _os.unlink(path)
+            except OSError:
+                pass
+
+    @property
+    def templates(self):
+        "Dict of template name -> path. The first template dir containing a name wins"
+        try:
+            return self._templates
+        except AttributeError:
+            self._templates = self.refresh()
+            return self._templates
+
+    def refresh(self):
+        """Update the index from the template directories and return the templates
+
+        Every directory is stat-ed, but only those which changed are listed.
+        """
+        dirs = self.data['dirs']
+        seen = set()
+        templates = {}
+        for root in self.roots:
+            for path, name in self._walk(root, dirs, seen):
+                templates.setdefault(name, path)
+        for path in set(dirs) - seen:
+            del dirs[path]
+            self._dirty = True
+        self.save()
+        return templates
+
+    def _walk(self, root, dirs, seen):
+        "Yield (path, name) of all files below root"
+        visited = set()
+        todo = [(root, '')]
+        while todo:
+            path, prefix = todo.pop()
+            try:
+                st = _os.stat(path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in visited:  # Symlink loop
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            seen.add(path)
+            entry = dirs.get(path)
+            if entry is None or entry['mtime'] != st.st_mtime:
+                entry = self._scan(path, st.st_mtime)
+                dirs[path] = entry
+                self._dirty = True
+            for fname in entry['files']:
+                yield _os.path.join(path, fname), prefix + fname
+            for dname in reversed(entry['subdirs']):
+                todo.append((_os.path.join(path, dname), prefix + dname + '/'))
+
+    @staticmethod
+    def _scan(path, mtime):
+        files, subdirs = [], []
+        for x in _os.scandir(path):
+            try:
+                (subdirs if x.is_dir() else files).append(x.name)
+            except OSError:
+                pass
+        return {'mtime': mtime, 'files': sorted(files), 'subdirs': sorted(subdirs)}
+
+    @property
+    def pbmaker(self):
+        try:
+            return self._pbmaker
+        except AttributeError:
+            from isna.playbook import PBMaker
+            self._pbmaker = PBMaker.shared(*self.templ_dirs)
+            return self._pbmaker
+
+    @staticmethod
+    def _has_ext(name, extensions):
+        return '.' in name and name.rsplit('.', 1)[1] in extensions
+
+    def names(self, extensions=None):
+        "Return the sorted template names, like jinja's Environment.list_templates"
+        if not self.usable:
+            return self.pbmaker.list_templates(extensions)
+        names = sorted(self.templates)
+        if extensions is not None:
+            names = [x for x in names if self._has_ext(x, extensions)]
+        return names
+
+    def is_template(self, name, extensions=cfg['templ_ext']):
+        "True if name is a template with one of the extensions"
+        if not self.usable:
+            return name in self.names(extensions)
+        return name in self.templates and self._has_ext(name, extensions)
+
+    def variables(self, name):
+        "Return the variables of template name, see PBMaker.all_vars"
+        if not self.usable:
+            return self.pbmaker.all_vars(name)
+        entry = self.data['vars'].get(name)
+        if entry is not None and self._is_current(name, entry):
+            return set(entry['vars'])
+
+        pbm = self.pbmaker
+        variables = pbm.all_vars(name)
+        deps = {}
+        for dep in pbm.dependencies(name):
+            path = self.templates.get(dep)
+            if path is not None:
+                deps[path] = _os.stat(path).st_mtime
+        self.data['vars'][name] = {
+            'path': self.templates.get(name),
+            'deps': deps,
+            'vars': sorted(variables),
+        }
+        self._dirty = True
+        self.save()
+        return variables
+
+    def _is_current(self, name, entry):
+        "True if the template & the templates it references are unchanged"
+        if entry['path'] != self.templates.get(name):
+            return False
+        for path, mtime in entry['deps'].items():
+            try:
+                if _os.stat(path).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
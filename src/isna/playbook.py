@@ -1,21 +1,110 @@
 from collections import (
     ChainMap as _ChainMap,
-    Iterable as _Iterable,
     UserDict as _UserDict,
 )
+from collections.abc import Iterable as _Iterable
+from contextlib import contextmanager as _contextmanager
+from collections import namedtuple as _namedtuple
+import os as _os
+import sys as _sys
+import threading as _threading
 from isna.config import cfg
+from isna.util import timed as _timed
+
+
+_callback_dir = _os.path.join(_os.path.dirname(__file__), 'ansible_plugins', 'callback')
+
+
+_default_callback_plugins = '~/.ansible/plugins/callback:/usr/share/ansible/plugins/callback'
+
+
+def _ansible_cfg(env):
+    "The path of the ansible.cfg which ansible-playbook reads in env, or None"
+    candidates = [env.get('ANSIBLE_CONFIG'), 'ansible.cfg', '~/.ansible.cfg', '/etc/ansible/ansible.cfg']
+    for path in filter(None, candidates):
+        path = _os.path.expanduser(path)
+        if _os.path.isdir(path):
+            path = _os.path.join(path, 'ansible.cfg')
+        if _os.path.isfile(path):
+            return _os.path.abspath(path)
+    return None
+
+
+def _callback_plugins(env):
+    """The callback plugin path for ansible-playbook in env: isna's callback dir first
+
+    The rest is the path which ansible would use itself: $ANSIBLE_CALLBACK_PLUGINS,
+    or else callback_plugins of ansible.cfg, or else ansible's default path.
+    """
+    path = env.get('ANSIBLE_CALLBACK_PLUGINS')
+    cfg_path = None if path else _ansible_cfg(env)
+    if cfg_path is not None:
+        import configparser
+        parser = configparser.ConfigParser(inline_comment_prefixes=(';',), interpolation=None)
+        try:
+            parser.read(cfg_path)
+            path = parser.get('defaults', 'callback_plugins', fallback=None)
+        except configparser.Error:
+            path = None
+        if path:
+            # Like ansible, relative paths in ansible.cfg are relative to its directory
+            base = _os.path.dirname(cfg_path)
+            path = _os.pathsep.join(
+                _os.path.join(base, _os.path.expanduser(x)) for x in path.split(_os.pathsep) if x
+            )
+    return _os.pathsep.join([_callback_dir, path or _default_callback_plugins])
 
 
 def _ansible_filters():
-    """Load and return some jinja2 filters that are shipped with ansible.
+    """Load and return the jinja2 filters that are shipped with ansible.
 
-    This is only called when one of these filters appears in a playbook template.
-    This is the only place ansible code is imported.
+    This is only called when a playbook template uses a filter which
+    isna.filters doesn't provide.
     """
     from ansible.plugins.filter.core import FilterModule
     return FilterModule().filters()
 
 
+class _Filters(dict):
+    """Jinja filters which fall back to the filters of isna.filters, then ansible
+
+    A filter of isna.filters is loaded when a template uses it (see require),
+    or when it's looked up at render time: templates loaded from the bytecode
+    cache are not compiled again. All of ansible's filters are only loaded
+    for a filter which isna.filters doesn't provide.
+    """
+    _ansible_loaded = False
+
+    def __missing__(self, key):
+        from isna import filters
+        if key in filters.registry:
+            self[key] = filters.load(key)
+        elif not self._ansible_loaded:
+            self._ansible_loaded = True
+            for name, func in _ansible_filters().items():
+                self.setdefault(name, func)
+        return dict.__getitem__(self, key)
+
+    def require(self, names):
+        """Load the filters names, which a template uses, before it is compiled
+
+        The jinja compiler checks for filters with 'in', which doesn't load them.
+        Unknown names are left for the compiler to report.
+        """
+        for name in names:
+            if name not in self:
+                try:
+                    self[name]
+                except KeyError:
+                    pass
+
+
+def _filter_names(ast):
+    "Return the names of the filters used in the template ast"
+    from jinja2 import nodes
+    return {x.name for x in ast.find_all(nodes.Filter)}
+
+
 def get_loader(*templ_dirs):
     """Get a jinja loader which searches in templ_dirs
 
@@ -36,14 +125,34 @@ def get_loader(*templ_dirs):
     return ChoiceLoader(loaders)
 
 
-def get_env(*templ_dirs):
+def get_bytecode_cache():
+    """Get a jinja bytecode cache which stores compiled templates on disk
+
+    The cache directory is specific to the isna and jinja versions.
+    Jinja checks the template source's hash before using a cached template.
+    """
+    import jinja2
+    from jinja2 import FileSystemBytecodeCache
+    from isna import __version__
+    from isna.util import cache_dir
+    name = 'jinja-{}-{}'.format(__version__, jinja2.__version__)
+    path = cache_dir(name)
+    _os.makedirs(path, mode=0o700, exist_ok=True)
+    return FileSystemBytecodeCache(path)
+
+
+def get_env(*templ_dirs, bytecode_cache=None):
     """Get a jinja environment with loaders from templ_dirs
 
     Each templ_dir can either be a
         directory path as a string     (e.g., '/path/to/templates')
         or a list-like object of len 2 (e.g, ['pymodule_name', 'template_folder'])
+    Compiled templates are cached on disk if bytecode_cache is true
+    (default: cfg['bytecode_cache']).
     """
     from jinja2 import Environment, StrictUndefined
+    if bytecode_cache is None:
+        bytecode_cache = cfg['bytecode_cache']
     jenv = Environment(
         loader=get_loader(*templ_dirs),
         block_start_string='<@@',
@@ -53,23 +162,207 @@ def get_env(*templ_dirs):
         comment_start_string='<#',
         comment_end_string='#>',
         undefined=StrictUndefined,
+        bytecode_cache=get_bytecode_cache() if bytecode_cache else None,
     )
+    jenv.filters = _Filters(jenv.filters)
     return jenv
 
 
-def get_undefined(template):
-    "Given a jinja2 template object return the template's variables"
-    from jinja2 import meta
-    env = template.environment
-    template_str = env.loader.get_source(env, template.name)[0]
-    parsed_content = env.parse(template_str)
-    return meta.find_undeclared_variables(parsed_content)
+def merge_playbooks(playbooks, variables=None):
+    """Merge rendered playbooks into a single multi-play playbook
+
+    playbooks is an iterable of (name, playbook_str) pairs.
+    variables is an optional list of dicts, one for each playbook, which
+    are added to the vars of each of its plays (overriding them).
+    Returns a tuple (playbook_str, names) where names gives the name
+    of the playbook which each of the merged plays came from.
+
+    The plays of the playbooks are concatenated as text, so ansible's own
+    yaml tags (like !vault or !unsafe) and the formatting are kept. The
+    yaml is only composed into nodes, never loaded, to count the plays. A
+    playbook which gets variables (or isn't a block list of plays) is
+    written out again from its nodes.
+    """
+    import yaml
+    from itertools import repeat
+    parts, names = [], []
+    for (name, playbook_str), pvars in zip(playbooks, variables or repeat(None)):
+        node = yaml.compose(playbook_str, Loader=yaml.SafeLoader)
+        if node is None:
+            continue
+        if isinstance(node, yaml.SequenceNode) and not pvars and not node.flow_style \
+                and node.start_mark.column == 0 and '%' not in playbook_str[:node.start_mark.index]:
+            txt = playbook_str[node.start_mark.index:node.end_mark.index]
+            parts.append(txt if txt.endswith('\n') else txt + '\n')
+        else:
+            if not isinstance(node, yaml.SequenceNode):  # A single play
+                node = yaml.SequenceNode('tag:yaml.org,2002:seq', [node])
+            node.flow_style = False
+            for play in node.value:
+                _add_play_vars(play, pvars or {})
+            parts.append(yaml.serialize(node, Dumper=yaml.SafeDumper, allow_unicode=True))
+        names.extend(name for x in node.value)
+    return '---\n' + ''.join(parts), names
+
+
+def _add_play_vars(play, pvars):
+    "Add the variables pvars to the vars of play, a yaml MappingNode, overriding them"
+    import yaml
+    if not pvars or not isinstance(play, yaml.MappingNode):
+        return
+    represent = yaml.representer.SafeRepresenter(sort_keys=False).represent_data
+    added = represent(pvars)
+    for i, (key, value) in enumerate(play.value):
+        if isinstance(key, yaml.ScalarNode) and key.value == 'vars':
+            if isinstance(value, yaml.MappingNode):
+                kept = [x for x in value.value
+                        if not (isinstance(x[0], yaml.ScalarNode) and x[0].value in pvars)]
+                added.value[:0] = kept
+            play.value[i] = (key, added)
+            return
+    play.value.append((represent('vars'), added))
+
+
+play_result = _namedtuple('play_result', 'template play returncode duration')
+task_time = _namedtuple('task_time', 'play task host duration')
+
+
+class run_event(_namedtuple('run_event', 'kind play task host time duration text')):
+    """An event of an ansible-playbook run, see AnsiblePlaybook.stream
+
+    kind is one of play_start, task_start, start, stats, output or one of
+    the task results in run_event.results. start is sent when a task starts
+    on a host; the result for that host has the task's duration (in seconds).
+    output events hold a line of ansible's own output in text, failed and
+    unreachable results ansible's message.
+    """
+    __slots__ = ()
+    results = ('ok', 'changed', 'failed', 'ignored', 'skipped', 'unreachable')
+
+    @classmethod
+    def from_dict(cls, d):
+        "Create a run_event from a json object written by the isna_report callback"
+        fields = dict.fromkeys(cls._fields)
+        fields.update((k, v) for k, v in d.items() if k in fields)
+        fields['kind'] = d['event']
+        return cls(**fields)
+
+
+def _run_events(events):
+    "Events as run_event tuples; events may also be dicts as returned by AnsiblePlaybook.report"
+    for ev in events:
+        yield ev if isinstance(ev, run_event) else run_event.from_dict(ev)
+
+
+def _returncode(statuses):
+    "Map the task statuses seen in a play to an ansible-playbook style exit code"
+    if 'unreachable' in statuses:
+        return 4
+    if 'failed' in statuses:
+        return 2
+    if statuses:
+        return 0
+    return None
+
+
+def play_results(events, templates=None):
+    """Summarize the events written by the isna_report callback per play
+
+    templates is an optional list giving the name of the template which
+    each play came from (e.g., from merge_playbooks).
+    Returns a list of play_result tuples. A play in which no task ran
+    has a returncode of None.
+    """
+    plays = []
+    for ev in _run_events(events):
+        if ev.kind == 'play_start':
+            plays.append(dict(play=ev.play, start=ev.time, end=ev.time, statuses=set()))
+        elif plays and ev.kind != 'output':
+            plays[-1]['end'] = ev.time
+            if ev.kind in run_event.results:
+                plays[-1]['statuses'].add(ev.kind)
+    if templates is None:
+        templates = [None] * len(plays)
+    return [
+        play_result(templ, x['play'], _returncode(x['statuses']), x['end'] - x['start'])
+        for templ, x in zip(templates, plays)
+    ]
+
+
+def template_results(results):
+    """Sum up play_results per template
+
+    Returns a dict template -> (returncode, duration), where returncode is
+    the largest of the template's plays (None if no task ran in any of them).
+    """
+    templates = {}
+    for res in results:
+        returncode, duration = templates.get(res.template, (None, 0.0))
+        if res.returncode is not None:
+            returncode = max(returncode or 0, res.returncode)
+        templates[res.template] = (returncode, duration + res.duration)
+    return templates
+
+
+def host_results(events):
+    """Count the task results in the events of the isna_report callback per host
+
+    Returns a dict like {host: {'ok': 3, 'changed': 1, ...}}
+    """
+    hosts = {}
+    for ev in _run_events(events):
+        if ev.host is None or ev.kind not in run_event.results:
+            continue
+        counts = hosts.setdefault(ev.host, {})
+        counts[ev.kind] = counts.get(ev.kind, 0) + 1
+    return hosts
+
+
+_become_errors = (
+    'sudo password',
+    'become password',
+    'a password is required',
+    'privilege escalation',
+)
+
+
+def become_failures(events):
+    """The hosts on which a task failed because become (sudo) needed a password
+
+    events are the events of the isna_report callback.
+    """
+    hosts = set()
+    for ev in _run_events(events):
+        if ev.kind == 'failed' and ev.text and any(x in ev.text.lower() for x in _become_errors):
+            hosts.add(ev.host)
+    return hosts
+
+
+def task_times(events):
+    """The duration of each task on each host in the events of the isna_report callback
+
+    Returns a list of task_time tuples, the slowest first.
+    """
+    times = []
+    play = None
+    for ev in _run_events(events):
+        if ev.kind == 'play_start':
+            play = ev.play
+        elif ev.kind in run_event.results and ev.duration is not None:
+            times.append(task_time(play, ev.task, ev.host, ev.duration))
+    times.sort(key=lambda x: -x.duration)
+    return times
 
 
 class AnsibleArgs(_UserDict):
 
     @classmethod
-    def from_ssh(cls, user=None, host=None, port=None):
+    def from_ssh(cls, user=None, host=None, port=None, control=None):
+        """Ansible variables for connecting as user to host:port
+
+        control is an optional isna.util.SSHControl whose master
+        connections ansible should reuse.
+        """
         d = {}
         if host is None:
             d['ansible_connection'] = 'local'
@@ -82,6 +375,8 @@ class AnsibleArgs(_UserDict):
             port = cfg['default_ssh_port']
         d['ansible_user'] = user
         d['ansible_port'] = port
+        if control is not None:
+            d['ansible_ssh_common_args'] = control.ansible_args()
         return cls(d)
 
     @classmethod
@@ -96,33 +391,100 @@ class AnsibleArgs(_UserDict):
         return cls(d)
 
 
+template_info = _namedtuple('template_info', 'template ast variables references assigned')
+
+
+def _assigned_names(ast):
+    """Return the names which a template assigns to
+
+    These are the targets of set & for statements, macro names and
+    the names bound by imports.
+    """
+    from jinja2 import nodes
+    names = {x.name for x in ast.find_all(nodes.Name) if x.ctx in ('store', 'param')}
+    names.update(x.name for x in ast.find_all(nodes.Macro))
+    names.update(x.target for x in ast.find_all(nodes.Import))
+    for x in ast.find_all(nodes.FromImport):
+        names.update(y if isinstance(y, str) else y[1] for y in x.names)
+    return names
+
+
 class PBMaker(_UserDict):
+    _shared = {}
 
     def __init__(self, *templ_dirs, **kwargs):
         super().__init__(kwargs)
         self.templ_dirs = templ_dirs
         self._templates = {}
+        self._all_vars = {}
+
+    @classmethod
+    def shared(cls, *templ_dirs, **kwargs):
+        """Return a PBMaker which shares its jinja environment & parsed templates
+
+        All PBMakers made by shared() for the same templ_dirs share them,
+        so a long-lived process (see isna.server) parses each template only
+        once. Templates are parsed again once they change.
+        The variables (the dict) of each PBMaker are its own.
+        """
+        pbm = cls(*templ_dirs, **kwargs)
+        key = tuple(templ_dirs)
+        try:
+            pbm._environment, pbm._templates = cls._shared[key]
+        except KeyError:
+            cls._shared[key] = pbm.environment, pbm._templates
+        return pbm
 
     @property
     def environment(self):
         try:
             return self._environment
         except AttributeError:
-            self._environment = get_env(*self.templ_dirs)
+            with _timed('environment'):
+                self._environment = get_env(*self.templ_dirs)
             return self._environment
 
+    def template_info(self, name):
+        """Return the template_info of template name
+
+        The template's source is parsed only once. The resulting AST is used
+        to find the template's undeclared variables, the templates it
+        references (include, import & extends), the names it assigns to,
+        and to compile it, unless the compiled template is found in
+        the bytecode cache.
+        """
+        info = self._templates.get(name)
+        if info is not None and info.template.is_up_to_date:
+            return info
+        from jinja2 import meta
+        env = self.environment
+        with _timed('parse'):
+            source, filename, uptodate = env.loader.get_source(env, name)
+            ast = env.parse(source, name, filename)
+            env.filters.require(_filter_names(ast))
+            variables = frozenset(meta.find_undeclared_variables(ast))
+            references = meta.find_referenced_templates(ast)
+            references = tuple(dict.fromkeys(x for x in references if x is not None))
+            assigned = frozenset(_assigned_names(ast))
+
+        with _timed('compile'):
+            bcc = env.bytecode_cache
+            code = None
+            if bcc is not None:
+                bucket = bcc.get_bucket(env, name, filename, source)
+                code = bucket.code
+            if code is None:
+                code = env.compile(ast, name, filename)
+                if bcc is not None:
+                    bucket.code = code
+                    bcc.set_bucket(bucket)
+            templ = env.template_class.from_code(env, code, env.make_globals(None), uptodate)
+        info = template_info(templ, ast, variables, references, assigned)
+        self._templates[name] = info
+        return info
+
     def get_template(self, name):
-        templ = self._templates.get(name, False)
-        if templ:
-            return templ
-        from jinja2.exceptions import TemplateAssertionError
-        try:
-            templ = self.environment.get_template(name)
-        except TemplateAssertionError:  # Load ansible filters
-            self.environment.filters.update(_ansible_filters())
-            templ = self.environment.get_template(name)
-        self._templates[name] = templ
-        return templ
+        return self.template_info(name).template
 
     def list_templates(self, extensions=None, filter_func=None):
         return self.environment.list_templates(
@@ -130,8 +492,68 @@ class PBMaker(_UserDict):
             filter_func=filter_func,
         )
 
+    def dependencies(self, templ_name):
+        """Return templ_name and all templates it references, directly or indirectly
+
+        Referenced templates which can't be found are left out.
+        Dynamically chosen templates (e.g., include some_var) aren't known.
+        """
+        from jinja2.exceptions import TemplateNotFound
+        seen, todo = [], [templ_name]
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            try:
+                info = self.template_info(name)
+            except TemplateNotFound:
+                if name == templ_name:
+                    raise
+                continue
+            seen.append(name)
+            todo.extend(reversed(info.references))
+        return seen
+
+    def source_hash(self, templ_name):
+        "Return a sha256 hex digest of the sources of templ_name and the templates it references"
+        import hashlib
+        env = self.environment
+        digest = hashlib.sha256()
+        for name in sorted(self.dependencies(templ_name)):
+            source = env.loader.get_source(env, name)[0]
+            digest.update(name.encode() + b'\0' + source.encode() + b'\0')
+        return digest.hexdigest()
+
     def all_vars(self, templ_name):
-        return get_undefined(self.get_template(templ_name))
+        """Return the variables needed by templ_name and the templates it references
+
+        The variables of a referenced template are those it needs, minus
+        the names which the referencing template assigns to.
+        The result for each template is cached, so shared templates
+        are only analysed once.
+        """
+        return set(self._template_vars(templ_name, ()))
+
+    def _template_vars(self, name, parents):
+        try:
+            return self._all_vars[name]
+        except KeyError:
+            pass
+        from jinja2.exceptions import TemplateNotFound
+        try:
+            info = self.template_info(name)
+        except TemplateNotFound:
+            if not parents:
+                raise
+            return frozenset()
+        parents = parents + (name,)
+        needed = set()
+        for ref in info.references:
+            if ref not in parents:  # Skip recursive references
+                needed.update(self._template_vars(ref, parents))
+        variables = frozenset(info.variables | (needed - info.assigned))
+        self._all_vars[name] = variables
+        return variables
 
     def undef_vars(self, templ_name, **kwargs):
         all_vars = self.all_vars(templ_name)
@@ -148,7 +570,8 @@ class PBMaker(_UserDict):
         cm = _ChainMap(kwargs, self.data)
         newd = {k: v for k, v in cm.items()}
         templ = self.get_template(name)
-        return templ.render(**newd)
+        with _timed('render'):
+            return templ.render(**newd)
 
     def __repr__(self):
         reprdict = super().__repr__()
@@ -162,13 +585,35 @@ class PBMaker(_UserDict):
         return main
 
 
+def _tmpfs_dir():
+    "A directory in memory for temporary files, or None to use the tempfile module's default"
+    for dirname in (_os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm'):
+        if dirname and _os.path.isdir(dirname) and _os.access(dirname, _os.W_OK | _os.X_OK):
+            return dirname
+    return None
+
+
 class AnsiblePlaybook:
     """AnsiblePlaybook is context manager for running playbooks
 
     For example:
         with AnsiblePlaybook(...) as pb:
             output = pb.run()
+
+    The playbook, the extra vars and the report are temporary files, which
+    are kept according to storage (None means cfg['temp_storage']):
+      'disk'  - the default directory of the tempfile module
+      'tmpfs' - $XDG_RUNTIME_DIR or /dev/shm, which are in memory
+      'memfd' - anonymous files in memory (see os.memfd_create), which
+                ansible-playbook opens as /dev/fd/N. They never have
+                a name on any filesystem. Falls back to 'tmpfs' where
+                memfd_create is missing. ansible-playbook resolves the
+                path of the extra vars file with realpath, which fails
+                for a memfd, so that file is kept on 'tmpfs' instead.
+    Either way, the files are gone once the context manager exits.
     """
+    storage = None
+    memfd_extra_vars = False
 
     def __init__(self, playbook_str, host_list, **extra_vars):
         import tempfile
@@ -182,41 +627,474 @@ class AnsiblePlaybook:
         self.extra_vars = {}
         self.extra_vars.update(cfg['common_ansi_vars'])
         self.extra_vars.update(extra_vars)
+        self.options = []  # Additional options for ansible-playbook, e.g., --check
 
-    def get_tempfile(self, towrite, mode='w+t', suffix=None, prefix='isna'):
-        """Create a named temporary file from the string towrite
-
+    def get_tempfile(self, towrite, mode='w+t', suffix=None, prefix='isna', storage=None):
+        """Create a temporary file from the string towrite
 
-        It returns a handle to the file object.
+        It returns a handle to the file object; see tempfile_path for its path.
 
         The file is named prefix**suffix, and should have no rwx permissions for group
-        or others.
+        or others. It is kept on storage, which defaults to self.storage.
         [On my system tempfile.NamedTemporaryFile implicitly sets the permissions
         for group and others to zero. If this isn't always true we'll
         have to come up with another solution]
         """
-        ntf = self._tempfile.NamedTemporaryFile
-        tf = ntf(mode='w+t', prefix=prefix, suffix=suffix)
+        storage = storage or self.storage or cfg['temp_storage']
+        if storage == 'memfd' and hasattr(_os, 'memfd_create'):
+            tf = open(_os.memfd_create(prefix + (suffix or '')), mode)
+        else:
+            dirname = _tmpfs_dir() if storage in ('tmpfs', 'memfd') else None
+            ntf = self._tempfile.NamedTemporaryFile
+            tf = ntf(mode=mode, prefix=prefix, suffix=suffix, dir=dirname)
         tf.write(towrite)
         tf.seek(0)
         return tf
 
+    @staticmethod
+    def tempfile_path(tf):
+        "The path of a file from get_tempfile"
+        if isinstance(tf.name, int):  # memfd
+            return '/dev/fd/{}'.format(tf.name)
+        return tf.name
+
+    @property
+    def pass_fds(self):
+        "File descriptors which ansible-playbook needs to inherit"
+        tfs = (self.temp_playbook, self.temp_extra_vars, self.temp_report)
+        return tuple(x.name for x in tfs if isinstance(x.name, int))
+
     def __enter__(self):
-        self.temp_playbook = self.get_tempfile(self.playbook_str, suffix='.yml')
-        self.temp_extra_vars = self.get_tempfile(
-            self._json.dumps(self.extra_vars),
-            suffix='.json',
-        )
+        with _timed('write'):
+            self.temp_playbook = self.get_tempfile(self.playbook_str, suffix='.yml')
+            storage = self.storage or cfg['temp_storage']
+            if storage == 'memfd' and not self.memfd_extra_vars:
+                storage = 'tmpfs'
+            self.temp_extra_vars = self.get_tempfile(
+                self._json.dumps(self.extra_vars),
+                suffix='.json',
+                storage=storage,
+            )
+            self.temp_report = self.get_tempfile('', suffix='.jsonl')
         return self
 
     def __exit__(self, *args):
         self.temp_playbook.close()
         self.temp_extra_vars.close()
+        self.temp_report.close()
 
-    def run(self):
-        from subprocess import run, DEVNULL
-        cmd = ['ansible-playbook', self.temp_playbook.name]
+    @property
+    def environment(self):
+        """Environment for ansible-playbook
+
+        It enables the isna_report callback plugin, which records
+        the results of the run in self.temp_report
+        """
+        env = dict(_os.environ)
+        env['ANSIBLE_CALLBACK_PLUGINS'] = _callback_plugins(env)
+        env['ISNA_REPORT_FILE'] = self.tempfile_path(self.temp_report)
+        return env
+
+    @property
+    def command(self):
+        "The ansible-playbook command line"
+        cmd = ['ansible-playbook', self.tempfile_path(self.temp_playbook)]
         inv = ['-i', ','.join(self.host_list) + ',']
-        extra = ['-e', '@' + self.temp_extra_vars.name]
-        cmd = cmd + inv + extra
-        return run(cmd, stdin=DEVNULL)
+        extra = ['-e', '@' + self.tempfile_path(self.temp_extra_vars)]
+        return cmd + inv + extra + list(self.options)
+
+    def run(self, capture=False):
+        """Run ansible-playbook and return the CompletedProcess
+
+        If capture is true, stdout & stderr of ansible-playbook are
+        returned as a single string in the stdout attribute.
+        """
+        from subprocess import run, DEVNULL, PIPE, STDOUT
+        cmd = self.command
+        with _timed('ansible'):
+            if capture:
+                return run(cmd, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, pass_fds=self.pass_fds,
+                           universal_newlines=True, env=self.environment)
+            return run(cmd, stdin=DEVNULL, env=self.environment, pass_fds=self.pass_fds)
+
+    def stream(self, capture=False):
+        """Run ansible-playbook and yield a run_event for each event as it happens
+
+        The isna_report callback writes its events to a pipe, which is read
+        line by line while ansible runs. If capture is true, the output of
+        ansible-playbook is read as well, and each line is yielded as an
+        'output' event; otherwise ansible writes to the terminal as usual.
+
+        Once the generator is exhausted the exit code of ansible-playbook
+        is in self.returncode. If the generator is closed early,
+        ansible-playbook is terminated.
+        """
+        from subprocess import Popen, DEVNULL, PIPE, STDOUT
+        self.returncode = None
+        rfd, wfd = _os.pipe()
+        env = self.environment
+        env['ISNA_REPORT_FD'] = str(wfd)
+        out = dict(stdout=PIPE, stderr=STDOUT) if capture else {}
+        with _timed('ansible'):
+            try:
+                proc = Popen(self.command, stdin=DEVNULL, env=env,
+                             pass_fds=(wfd,) + self.pass_fds, **out)
+            except BaseException:
+                _os.close(rfd)
+                raise
+            finally:
+                _os.close(wfd)
+
+            fds = {'report': rfd}
+            if capture:
+                fds['output'] = proc.stdout.fileno()
+            try:
+                yield from self._read_events(fds)
+                self.returncode = proc.wait()
+            finally:
+                _os.close(rfd)
+                if proc.stdout is not None:
+                    proc.stdout.close()
+                if proc.poll() is None:
+                    proc.terminate()
+                    proc.wait()
+
+    def _read_events(self, fds):
+        """Read lines from the file descriptors in fds until all are at EOF
+
+        fds is a dict like {'report': fd, 'output': fd}. Yields a run_event
+        for each line.
+        """
+        import selectors
+        buffers = dict.fromkeys(fds, b'')
+        with selectors.DefaultSelector() as sel:
+            for name, fd in fds.items():
+                sel.register(fd, selectors.EVENT_READ, name)
+            while sel.get_map():
+                for key, _ in sel.select():
+                    name = key.data
+                    chunk = _os.read(key.fd, 65536)
+                    if not chunk:
+                        sel.unregister(key.fd)
+                        lines, buffers[name] = [buffers[name]], b''
+                    else:
+                        *lines, buffers[name] = (buffers[name] + chunk).split(b'\n')
+                    for line in lines:
+                        if line:
+                            yield self._event(name, line)
+
+    def _event(self, name, line):
+        line = line.decode(errors='replace')
+        if name == 'output':
+            return run_event('output', None, None, None, None, None, line)
+        return run_event.from_dict(self._json.loads(line))
+
+    def report(self):
+        """Return the events recorded by the isna_report callback during run()
+
+        The events are dicts; see run_event for the typed events of stream().
+        """
+        self.temp_report.seek(0)
+        return [self._json.loads(line) for line in self.temp_report if line.strip()]
+
+
+@_contextmanager
+def _environ(env):
+    "Context manager setting the variables in env in os.environ"
+    saved = {k: _os.environ.get(k) for k in env}
+    _os.environ.update(env)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                _os.environ.pop(k, None)
+            else:
+                _os.environ[k] = v
+
+
+def _drain(fds):
+    "Read & discard everything from the file descriptors fds until they are at EOF"
+    import selectors
+    with selectors.DefaultSelector() as sel:
+        for fd in fds:
+            sel.register(fd, selectors.EVENT_READ)
+        while sel.get_map():
+            for key, _ in sel.select():
+                if not _os.read(key.fd, 65536):
+                    sel.unregister(key.fd)
+
+
+class InProcessPlaybook(AnsiblePlaybook):
+    """AnsiblePlaybook which runs playbooks with ansible's python API
+
+    Instead of starting ansible-playbook, the playbook is run by ansible's
+    PlaybookExecutor in this process. Ansible is imported once, and the
+    DataLoader & the inventory of each host list are kept for later runs,
+    so a long-lived process pays for ansible's startup only once.
+
+    Ansible keeps global state (its command line options, sys.stdout and
+    the environment of the callback plugin), so runs are serialized.
+    """
+    memfd_extra_vars = True
+    _lock = _threading.Lock()
+    _loader = None
+    _inventories = {}
+
+    @classmethod
+    def get_loader(cls):
+        "The shared ansible DataLoader"
+        if cls._loader is None:
+            from ansible.parsing.dataloader import DataLoader
+            from ansible.plugins import loader
+            from ansible.utils.collection_loader import AnsibleCollectionConfig
+            if not AnsibleCollectionConfig.collection_finder:
+                # ansible >= 2.15 installs its collection loader only in CLI.run
+                init_plugin_loader = getattr(loader, 'init_plugin_loader', None)
+                if init_plugin_loader is not None:
+                    init_plugin_loader()
+            loader.callback_loader.add_directory(_callback_dir)
+            cls._loader = DataLoader()
+        return cls._loader
+
+    @classmethod
+    def get_inventory(cls, host_list):
+        "The shared ansible InventoryManager of host_list"
+        key = tuple(host_list)
+        if key not in cls._inventories:
+            from ansible.inventory.manager import InventoryManager
+            source = ','.join(host_list) + ','
+            cls._inventories[key] = InventoryManager(loader=cls.get_loader(), sources=[source])
+        return cls._inventories[key]
+
+    def cli_args(self):
+        """Ansible's CLIArgs for the command line of ansible-playbook
+
+        PlaybookCLI.parse() can't be used, as it sets ansible's global
+        CLIARGS only once per process.
+        """
+        from ansible.cli.playbook import PlaybookCLI
+        from ansible.utils.context_objects import CLIArgs
+        cli = PlaybookCLI(self.command)
+        cli.init_parser()
+        options = cli.post_process_args(cli.parser.parse_args(self.command[1:]))
+        # The parser resolves the path with realpath, which breaks /dev/fd/N of a memfd
+        options.extra_vars = ['@' + self.tempfile_path(self.temp_extra_vars)]
+        return CLIArgs.from_options(options)
+
+    def execute(self, report_fd=None, output=None):
+        """Run the playbook with ansible's PlaybookExecutor and return the exit code
+
+        The exit codes are those of ansible-playbook. report_fd is a file
+        descriptor for the isna_report callback; without it the events go to
+        self.temp_report. output is a file object for ansible's stdout & stderr.
+        """
+        from contextlib import ExitStack, redirect_stdout, redirect_stderr
+        from ansible import context
+        from ansible.errors import AnsibleError, AnsibleOptionsError, AnsibleParserError
+        from ansible.executor.playbook_executor import PlaybookExecutor
+        from ansible.utils.vars import load_extra_vars, load_options_vars
+        from ansible.vars.manager import VariableManager
+
+        report = {'ISNA_REPORT_FILE': self.tempfile_path(self.temp_report)}
+        if report_fd is not None:
+            report = {'ISNA_REPORT_FD': str(report_fd)}
+        with self._lock, ExitStack() as stack:
+            stack.enter_context(_environ(report))
+            if output is not None:
+                stack.enter_context(redirect_stdout(output))
+                stack.enter_context(redirect_stderr(output))
+            try:
+                loader = self.get_loader()
+                inventory = self.get_inventory(self.host_list)
+                context.CLIARGS = self.cli_args()
+                # ansible caches the extra & option vars, as it expects one run per process
+                load_extra_vars.extra_vars = None
+                load_options_vars.options_vars = None
+                pbex = PlaybookExecutor(
+                    playbooks=[self.tempfile_path(self.temp_playbook)],
+                    inventory=inventory,
+                    variable_manager=VariableManager(loader=loader, inventory=inventory),
+                    loader=loader,
+                    passwords={},
+                )
+                return pbex.run()
+            except AnsibleError as exc:
+                print('ERROR!', exc, file=_sys.stderr)
+                if isinstance(exc, AnsibleOptionsError):
+                    return 5
+                return 4 if isinstance(exc, AnsibleParserError) else 1
+
+    def run(self, capture=False):
+        """Run the playbook and return a CompletedProcess, see AnsiblePlaybook.run"""
+        from io import StringIO
+        from subprocess import CompletedProcess
+        output = StringIO() if capture else None
+        with _timed('ansible'):
+            returncode = self.execute(output=output)
+        stdout = output.getvalue() if capture else None
+        return CompletedProcess(self.command, returncode, stdout)
+
+    def stream(self, capture=False):
+        """Run the playbook and yield a run_event for each event, see AnsiblePlaybook.stream
+
+        The playbook runs in a separate thread. A run in this process
+        can't be terminated, so closing the generator early waits
+        for the run to finish.
+        """
+        from threading import Thread
+        self.returncode = None
+        result = {}
+        rfd, wfd = _os.pipe()
+        fds = {'report': rfd}
+        output = None
+        if capture:
+            fds['output'], out_wfd = _os.pipe()
+            output = open(out_wfd, 'w', buffering=1, errors='replace')
+
+        def target():
+            try:
+                result['returncode'] = self.execute(report_fd=wfd, output=output)
+            except BaseException as exc:
+                result['error'] = exc
+            finally:
+                _os.close(wfd)
+                if output is not None:
+                    output.close()
+
+        with _timed('ansible'):
+            thread = Thread(target=target, name='isna-inprocess', daemon=True)
+            thread.start()
+            try:
+                yield from self._read_events(fds)
+            finally:
+                _drain(fds.values())  # If closed early, so the run can finish
+                thread.join()
+                for fd in fds.values():
+                    _os.close(fd)
+        if 'error' in result:
+            raise result['error']
+        self.returncode = result['returncode']
+
+
+class AsyncAnsiblePlaybook(AnsiblePlaybook):
+    """AnsiblePlaybook for asyncio
+
+    For example:
+        async with AsyncAnsiblePlaybook(...) as pb:
+            async for event in pb.stream(timeout=600):
+                ...
+        print(pb.returncode)
+
+    A run which is cancelled or times out terminates its ansible-playbook
+    (and kills it, if it is still running after terminate_timeout seconds).
+    """
+    terminate_timeout = 5
+    line_limit = 2 ** 24
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *args):
+        self.__exit__(*args)
+
+    async def _terminate(self, proc):
+        import asyncio
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), self.terminate_timeout)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def run(self, capture=False, timeout=None):
+        """Run ansible-playbook and return the CompletedProcess, see AnsiblePlaybook.run
+
+        If the run takes longer than timeout seconds, ansible-playbook
+        is terminated and asyncio.TimeoutError is raised.
+        """
+        import asyncio
+        from subprocess import CompletedProcess, DEVNULL, PIPE, STDOUT
+        out = dict(stdout=PIPE, stderr=STDOUT) if capture else {}
+        proc = await asyncio.create_subprocess_exec(
+            *self.command, stdin=DEVNULL, env=self.environment, pass_fds=self.pass_fds, **out)
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        finally:
+            if proc.returncode is None:
+                await self._terminate(proc)
+        if stdout is not None:
+            stdout = stdout.decode(errors='replace')
+        return CompletedProcess(self.command, proc.returncode, stdout)
+
+    async def stream(self, capture=False, timeout=None):
+        """Run ansible-playbook and yield a run_event for each event as it happens
+
+        This is the async generator version of AnsiblePlaybook.stream.
+        If the run takes longer than timeout seconds, ansible-playbook
+        is terminated and asyncio.TimeoutError is raised.
+        """
+        import asyncio
+        from subprocess import DEVNULL, PIPE, STDOUT
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        self.returncode = None
+        rfd, wfd = _os.pipe()
+        env = self.environment
+        env['ISNA_REPORT_FD'] = str(wfd)
+        out = dict(stdout=PIPE, stderr=STDOUT) if capture else {}
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *self.command, stdin=DEVNULL, env=env, pass_fds=(wfd,) + self.pass_fds,
+                limit=self.line_limit, **out)
+        except BaseException:
+            _os.close(rfd)
+            raise
+        finally:
+            _os.close(wfd)
+
+        queue = asyncio.Queue(maxsize=64)
+        report = asyncio.StreamReader(limit=self.line_limit)
+        transport = None
+        tasks = []
+        try:
+            transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(report), open(rfd, 'rb', 0))
+            rfd = None
+            tasks.append(loop.create_task(self._pump('report', report, queue)))
+            if capture:
+                tasks.append(loop.create_task(self._pump('output', proc.stdout, queue)))
+            running = len(tasks)
+            while running:
+                remaining = None if deadline is None else deadline - loop.time()
+                ev = await asyncio.wait_for(queue.get(), remaining)
+                if ev is None:
+                    running -= 1
+                elif isinstance(ev, Exception):
+                    raise ev
+                else:
+                    yield ev
+            remaining = None if deadline is None else deadline - loop.time()
+            self.returncode = await asyncio.wait_for(proc.wait(), remaining)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if transport is not None:
+                transport.close()
+            if rfd is not None:
+                _os.close(rfd)
+            if proc.returncode is None:
+                await self._terminate(proc)
+
+    async def _pump(self, name, reader, queue):
+        "Put the events read from reader on queue, followed by None at the end"
+        try:
+            async for line in reader:
+                line = line.rstrip(b'\n')
+                if line:
+                    await queue.put(self._event(name, line))
+        except Exception as exc:
+            await queue.put(exc)
+        await queue.put(None)
@@ -15,6 +15,127 @@ def _hidden_input(prompt):
 QueryRes = _namedtuple('QueryRes', 'var result raw_result')
 
 
+class _PipeVars:
+    """Parse the variables piped to stdin as a stream
+
+    The input is either a sequence of json objects (a single object, or
+    JSON Lines), or key=value pairs separated by ';' (see
+    isna.util.dict_from_str). Iterating yields (key, value) pairs in the
+    order they are given, reading only as much input as needed.
+    Only the pair being parsed is buffered. As with dict_from_str, a
+    newline is read as a space, also inside a json string.
+    """
+    chunk_size = 2**16
+
+    def __init__(self, fin):
+        import json
+        self.fin = fin
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size=1):
+        """Read at least size more characters, or up to the end of the input
+
+        Drops the parsed part of the buffer. Returns False at the end of the input.
+        """
+        if self.eof:
+            return False
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        size = max(size, 1)
+        chunks, wanted = [self.buf], size
+        while wanted > 0:
+            chunk = self.fin.readline(self.chunk_size)  # Doesn't wait for more than a line
+            if not chunk:
+                self.eof = True
+                break
+            chunks.append(chunk.replace('\n', ' '))
+            wanted -= len(chunk)
+        self.buf = ''.join(chunks)
+        return wanted < size
+
+    def _peek(self):
+        "Skip whitespace and return the next character, or '' at the end of the input"
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        "Consume the next character, which must be one of chars, and return it"
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of {!r} on stdin, got {!r}'.format(chars, char))
+        self.pos += 1
+        return char
+
+    def _decode(self):
+        "Decode the json value at the current position"
+        from json import JSONDecodeError
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buf, self.pos)
+            except JSONDecodeError:
+                if self._fill(len(self.buf) - self.pos):  # Double the buffer, see _fill
+                    continue
+                raise
+            # A number at the end of the buffer might continue in the next chunk
+            if end < len(self.buf) or not self._fill():
+                self.pos = end
+                return value
+
+    def __iter__(self):
+        first = self._peek()
+        if first == '{':
+            return self._json_pairs()
+        if first:
+            return self._simple_pairs()
+        return iter(())
+
+    def _json_pairs(self):
+        while self._peek():
+            self._expect('{')
+            if self._peek() == '}':
+                self.pos += 1
+                continue
+            while True:
+                key = self._decode()
+                if not isinstance(key, str):
+                    raise ValueError('Expected a key on stdin, got {!r}'.format(key))
+                self._expect(':')
+                yield key, self._decode()
+                if self._expect(',}') == '}':
+                    break
+
+    def _find_sep(self, start):
+        "Return the index of the first ';' from start which isn't escaped, or -1"
+        end = self.buf.find(';', start)
+        while end > 0 and self.buf[end - 1] == '\\':
+            end = self.buf.find(';', end + 1)
+        return end
+
+    def _simple_pairs(self):
+        from isna.util import _simple_parse_str
+        while True:
+            end = self._find_sep(self.pos)
+            while end < 0:
+                searched = len(self.buf) - self.pos
+                if not self._fill(len(self.buf) - self.pos):
+                    break
+                end = self._find_sep(self.pos + searched)
+            segment = self.buf[self.pos:end] if end >= 0 else self.buf[self.pos:]
+            self.pos = end + 1 if end >= 0 else len(self.buf)
+            yield from _simple_parse_str(segment).items()
+            if end < 0:
+                return
+
+
 class InputQuery:
     """InputQuery is a class which facilitates getting user-input or input from a pipe
 
@@ -35,22 +156,43 @@ class InputQuery:
     class InputError(Exception):
         pass
 
-    def __init__(self, print_file=_sys.stderr):
+    def __init__(self, print_file=_sys.stderr, read_pipe=True):
         """Create InputQuery instance.
 
         print_file is a file-like object where user-input prompts
         are written.
+        A piped stdin is read to its end by the first query or access of
+        data. A variable given twice keeps its last value, as with --vars.
+        If read_pipe is false a piped stdin is left unread, for the
+        caller to read; variables can't be queried from it then.
         """
-        self.data = {}
+        self._data = {}
         self.print_file = print_file
         self.is_tty = self.input_file.isatty()
-        if self.is_tty:
-            self._query = self._user_query
+        if self.is_tty or not read_pipe:
+            self._pipe = iter(())
         else:
-            from isna.util import dict_from_str
-            pipe_dat = dict_from_str(self.input_file.read())
-            self.data.update(pipe_dat)
-            self._query = self._pipe_query
+            self._pipe = iter(_PipeVars(self.input_file))
+        self._query = self._user_query if self.is_tty else self._pipe_query
+
+    @property
+    def data(self):
+        "Dict of all variables given on stdin or queried so far"
+        self._read_pipe()
+        return self._data
+
+    def _read_pipe(self):
+        "Read the variables on stdin, unless that was done already"
+        try:
+            for key, value in self._pipe:
+                self._data[key] = value
+        except ValueError as e:
+            self._pipe = iter(())
+            raise self.InputError('Could not parse {!r}: {}'.format(self._input_name, e)) from e
+
+    @property
+    def _input_name(self):
+        return getattr(self.input_file, 'name', 'stdin')
 
     def _build_prompt(self, var, default=None, prompt=None, choices=None, **kw):
         """_build_prompt creates a prompt-string for querying the user.
@@ -110,7 +252,7 @@ class InputQuery:
                 valid, res, raw_res = self._get_value(query, transform, choices)
             total_res = QueryRes(var, res, raw_res)
         # print('got', QueryRes(var, res, raw_res))
-        self.data[total_res.var] = total_res.result
+        self._data[total_res.var] = total_res.result
         return total_res
 
     def qprint(self, *args, sep=' ', end='\n'):
@@ -148,15 +290,11 @@ class InputQuery:
             return self._user_query(var, allow_empty=allow_empty, **kw)
 
     def _pipe_query(self, var, *, default, **kw):
-        "Get var from a json object read from stdin"
-        jdat = self.data
+        "Get var from the variables read from stdin"
+        self._read_pipe()
+        if var in self._data:
+            return self._data[var]
         if default is not None:
-            val = jdat.get(var, default)
-        else:
-            try:
-                val = jdat[var]
-            except KeyError as e:
-                msg = 'The key {key!r} was not given to {name!r}'
-                msg = msg.format(key=var, name=self.input_file.name)
-                raise self.InputError(msg) from e
-        return val
+            return default
+        msg = 'The key {key!r} was not given to {name!r}'
+        raise self.InputError(msg.format(key=var, name=self._input_name))
@@ -0,0 +1,291 @@
+"""isna.server -- Run isna commands in a warm, long-lived process
+
+'isna serve' listens on a UNIX socket. It imports isna's modules (and
+ansible, for the inprocess engine) and parses the default templates once,
+as well as those of its --dir options. For each request it forks a child,
+which inherits all of that. Templates a request parses itself are parsed
+again by the next request.
+
+If $ISNA_SERVER (or else cfg['server']) is true, the isna command line
+(see isna.cli2.main) first tries to forward its argv to a running server.
+It sends its argv, working directory, environment & umask, and passes its
+stdin, stdout & stderr with SCM_RIGHTS, so the child reads & writes them
+directly (prompts included). If no server is running the command runs in
+the client as usual.
+Forwarded commands run the code & cfg which the server loaded when it
+started, so the server has to be restarted after isna is upgraded or
+configured differently. That's why forwarding is off by default.
+
+The socket is only accessible to its owner, and the server also checks
+the uid of each client with SO_PEERCRED.
+"""
+import os as _os
+import struct as _struct
+import sys as _sys
+
+from isna.config import cfg
+
+
+def socket_path():
+    "The server's socket; cfg['server_socket'] or server.sock under $XDG_RUNTIME_DIR/isna"
+    if cfg['server_socket']:
+        return cfg['server_socket']
+    runtime_dir = _os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return _os.path.join(runtime_dir, 'isna', 'server.sock')
+    cache_home = _os.environ.get('XDG_CACHE_HOME') or _os.path.expanduser('~/.cache')
+    return _os.path.join(cache_home, 'isna', 'server.sock')
+
+
+def _send_request(sock, request, fds):
+    import array
+    import json
+    import socket
+    data = json.dumps(request).encode()
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    sock.sendmsg([_struct.pack('!I', len(data)) + data], ancillary)
+
+
+def _recv_request(sock, maxfds=3):
+    "Return the request dict and the file descriptors sent by _send_request"
+    import array
+    import json
+    import socket
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(65536, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    if len(msg) < 4:
+        raise ValueError('Incomplete request')
+    size, = _struct.unpack('!I', msg[:4])
+    data = msg[4:]
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ValueError('Incomplete request')
+        data += chunk
+    return json.loads(data.decode()), list(fds)
+
+
+def forward(argv, path=None):
+    """Run the isna command line argv in a running server
+
+    Returns the exit code of the command, or None if no server is running.
+    """
+    path = path if path is not None else socket_path()
+    if not _os.path.exists(path):
+        return None
+    import json
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        umask = _os.umask(0)
+        _os.umask(umask)
+        request = {
+            'argv': list(argv),
+            'cwd': _os.getcwd(),
+            'env': dict(_os.environ),
+            'umask': umask,
+        }
+        _sys.stdout.flush()
+        _sys.stderr.flush()
+        _send_request(sock, request, [0, 1, 2])
+        reply = b''
+        while not reply.endswith(b'\n'):
+            try:
+                chunk = sock.recv(4096)
+            except KeyboardInterrupt:
+                sock.sendall(b'INT\n')  # The child gets a KeyboardInterrupt as well
+                continue
+            if not chunk:
+                print('isna: the server closed the connection', file=_sys.stderr)
+                return 1
+            reply += chunk
+    return json.loads(reply.decode())['returncode']
+
+
+def _check_peer(conn):
+    "True if the client connected to conn runs as our user"
+    import socket
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _struct.calcsize('3i'))
+    pid, uid, gid = _struct.unpack('3i', creds)
+    return uid == _os.getuid()
+
+
+def _watch(conn, done):
+    "Interrupt the main thread once the client sends INT or goes away, unless done is set"
+    import signal
+    try:
+        conn.recv(16)
+    except OSError:
+        pass
+    if not done.is_set():
+        _os.kill(_os.getpid(), signal.SIGINT)
+
+
+def _run(argv):
+    "Run the isna command line argv and return its exit code"
+    from isna.cli2 import main
+    try:
+        return main(argv, forward=False) or 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=_sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+    finally:
+        _sys.stdout.flush()
+        _sys.stderr.flush()
+
+
+def handle(conn):
+    """Handle one request on conn in a forked child. Returns the exit code of the command
+
+    The child takes over the client's stdin, stdout & stderr, working
+    directory, environment and umask before it runs the command.
+    """
+    import json
+    import signal
+    import threading
+    if not _check_peer(conn):
+        return 1
+    request, fds = _recv_request(conn)
+    for target, fd in enumerate(fds[:3]):
+        if fd != target:
+            _os.dup2(fd, target)
+            _os.close(fd)
+    for stream in (_sys.stdout, _sys.stderr):
+        stream.reconfigure(line_buffering=stream.isatty())
+    _os.chdir(request['cwd'])
+    _os.environ.clear()
+    _os.environ.update(request['env'])
+    _os.umask(request['umask'])
+    done = threading.Event()
+    threading.Thread(target=_watch, args=(conn, done), daemon=True).start()
+    returncode = _run(request['argv'])
+    done.set()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conn.sendall(json.dumps({'returncode': returncode}).encode() + b'\n')
+    return returncode
+
+
+def warm(templ_dirs=()):
+    """Import isna's modules & parse the templates of the default template dirs
+
+    If templ_dirs are given, the templates of templ_dirs (followed by the
+    default dirs) are parsed as well, i.e., those of commands given the
+    same --dir options. The forked children inherit all of it. Whatever a
+    request parses is lost with its child, so only these dirs stay warm.
+    """
+    import importlib
+    import isna.cli
+    for module in ('docopt', 'schema', 'isna.query'):
+        importlib.import_module(module)
+    from isna.index import TemplateIndex
+    from isna.playbook import PBMaker
+    dir_sets = [isna.cli.get_templ_dirs([])]
+    if templ_dirs:
+        dir_sets.append(isna.cli.get_templ_dirs(templ_dirs))
+    for dirs in dir_sets:
+        pbm = PBMaker.shared(*dirs)
+        for name in TemplateIndex(*dirs).names(cfg['templ_ext']):
+            try:
+                pbm.all_vars(name)
+            except Exception as e:
+                isna.cli.dprint('Could not load template', name, e)
+    if cfg['engine'] == 'inprocess':
+        from isna.playbook import InProcessPlaybook
+        InProcessPlaybook.get_loader()
+
+
+def serve(path=None, templ_dirs=()):
+    """Serve isna commands on the UNIX socket path until terminated
+
+    templ_dirs are template dirs to parse in advance, see warm().
+    Returns an exit code: 1 if another server is running on path.
+    """
+    import select
+    import signal
+    import socket
+    path = path if path is not None else socket_path()
+    dirname = _os.path.dirname(path)
+    _os.makedirs(dirname, mode=0o700, exist_ok=True)
+    if _os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            _os.unlink(path)  # Left over by a server which died
+        else:
+            print('isna: a server is already running on', path, file=_sys.stderr)
+            return 1
+        finally:
+            probe.close()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = _os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        _os.umask(umask)
+    sock.listen(64)
+    warm(templ_dirs)
+
+    # The handler only sets a flag: an exception raised in it could be
+    # swallowed, e.g. by the at-fork hooks which run after fork().
+    # The wakeup fd makes select() return for a signal arriving at any time.
+    stopping = []
+
+    def terminate(signum, frame):
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # The children are reaped automatically
+    wakeup_r, wakeup_w = _os.pipe()
+    _os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    print('isna: serving on', path, flush=True)
+    try:
+        while not stopping:
+            readable, _, _ = select.select([sock, wakeup_r], [], [])
+            if wakeup_r in readable:
+                _os.read(wakeup_r, 512)
+            if sock not in readable:
+                continue
+            conn, _ = sock.accept()
+            if _os.fork() == 0:
+                returncode = 1
+                try:
+                    sock.close()
+                    signal.set_wakeup_fd(-1)
+                    _os.close(wakeup_r)
+                    _os.close(wakeup_w)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.default_int_handler)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    returncode = handle(conn)
+                except BaseException:
+                    import traceback
+                    traceback.print_exc()
+                finally:
+                    _os._exit(returncode)
+            conn.close()
+        return 0
+    finally:
+        signal.set_wakeup_fd(-1)
+        _os.close(wakeup_r)
+        _os.close(wakeup_w)
+        sock.close()
+        _os.unlink(path)
@@ -1,4 +1,9 @@
 from collections import namedtuple as _namedtuple
+from contextlib import (
+    contextmanager as _contextmanager,
+    nullcontext as _nullcontext,
+)
+from functools import lru_cache as _lru_cache
 
 from isna.config import cfg
 
@@ -22,17 +27,181 @@ def maybe_bool(txt, true_strs=cfg['true_strs'],
         return txt
 
 
-def get_hosts(domain='.local'):
-    "Return a list of hostnames on domain"
-    hosts = set()
+def format_table(rows, header):
+    """Format rows (an iterable of tuples) as a left-aligned text table
+
+    None values are shown as '-'. Returns a str.
+    """
+    def fmt(x):
+        if x is None:
+            return '-'
+        if isinstance(x, float):
+            return '{:.2f}'.format(x)
+        return str(x)
+    lines = [[fmt(x) for x in row] for row in rows]
+    lines.insert(0, [str(x) for x in header])
+    widths = [max(len(x) for x in col) for col in zip(*lines)]
+    return '\n'.join(
+        '  '.join(x.ljust(w) for x, w in zip(line, widths)).rstrip()
+        for line in lines
+    )
+
+
+class Timings:
+    """The wall-clock time spent in each phase of a command, see timed()
+
+    The time of a phase excludes the phases nested in it, so the phases of
+    one thread add up to the time of the command. Phases which run in
+    several threads at once (e.g., ansible on many --ssh hosts) add up to more.
+    """
+
+    def __init__(self):
+        import threading
+        self.phases = {}  # name -> [calls, seconds]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @_contextmanager
+    def phase(self, name):
+        from time import perf_counter
+        stack = self._local.__dict__.setdefault('stack', [])
+        frame = [0.0]  # Time spent in nested phases
+        stack.append(frame)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            # Not necessarily the top of the stack: a phase may wrap a generator
+            index = next(i for i, x in enumerate(stack) if x is frame)
+            del stack[index]
+            if index:
+                stack[index - 1][0] += elapsed
+            with self._lock:
+                entry = self.phases.setdefault(name, [0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed - frame[0]
+
+    def table(self, total):
+        """Format the phases as a table, slowest first
+
+        total is the duration of the command in seconds. The time
+        which isn't in any phase is shown as 'other'.
+        """
+        rows = sorted(self.phases.items(), key=lambda x: -x[1][1])
+        rows = [(name, calls, seconds) for name, (calls, seconds) in rows]
+        rows.append(('other', None, max(0.0, total - sum(x[2] for x in rows))))
+        rows = [
+            (name, calls, '{:.3f}'.format(seconds), '{:.0%}'.format(seconds / total) if total else None)
+            for name, calls, seconds in rows
+        ]
+        rows.append(('total', None, '{:.3f}'.format(total), None))
+        return format_table(rows, ('PHASE', 'CALLS', 'SECONDS', 'SHARE'))
+
+
+timings = None  # The Timings of the current command, if it is profiled (see cli2.main)
+
+
+def timed(name):
+    "Context manager which adds its duration to the phase name of timings, if the command is profiled"
+    if timings is None:
+        return _nullcontext()
+    return timings.phase(name)
+
+
+def cache_dir(*names):
+    """Return the path to isna's cache directory joined with names
+
+    The cache directory is $XDG_CACHE_HOME/isna (~/.cache/isna by default)
+    and is created if it doesn't exist yet.
+    """
+    import os
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    path = os.path.join(base, 'isna')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return os.path.join(path, *names)
+
+
+def write_atomic(path, txt, mode=None):
+    """Write txt to path by replacing it with a fully written temporary file
+
+    The file is only readable by its owner, unless mode is given: then
+    an existing file keeps its permissions, and a new one gets mode
+    (less the umask), like open() would give it.
+    """
+    import os
+    import tempfile
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.isna')
+    try:
+        if mode is not None:
+            try:
+                mode = os.stat(path).st_mode & 0o7777
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode &= ~umask
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(txt)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def iter_hosts(domain='.local', timeout=cfg['avahi_timeout'], cache=None):
+    """Yield the hostnames on domain as avahi-browse finds them
+
+    Each hostname is yielded once, as soon as avahi-browse prints it.
+    avahi-browse is stopped once timeout seconds have passed.
+    cache is an optional HostsCache. Cached hostnames are yielded instead
+    of running avahi-browse, and the hostnames found are stored in it,
+    unless the caller stops iterating early.
+    """
+    if cache is not None:
+        hosts = cache.get(domain)
+        if hosts is not None:
+            yield from hosts
+            return
+    import os
+    import selectors
     import subprocess as sp
-    p = sp.Popen(['avahi-browse', '-alrpt'], stdout=sp.PIPE)
-    stdout, stderr = p.communicate()
-    stdout = stdout.decode()
-    for line in stdout.splitlines():
-        elements = line.split(';')
-        hosts = hosts | set([x for x in elements if x.endswith(domain)])
-    return sorted(hosts)
+    from time import monotonic
+    deadline = monotonic() + timeout
+    hosts = {}  # Ordered by discovery
+    p = sp.Popen(['avahi-browse', '-alrpt'], stdin=sp.DEVNULL, stdout=sp.PIPE)
+    try:
+        with selectors.DefaultSelector() as sel:
+            sel.register(p.stdout, selectors.EVENT_READ)
+            pending = b''
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0 or not sel.select(remaining):
+                    break
+                chunk = os.read(p.stdout.fileno(), 65536)
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop() if chunk else b''
+                for line in lines:
+                    for field in line.decode(errors='replace').split(';'):
+                        if field and field.endswith(domain) and field not in hosts:
+                            hosts[field] = None
+                            yield field
+                if not chunk:
+                    break
+        if cache is not None:
+            cache.put(domain, hosts)
+            cache.save()
+    finally:
+        if p.poll() is None:
+            p.terminate()
+        p.wait()
+        p.stdout.close()
+
+
+def get_hosts(domain='.local', timeout=cfg['avahi_timeout'], cache=None):
+    "Return a sorted list of hostnames on domain, see iter_hosts()"
+    return sorted(iter_hosts(domain, timeout=timeout, cache=cache))
+
 
 need_pass = _namedtuple(
     'need_pass',
@@ -42,11 +211,395 @@ need_pass = _namedtuple(
 )
 
 
+class _JsonCache:
+    "Base class of caches stored as a dict in a json file"
+
+    def __init__(self, path):
+        self.path = path
+        self._dirty = False
+
+    @property
+    def entries(self):
+        try:
+            return self._entries
+        except AttributeError:
+            import json
+            try:
+                with open(self.path) as fin:
+                    self._entries = json.load(fin)
+            except (OSError, ValueError):
+                self._entries = {}
+            return self._entries
+
+    def save(self):
+        if self._dirty:
+            import json
+            write_atomic(self.path, json.dumps(self.entries))
+            self._dirty = False
+
+
+class NeedsPassCache(_JsonCache):
+    """NeedsPassCache stores need_pass results in a json file
+
+    The results are keyed by (user, host, port, sudo user) and
+    are ignored once they are older than ttl seconds.
+    Changes are only written to disk by save().
+    """
+
+    def __init__(self, path=None, ttl=cfg['needs_pass_ttl']):
+        super().__init__(path if path is not None else cache_dir('needs_pass.json'))
+        self.ttl = ttl
+
+    @staticmethod
+    def key(user, hostname, port, sudo):
+        return '{}@{}:{}/{}'.format(user, hostname, port, sudo if sudo else '')
+
+    def get(self, user, hostname, port, sudo=''):
+        "Return the cached need_pass result or None"
+        from time import time
+        entry = self.entries.get(self.key(user, hostname, port, sudo))
+        if entry is None or time() - entry['time'] > self.ttl:
+            return None
+        return need_pass(**entry['result'])
+
+    def put(self, result, port):
+        "Store the need_pass result of a probe which connected to port"
+        from time import time
+        key = self.key(result.ssh_user, result.host, port, result.sudo_user)
+        self.entries[key] = {'time': time(), 'result': result._asdict()}
+        self._dirty = True
+
+    def invalidate(self, hostname):
+        "Forget all results for hostname, e.g., after ansible failed to connect"
+        for key, entry in list(self.entries.items()):
+            if entry['result']['host'] == hostname:
+                del self.entries[key]
+                self._dirty = True
+
+
+class RunCache(_JsonCache):
+    """RunCache stores the outcome of playbook runs in a json file
+
+    A run is keyed by a hash of everything which went into it, see key().
+    Outcomes are ignored once they are older than ttl seconds
+    (None means never). Changes are only written to disk by save().
+    """
+
+    def __init__(self, path=None, ttl=cfg['run_cache_ttl']):
+        super().__init__(path if path is not None else cache_dir('runs.json'))
+        self.ttl = ttl
+
+    @staticmethod
+    def key(*parts):
+        "Return a sha256 hex digest of parts, which have to be json serializable"
+        import hashlib
+        import json
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        "Return the cached outcome (a dict with returncode & time) or None"
+        from time import time
+        entry = self.entries.get(key)
+        if entry is None or (self.ttl is not None and time() - entry['time'] > self.ttl):
+            return None
+        return entry
+
+    def put(self, key, returncode, **info):
+        "Store the returncode of the run with key, and any other json serializable info"
+        from time import time
+        self.entries[key] = dict(info, returncode=returncode, time=time())
+        self._dirty = True
+
+
+class HostsCache(_JsonCache):
+    """HostsCache stores the hostnames found on each avahi domain in a json file
+
+    The hostnames are ignored once they are older than ttl seconds.
+    Changes are only written to disk by save().
+    """
+
+    def __init__(self, path=None, ttl=cfg['hosts_ttl']):
+        super().__init__(path if path is not None else cache_dir('hosts.json'))
+        self.ttl = ttl
+
+    def get(self, domain):
+        "Return the cached list of hostnames on domain or None"
+        from time import time
+        entry = self.entries.get(domain)
+        if entry is None or time() - entry['time'] > self.ttl:
+            return None
+        return entry['hosts']
+
+    def put(self, domain, hosts):
+        "Store the hostnames found on domain"
+        from time import time
+        self.entries[domain] = {'time': time(), 'hosts': list(hosts)}
+        self._dirty = True
+
+
+class RenderCache:
+    """RenderCache stores the last render of each template & its variables
+
+    Each render is a file named by its key, see RunCache.key.
+    Renders are ignored, and deleted by put(), once they are older
+    than ttl seconds.
+    """
+    key = staticmethod(RunCache.key)
+
+    def __init__(self, directory=None, ttl=cfg['render_cache_ttl']):
+        self.directory = directory if directory is not None else cache_dir('renders')
+        self.ttl = ttl
+
+    def get(self, key):
+        "Return the stored render with key or None"
+        import os
+        from time import time
+        try:
+            with open(os.path.join(self.directory, key)) as fin:
+                if time() - os.fstat(fin.fileno()).st_mtime > self.ttl:
+                    return None
+                return fin.read()
+        except OSError:
+            return None
+
+    def put(self, key, txt):
+        "Store the render txt with key, and delete the expired renders"
+        import os
+        from time import time
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        write_atomic(os.path.join(self.directory, key), txt)
+        expired = time() - self.ttl
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < expired:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+class SSHControl:
+    """SSHControl manages shared ssh master connections (ssh's ControlMaster)
+
+    A master connection is started in the background for each probed host.
+    The NeedsPass probe and ansible (see ansible_args()) then multiplex over
+    its ControlPath socket instead of doing their own ssh handshakes.
+
+    persist is passed to ssh's ControlPersist, i.e., how long an idle
+    master connection is kept open. With persist='no' the master
+    connections should be closed with stop() once ansible is done.
+    """
+
+    def __init__(self, persist=cfg['ssh_control_persist'], directory=None):
+        self.persist = persist
+        self.directory = directory if directory is not None else self.default_directory()
+
+    @staticmethod
+    def default_directory():
+        "Directory for the control sockets; under $XDG_RUNTIME_DIR if it is set"
+        import os
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+        if runtime_dir:
+            path = os.path.join(runtime_dir, 'isna', 'ssh')
+        else:
+            path = cache_dir('ssh')
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    @property
+    def path(self):
+        "The ControlPath; ssh replaces %C by a hash of the local & remote host, port and user"
+        import os
+        return os.path.join(self.directory, '%C')
+
+    def options(self):
+        "ssh options for connecting through an existing master connection"
+        return ['-oControlPath={}'.format(self.path)]
+
+    def ansible_args(self):
+        "Value for ansible_ssh_common_args, so that ansible reuses the master connections"
+        from shlex import quote
+        opts = '-o ControlMaster=auto -o ControlPath={} -o ControlPersist={}'
+        return opts.format(quote(self.path), self.persist)
+
+    def _cmd(self, user, hostname, port, *options):
+        return [
+            'ssh',
+            '-oControlPath={}'.format(self.path),
+            '-p', '{}'.format(port),
+        ] + list(options) + ['{}@{}'.format(user, hostname)]
+
+    def start_cmd(self, user='root', hostname='localhost', port=22, strict=None):
+        "Command which starts a background master connection"
+        options = [
+            '-fNT',
+            '-oBatchMode=yes',
+            '-oNoHostAuthenticationForLocalhost=yes',
+            '-oControlMaster=yes',
+            '-oControlPersist={}'.format(self.persist),
+        ]
+        if strict is not None:
+            options.append('-oStrictHostKeyChecking={}'.format('yes' if strict else 'no'))
+        return self._cmd(user, hostname, port, *options)
+
+    def check_cmd(self, user='root', hostname='localhost', port=22):
+        "Command which succeeds if a master connection is running"
+        return self._cmd(user, hostname, port, '-Ocheck')
+
+    def start(self, user='root', hostname='localhost', port=22, strict=None, timeout=None):
+        """Start a master connection to user@hostname:port, unless one is running already
+
+        A master left running by ansible (or an earlier isna) is reused:
+        starting another on the same ControlPath would leave a second
+        ssh session in the background. Returns True if a master connection
+        is running. Starting one fails if a password is needed.
+        """
+        import subprocess as sp
+
+        def run(cmd):
+            try:
+                res = sp.run(cmd, stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL,
+                             timeout=timeout)
+            except sp.TimeoutExpired:
+                return False
+            return res.returncode == 0
+        return (run(self.check_cmd(user=user, hostname=hostname, port=port))
+                or run(self.start_cmd(user=user, hostname=hostname, port=port, strict=strict)))
+
+    async def astart(self, user='root', hostname='localhost', port=22, strict=None,
+                     timeout=None):
+        "Asyncio version of start()"
+        import asyncio
+        import subprocess as sp
+
+        async def run(cmd):
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+            try:
+                return await asyncio.wait_for(proc.wait(), timeout) == 0
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                return False
+        return (await run(self.check_cmd(user=user, hostname=hostname, port=port))
+                or await run(self.start_cmd(user=user, hostname=hostname, port=port, strict=strict)))
+
+    def stop(self, user='root', hostname='localhost', port=22):
+        "Close the master connection to user@hostname:port (if there is one)"
+        import subprocess as sp
+        cmd = self._cmd(user, hostname, port, '-Oexit')
+        res = sp.run(cmd, stdin=sp.DEVNULL, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+        return res.returncode == 0
+
+
 class NeedsPass:
 
     @classmethod
-    def ssh(cls, user='root', hostname='localhost', sudo='', port=22, strict=None):
-        res = cls._ssh(user=user, hostname=hostname, sudo=sudo, port=port, strict=strict)
+    def ssh(cls, user='root', hostname='localhost', sudo='', port=22, strict=None,
+            cache=None, control=None):
+        """Test if ssh to user@hostname:port (and sudo to the sudo user) needs a password
+
+        cache is an optional NeedsPassCache to look up and store the result.
+        control is an optional SSHControl. A master connection is started
+        and the probe (and later ansible) reuses it.
+        """
+        if cache is not None:
+            res = cache.get(user, hostname, port, sudo)
+            if res is not None:
+                return res
+        options = ()
+        if control is not None:
+            control.start(user=user, hostname=hostname, port=port, strict=strict,
+                          timeout=cfg['probe_timeout'])
+            options = control.options()
+        res = cls._ssh(user=user, hostname=hostname, sudo=sudo, port=port, strict=strict,
+                       options=options)
+        res = cls._ssh_result(res, user=user, hostname=hostname, sudo=sudo)
+        if cache is not None:
+            cache.put(res, port)
+            cache.save()
+        return res
+
+    @classmethod
+    def ssh_many(cls, targets, timeout=cfg['probe_timeout'], strict=None, cache=None,
+                 control=None):
+        """Probe many hosts concurrently
+
+        targets is an iterable of dicts with the keyword arguments of
+        NeedsPass.ssh (user, hostname, sudo, port).
+        Returns a list of need_pass tuples in the order of targets.
+        A host which times out or has connection problems gets
+        ssh_success=False and ssh_needs_pw=None.
+        cache is an optional NeedsPassCache; only targets which
+        are missing from it are probed.
+        control is an optional SSHControl, see NeedsPass.ssh
+        """
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(cls.assh_many(
+                targets, timeout=timeout, strict=strict, cache=cache, control=control))
+        finally:
+            loop.close()
+
+    @classmethod
+    async def assh_many(cls, targets, timeout=cfg['probe_timeout'], strict=None, cache=None,
+                        control=None):
+        "Coroutine version of NeedsPass.ssh_many, for use in a running event loop"
+        targets = list(targets)
+        results = [None] * len(targets)
+        if cache is not None:
+            results = [
+                cache.get(x.get('user', 'root'), x['hostname'], x.get('port', 22), x.get('sudo', ''))
+                for x in targets
+            ]
+        todo = [(i, x) for i, x in enumerate(targets) if results[i] is None]
+        if not todo:
+            return results
+
+        import asyncio
+        probes = [cls._ssh_probe(timeout=timeout, strict=strict, control=control, **x)
+                  for i, x in todo]
+        probed = await asyncio.gather(*probes)
+        for (i, target), res in zip(todo, probed):
+            results[i] = res
+            if cache is not None and res.ssh_needs_pw is not None:
+                cache.put(res, target.get('port', 22))
+        if cache is not None:
+            cache.save()
+        return results
+
+    @classmethod
+    async def _ssh_probe(cls, user='root', hostname='localhost', sudo='', port=22,
+                         strict=None, timeout=None, control=None):
+        import asyncio
+        options = ()
+        if control is not None:
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            await control.astart(user=user, hostname=hostname, port=port, strict=strict,
+                                 timeout=timeout)
+            if timeout is not None:
+                timeout = max(timeout - (loop.time() - start), 0)
+            options = control.options()
+        res = await cls._assh(user=user, hostname=hostname, sudo=sudo, port=port,
+                              strict=strict, timeout=timeout, options=options)
+        try:
+            if res is not None:
+                return cls._ssh_result(res, user=user, hostname=hostname, sudo=sudo)
+        except ConnectionError:
+            pass
+        d = dict.fromkeys(need_pass._fields)
+        d['host'] = hostname
+        d['ssh_user'] = user
+        d['ssh_retcode'] = None if res is None else res.returncode
+        d['ssh_success'] = False
+        d['sudo_user'] = sudo if sudo else None
+        return need_pass(**d)
+
+    @classmethod
+    def _ssh_result(cls, res, user, hostname, sudo):
+        "Create a need_pass tuple from the CompletedProcess of _ssh()"
         code = res.returncode
         d = dict.fromkeys(need_pass._fields)
         d['host'] = hostname
@@ -91,7 +644,7 @@ class NeedsPass:
             raise ConnectionError(stderr)
 
     @staticmethod
-    def _ssh(user='root', hostname='localhost', sudo='', port=22, strict=None):
+    def _ssh_cmd(user='root', hostname='localhost', sudo='', port=22, strict=None, options=()):
         usrhost = '{}@{}'.format(user, hostname)
         cmd = [
             'ssh', '-T',
@@ -99,6 +652,7 @@ class NeedsPass:
             '-oNoHostAuthenticationForLocalhost=yes',
             '-p', '{}'.format(port),
         ]
+        cmd.extend(options)
         if strict is not None:
             strict = 'yes' if strict else 'no'
             cmd.append('-oStrictHostKeyChecking={}'.format(strict))
@@ -106,6 +660,12 @@ class NeedsPass:
 
         if sudo:
             cmd.append('sudo -u {} -n whoami'.format(sudo))
+        return cmd
+
+    @classmethod
+    def _ssh(cls, user='root', hostname='localhost', sudo='', port=22, strict=None, options=()):
+        cmd = cls._ssh_cmd(user=user, hostname=hostname, sudo=sudo, port=port, strict=strict,
+                           options=options)
         import subprocess as sp
         output = sp.run(
             cmd,
@@ -115,6 +675,31 @@ class NeedsPass:
         )
         return output
 
+    @classmethod
+    async def _assh(cls, user='root', hostname='localhost', sudo='', port=22, strict=None,
+                    timeout=None, options=()):
+        """Asyncio version of _ssh()
+
+        Returns None if ssh did not finish within timeout seconds.
+        """
+        cmd = cls._ssh_cmd(user=user, hostname=hostname, sudo=sudo, port=port, strict=strict,
+                           options=options)
+        import asyncio
+        import subprocess as sp
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=sp.DEVNULL,
+            stdout=sp.PIPE,
+            stderr=sp.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None
+        return sp.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
     @classmethod
     def sudo(cls, user='root'):
         res = cls._sudo(user=user)
@@ -140,8 +725,18 @@ class NeedsPass:
         return output
 
 
+_json_firsts = frozenset('{["-0123456789tfnNI')  # NaN & Infinity too
+
+
 def _json_parse_str(varstr):
     "Load obj from json; Return None on exception"
+    for char in varstr:  # Only strings starting like json are parsed
+        if not char.isspace():
+            break
+    else:
+        return None
+    if char not in _json_firsts:
+        return None
     import json
     try:
         return json.loads(varstr)
@@ -149,26 +744,41 @@ def _json_parse_str(varstr):
         return None
 
 
+@_lru_cache()
+def _pair_pattern(kv_sep='=', sep=';'):
+    """The compiled pattern of a key=value pair for _simple_parse_str
+
+    A key has to start at a word boundary, and a value ends at the first
+    sep which isn't escaped with a backslash.
+    """
+    import re
+    key = r'(?<!\w)(?P<key>[^\d\W]\w*)\s*' + re.escape(kv_sep) + r'\s*'
+    if len(sep) == 1:
+        sep = re.escape(sep)
+        val = r'(?P<val>(?:[^\s{0}\\]|\\.?)[^{0}\\]*(?:\\.?[^{0}\\]*)*)'.format(sep)
+    else:
+        sep = re.escape(sep)
+        val = r'(?P<val>(?:\\{0}|(?!{0})\S)(?:\\{0}|(?!{0}).)*)'.format(sep)
+    pat = key + val
+    return re.compile(pat, re.UNICODE | re.DOTALL)
+
+
 def _simple_parse_str(varstr, kv_sep='=', sep=';'):
     """Turn a string like 'a=1; b=2; c=three' into a dict
 
     For each key=value pair the key should be a valid python identifier,
-    and the value can either be a json object or any string*
-
-    *None of the values can contain any semicolon.
+    and the value can either be a json object or any string.
+    A semicolon in a value has to be escaped, like 'cmd=ls\\; ls'.
     """
-    pat = r'(?P<key>[^\d\W]\w*)(?:\s*?' + kv_sep + r'\s*?)(?P<val>\S.*?)(?:' + sep + r'|$)'
-    import re
-    def parse():
-        for kv in re.findall(pat, varstr, re.UNICODE | re.DOTALL):
-            k, v = kv
-            v_json = _json_parse_str(v)
-            if v_json is not None:
-                v = v_json
-            else:
-                v = v.strip()
-            yield k, v
-    return dict(parse())
+    escaped = '\\' + sep
+    dvars = {}
+    for match in _pair_pattern(kv_sep, sep).finditer(varstr):
+        key, val = match.groups()
+        if escaped in val:
+            val = val.replace(escaped, sep)
+        v_json = _json_parse_str(val)
+        dvars[key] = v_json if v_json is not None else val.strip()
+    return dvars
 
 
 def dict_from_str(some_string, kv_sep='=', sep=';'):
@@ -179,7 +789,9 @@ def dict_from_str(some_string, kv_sep='=', sep=';'):
        a string of key,value pairs like 'a=1; b=2; c=three'
     """
     some_string = some_string.replace('\n', ' ')
-    dvars = _json_parse_str(some_string)
-    if dvars is None:
+    dvars = None
+    if some_string.lstrip(' \t\r')[:1] == '{':
+        dvars = _json_parse_str(some_string)
+    if not isinstance(dvars, dict):
         dvars = _simple_parse_str(some_string, kv_sep=kv_sep, sep=sep)
-    return dict(dvars)
+    return dvars
@@ -0,0 +1,32 @@
+"""Benchmarks of isna.util.dict_from_str over --vars strings
+
+Run with: make bench
+"""
+import pytest
+
+from isna import util
+
+pytest.importorskip('pytest_benchmark')
+
+repos = ', '.join(
+    '{{"repo": "https://github.com/example/repo{0}.git", "dest": "~/src/repo{0}"}}'.format(i)
+    for i in range(200)
+)
+vars_strs = {
+    'short': 'username=woofdawg; new_usr_password=Xk3j9QpL2z; is_admin=no',
+    'json_object': '{"username": "woofdawg", "new_usr_password": "Xk3j9QpL2z", "is_admin": false}',
+    'json_values': 'a=0; b=one; c=true; d=[42, "jein"]; e={"a": "good=bad"}',
+    'multiline': 'git_repos_to_clone=[\n' + repos.replace('}, ', '},\n') + '\n]\n',
+    'many_pairs': '; '.join('var{0}=value{0}'.format(i) for i in range(500)),
+    'escaped': r'cmd=echo a\; echo b\; echo c; user=root',
+    'long_value': 'key=' + 'x' * 100000,
+    'long_word': 'x' * 20000,
+    'separators': ';' * 20000,
+    'equals': '=' * 20000,
+}
+
+
+@pytest.mark.parametrize('name', sorted(vars_strs))
+def test_dict_from_str(benchmark, name):
+    result = benchmark(util.dict_from_str, vars_strs[name])
+    assert isinstance(result, dict)
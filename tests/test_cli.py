@@ -37,6 +37,28 @@ class TestValidate(unittest.TestCase):
         with self.assertRaises(ValueError):
             val(['--ssh=wow.local::22', 'create-user.yml'])
 
+    def test_ssh_many(self):
+        val = self.validate
+        v = val(['--ssh=ida@localhost:22,wow.local', '--ssh=nope@okay', 'create-user.yml'])
+        self.assertEqual(v.data['--ssh'], ['ida@localhost:22', 'wow.local', 'nope@okay'])
+        with self.assertRaises(ValueError):
+            val(['--ssh=wow.local,,okay', 'create-user.yml'])
+
+    def test_forks(self):
+        val = self.validate
+        self.assertIsNone(val(['create-user.yml']).data['--forks'])
+        self.assertEqual(val(['--forks=20', 'create-user.yml']).data['--forks'], 20)
+        with self.assertRaises(ValueError):
+            val(['--forks=0', 'create-user.yml'])
+
+    def test_engine(self):
+        val = self.validate
+        self.assertIsNone(val(['create-user.yml']).data['--engine'])
+        self.assertEqual(val(['--engine=inprocess', 'create-user.yml']).data['--engine'],
+                         'inprocess')
+        with self.assertRaises(ValueError):
+            val(['--engine=fork', 'create-user.yml'])
+
     def test_templ_dirs(self):
         val = self.validate
         val(['--dir=/tmp', 'create-user.yml'])
@@ -125,3 +147,312 @@ class TestTransformStatic(unittest.TestCase):
         templates = templs([self.datfile(name)])
         x = templates[0]
         self.assertTempl(x, name, self.data_dir)
+
+
+class TestForgetUnreachable(unittest.TestCase):
+
+    def test_forget(self):
+        "Unreachable hosts and hosts which needed a sudo password are probed again"
+        import tempfile
+        from isna import util
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = util.NeedsPassCache(path=os.path.join(tmpdir, 'needs_pass.json'), ttl=60)
+            for host in ('h1', 'h2', 'h3'):
+                res = dict.fromkeys(util.need_pass._fields, False)
+                cache.put(util.need_pass(**dict(res, host=host, ssh_user='root')), 22)
+            runner = cli.Runner.__new__(cli.Runner)
+            runner._needs_pass_cache = cache
+            runner.forget_unreachable([
+                {'event': 'unreachable', 'host': 'h1', 'task': 't', 'time': 1.0},
+                {'event': 'failed', 'host': 'h2', 'task': 't', 'time': 1.0,
+                 'text': 'Incorrect sudo password'},
+                {'event': 'failed', 'host': 'h3', 'task': 't', 'time': 1.0, 'text': 'exit 1'},
+            ])
+            cache = util.NeedsPassCache(path=cache.path, ttl=60)
+            self.assertIsNone(cache.get('root', 'h1', 22))
+            self.assertIsNone(cache.get('root', 'h2', 22))
+            self.assertIsNotNone(cache.get('root', 'h3', 22))
+
+
+class StubTestCase(unittest.TestCase):
+    "Run isna using the ansible-playbook stub in tests/data/bin"
+
+    def setUp(self):
+        import tempfile
+        from unittest import mock
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.log = os.path.join(self.tmpdir, 'ansible.log')
+        self.templ = os.path.join(self.tmpdir, 'noop.yml')
+        with open(self.templ, 'w') as fout:
+            fout.write('- hosts: all\n  tasks: []\n')
+        bin_dir = os.path.join(os.path.dirname(__file__), 'data', 'bin')
+        env = {
+            'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+            'XDG_CACHE_HOME': self.tmpdir,
+            'XDG_DATA_HOME': self.tmpdir,
+            'ANSIBLE_STUB_LOG': self.log,
+        }
+        patcher = mock.patch.dict('os.environ', env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def runs(self):
+        "The ansible-playbook command lines run so far"
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as fin:
+            return fin.read().splitlines()
+
+    def isna(self, *args, stdin=''):
+        "Run isna with stdin piped. Return its exit code, stdout & stderr"
+        from contextlib import redirect_stdout, redirect_stderr
+        from io import StringIO
+        from unittest import mock
+        from isna.query import InputQuery
+        out, err = StringIO(), StringIO()
+        with redirect_stdout(out), redirect_stderr(err), \
+                mock.patch.object(InputQuery, 'input_file', StringIO(stdin)):
+            returncode = cli2.main(list(args))
+        return returncode, out.getvalue(), err.getvalue()
+
+
+class TestEach(StubTestCase):
+    "Run several templates without --batch"
+
+    def test_each(self):
+        failing = os.path.join(self.tmpdir, 'fail.yml')
+        with open(failing, 'w') as fout:
+            fout.write('- hosts: all\n  vars: {stub_fail: true}\n  tasks: []\n')
+        self.assertEqual(self.isna(failing, self.templ)[0], 2)
+        self.assertEqual(len(self.runs()), 2)
+
+
+class TestTempStorage(StubTestCase):
+    "Run isna with --temp-storage"
+
+    def playbook_path(self, *args):
+        "Run isna, return the path of the playbook given to ansible-playbook"
+        self.assertEqual(self.isna(*args, self.templ)[0], 0)
+        return self.runs()[-1].split()[0]
+
+    def test_temp_storage(self):
+        from unittest import mock
+        runtime_dir = os.path.join(self.tmpdir, 'run')
+        os.mkdir(runtime_dir, 0o700)
+        with mock.patch.dict('os.environ', XDG_RUNTIME_DIR=runtime_dir):
+            self.assertTrue(self.playbook_path('--temp-storage=tmpfs').startswith(runtime_dir + os.sep))
+            self.assertFalse(self.playbook_path().startswith(runtime_dir + os.sep))
+            if hasattr(os, 'memfd_create'):
+                self.assertTrue(self.playbook_path('--temp-storage=memfd').startswith('/dev/fd/'))
+        with self.assertRaises(ValueError):
+            self.playbook_path('--temp-storage=nfs')
+
+
+class TestUnchanged(StubTestCase):
+    "Run isna with --unchanged"
+
+    def test_skip(self):
+        self.assertEqual(self.isna('--unchanged=skip', self.templ)[0], 0)
+        self.assertEqual(len(self.runs()), 1)
+        self.assertEqual(self.isna('--unchanged=skip', self.templ)[0], 0)
+        self.assertEqual(len(self.runs()), 1)
+        self.assertEqual(self.isna('--unchanged=skip', '--vars=x=1', self.templ)[0], 0)
+        self.assertEqual(len(self.runs()), 2)
+        with open(self.templ, 'a') as fout:
+            fout.write('# changed\n')
+        self.assertEqual(self.isna('--unchanged=skip', '--vars=x=1', self.templ)[0], 0)
+        self.assertEqual(len(self.runs()), 3)
+
+    def test_skip_each(self):
+        "Each template is skipped on its own, keyed by its own variables"
+        other = os.path.join(self.tmpdir, 'other.yml')
+        with open(other, 'w') as fout:
+            fout.write('- hosts: all\n  name: <@ b @>\n  tasks: []\n')
+        with open(self.templ, 'w') as fout:
+            fout.write('- hosts: all\n  name: <@ a @>\n  tasks: []\n')
+        self.assertEqual(self.isna('--unchanged=skip', '--vars=a=1;b=1', other, self.templ)[0], 0)
+        self.assertEqual(len(self.runs()), 2)
+        # other.yml is skipped, noop.yml after it runs with its changed variable
+        self.assertEqual(self.isna('--unchanged=skip', '--vars=a=2;b=1', other, self.templ)[0], 0)
+        self.assertEqual(len(self.runs()), 3)
+
+    def test_check(self):
+        self.isna('--unchanged=check', self.templ)
+        self.isna('--unchanged=check', self.templ)
+        self.isna('--unchanged=run', self.templ)
+        self.isna(self.templ)
+        runs = self.runs()
+        self.assertEqual(['--check' in x.split() for x in runs], [False, True, False, False])
+
+
+class TestMatrix(StubTestCase):
+    "Run isna with --matrix"
+    rows = '{"who": "a"}\n\n{"who": "b", "stub_fail": true}\nwho=c\n{}\n'
+
+    def setUp(self):
+        super().setUp()
+        with open(self.templ, 'w') as fout:
+            fout.write('- hosts: all\n  name: <@ who @>\n  tasks: []\n')
+
+    def matrix(self, *args):
+        "Run isna with the rows on stdin. Return its exit code & the RC of each row"
+        returncode, out, err = self.isna('--matrix', *args, self.templ, stdin=self.rows)
+        lines = out.splitlines()
+        table = lines[lines.index(next(x for x in lines if x.startswith('ROW'))) + 1:]
+        return returncode, {int(x.split()[0]): x.split()[1] for x in table}
+
+    def test_fanout(self):
+        returncode, statuses = self.matrix('--forks=2')
+        self.assertEqual(returncode, 2)
+        self.assertEqual(statuses, {1: '0', 3: '2', 4: '0', 5: '-'})
+        self.assertEqual(len(self.runs()), 3)
+
+    def test_batch(self):
+        returncode, statuses = self.matrix('--batch', '--vars=who=z')
+        self.assertEqual(returncode, 2)
+        # Like ansible, the stub skips the plays after the failed one
+        self.assertEqual(statuses, {1: '0', 3: '2', 4: '-', 5: '-'})
+        self.assertEqual(len(self.runs()), 1)
+
+    def test_precedence(self):
+        "A row's ansible variables lose to --vars, with or without --batch"
+        for args in ([], ['--batch']):
+            with self.subTest(args=args):
+                returncode, statuses = self.matrix('--vars={"stub_fail": false}', *args)
+                self.assertEqual(returncode, 1)
+                self.assertEqual(statuses, {1: '0', 3: '0', 4: '0', 5: '-'})
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            self.matrix('--ssh=a,b')
+
+
+class TestSlowest(StubTestCase):
+    "The slowest tasks are printed after a run"
+
+    def slowest(self, *args):
+        "Run isna, return the table of the slowest tasks"
+        returncode, out, err = self.isna(*args, self.templ)
+        self.assertEqual(returncode, 0)
+        lines = out.splitlines()
+        start = lines.index(next(x for x in lines if x.split()[:2] == ['PLAY', 'TASK']))
+        return [x.split() for x in lines[start:]]
+
+    def test_each(self):
+        self.assertEqual(self.slowest()[:2], [['PLAY', 'TASK', 'HOST', 'SECONDS'],
+                                           ['all', 'stub', 'localhost', '0.00']])
+
+    def test_fanout(self):
+        table = self.slowest('--ssh=localhost,localhost:2222')
+        self.assertEqual(table[0], ['PLAY', 'TASK', 'HOST', 'SECONDS'])
+        self.assertEqual(len([x for x in table if x[:2] == ['all', 'stub']]), 2)
+
+    def test_disabled(self):
+        from unittest import mock
+        with mock.patch.dict(cfg, slowest_tasks=0):
+            with self.assertRaises(StopIteration):
+                self.slowest()
+
+
+class TestProfile(StubTestCase):
+    "Run isna with --profile"
+
+    def test_profile(self):
+        from isna import util
+        returncode, out, err = self.isna('--profile', '--vars=x=1', self.templ)
+        self.assertEqual(returncode, 0)
+        self.assertIsNone(util.timings)
+        phases = [x.split()[0] for x in err.splitlines()]
+        self.assertEqual(phases[0], 'PHASE')
+        for phase in ('docopt', 'validate', 'transform', 'parse', 'render', 'write', 'ansible'):
+            self.assertIn(phase, phases)
+        self.assertEqual(phases[-2:], ['other', 'total'])
+
+    def test_pstats(self):
+        import pstats
+        path = os.path.join(self.tmpdir, 'isna.pstats')
+        returncode, out, err = self.isna('--profile=' + path, self.templ)
+        self.assertEqual(returncode, 0)
+        self.assertIn('ansible', err)
+        stats = pstats.Stats(path)
+        self.assertTrue(any(x[2] == 'render' for x in stats.stats))
+
+
+class TestHistory(StubTestCase):
+    "Runs are recorded in the history, and summarized by 'isna stats'"
+
+    def test_stats(self):
+        self.assertEqual(self.isna(self.templ)[0], 0)
+        self.assertEqual(self.isna('--batch', self.templ)[0], 0)
+        self.assertEqual(self.isna('--ssh=localhost,localhost:2222', self.templ)[0], 0)
+        returncode, out, err = self.isna('stats')
+        self.assertEqual(returncode, 0)
+        templates, hosts, tasks = [
+            [x.split() for x in table.splitlines()] for table in out.strip().split('\n\n')
+        ]
+        self.assertEqual(templates[1][:3], ['noop.yml', '4', '0'])
+        self.assertEqual(sorted(x[:2] for x in hosts[1:]), [['localhost', '4']])
+        self.assertEqual(tasks[1][:3], ['all', 'stub', '4'])
+        returncode, out, err = self.isna('stats', '--days=0.5')
+        self.assertIn('noop.yml', out)
+
+    def test_disabled(self):
+        from unittest import mock
+        with mock.patch.dict(cfg, history=False):
+            self.isna(self.templ)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'isna', 'history.sqlite')))
+
+
+class TestRender(StubTestCase):
+    "Render templates with 'isna render', without running ansible"
+
+    def setUp(self):
+        super().setUp()
+        self.write('- hosts: all\n  name: <@ who @>\n')
+
+    def write(self, source):
+        with open(self.templ, 'w') as fout:
+            fout.write(source)
+
+    def render(self, *args, stdin=''):
+        "Run 'isna render'. Return its stdout & stderr"
+        returncode, out, err = self.isna('render', *args, self.templ, stdin=stdin)
+        self.assertEqual(returncode, 0)
+        return out, err
+
+    def test_render(self):
+        self.assertEqual(self.render('--vars=who=a')[0], '- hosts: all\n  name: a\n')
+        self.assertEqual(self.render(stdin='{"who": "b"}')[0], '- hosts: all\n  name: b\n')
+        path = os.path.join(self.tmpdir, 'out.yml')
+        self.assertEqual(self.render('--vars=who=a', '--out=' + path)[0], '')
+        with open(path) as fin:
+            self.assertEqual(fin.read(), '- hosts: all\n  name: a\n')
+        os.chmod(path, 0o640)
+        self.render('--vars=who=b', '--out=' + path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(self.runs(), [])
+        # Renders are only kept for --diff
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'isna', 'renders')))
+
+    def test_diff(self):
+        out, err = self.render('--vars=who=a', '--diff')
+        self.assertIn('no earlier render', err)
+        self.assertIn('+  name: a', out.splitlines())
+        self.write('- hosts: all\n  name: "<@ who @>"\n')
+        out, err = self.render('--vars=who=a', '--diff')
+        self.assertEqual(err, '')
+        self.assertEqual(out.splitlines()[-2:], ['-  name: a', '+  name: "a"'])
+        out, err = self.render('--vars=who=a', '--diff')
+        self.assertEqual(out, '')
+        out, err = self.render('--vars=who=b', '--diff')
+        self.assertIn('no earlier render', err)
+
+    def test_diff_secret(self):
+        self.write('- hosts: all\n  name: <@ my_password @>\n')
+        for i in range(2):
+            out, err = self.render('--vars=my_password=a', '--diff')
+            self.assertIn('not kept', err)
+            self.assertIn('+  name: a', out.splitlines())
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'isna', 'renders')))
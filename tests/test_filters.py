@@ -0,0 +1,110 @@
+import unittest
+
+from isna import filters
+
+try:
+    from ansible.plugins.filter.core import FilterModule
+except ImportError:
+    FilterModule = None
+
+
+class TestFilters(unittest.TestCase):
+
+    def test_load(self):
+        for name in filters.registry:
+            with self.subTest(name=name):
+                self.assertTrue(callable(filters.load(name)))
+        with self.assertRaises(KeyError):
+            filters.load('no_such_filter')
+
+    def test_password_hash(self):
+        hashed = filters.password_hash('secret')
+        self.assertTrue(hashed.startswith('$6$'))
+        self.assertEqual(len(hashed.split('$')[2]), 16)
+        self.assertNotEqual(hashed, filters.password_hash('secret'))
+        hashed = filters.password_hash('secret', 'sha256', salt='abcdefgh', rounds=6000)
+        self.assertTrue(hashed.startswith('$5$rounds=6000$abcdefgh$'))
+
+    def test_regex_replace_count(self):
+        self.assertEqual(filters.regex_replace('aaa', 'a', 'b', count=2), 'bba')
+        self.assertEqual(filters.regex_replace('aaa', 'a', 'b', mandatory_count=3), 'bbb')
+        with self.assertRaises(ValueError):
+            filters.regex_replace('aaa', 'a', 'b', mandatory_count=2)
+
+    def test_to_json(self):
+        import datetime
+        from types import MappingProxyType
+        value = {'d': datetime.date(2020, 1, 2), 'm': MappingProxyType({'a': 1})}
+        self.assertEqual(filters.to_json(value), '{"d": "2020-01-02", "m": {"a": 1}}')
+        self.assertEqual(filters.to_nice_json(value), '{\n    "d": "2020-01-02",\n    "m": {\n        "a": 1\n    }\n}')
+
+
+@unittest.skipIf(FilterModule is None, 'ansible is not installed')
+class TestLikeAnsible(unittest.TestCase):
+    "isna's filters give the same results as ansible's"
+    calls = [
+        ('b64decode', ('aMOpbGxv',), {}),
+        ('b64encode', ('héllo',), {}),
+        ('b64encode', (b'bytes',), {}),
+        ('basename', ('/a/b/c.txt',), {}),
+        ('bool', ('Yes',), {}),
+        ('bool', ('off',), {}),
+        ('bool', (1,), {}),
+        ('bool', (None,), {}),
+        ('dirname', ('/a/b/c.txt',), {}),
+        ('expanduser', ('~/x',), {}),
+        ('from_json', ('{"a": [1, 2]}',), {}),
+        ('from_yaml', ('a: [1, 2]\nb: x',), {}),
+        ('from_yaml', ({'a': 1},), {}),
+        ('hash', ('text',), {}),
+        ('hash', ('text', 'md5'), {}),
+        ('password_hash', ('secret', 'sha512', 'saltsaltsaltsalt'), {}),
+        ('password_hash', ('secret', 'sha256', 'saltsalt'), {'rounds': 10000}),
+        ('password_hash', ('secret', 'md5', 'saltsalt'), {}),
+        ('quote', ("it's a test",), {}),
+        ('quote', (None,), {}),
+        ('realpath', ('/tmp/../tmp',), {}),
+        ('regex_escape', ('a.b*c',), {}),
+        ('regex_escape', ('a.b*c', 'posix_basic'), {}),
+        ('regex_replace', ('Hello World', 'o', '0'), {}),
+        ('regex_replace', ('a\nB', '^b', 'c'), {'ignorecase': True, 'multiline': True}),
+        ('regex_replace', (42, '2', '3'), {}),
+        ('ternary', (True, 'y', 'n'), {}),
+        ('ternary', (None, 'y', 'n', 'none'), {}),
+        ('ternary', ([], 'y', 'n'), {}),
+        ('to_json', ({'a': [1, 'é']},), {}),
+        ('to_nice_json', ({'b': 1, 'a': {'c': None}},), {}),
+        ('to_yaml', ({'a': [1, 2], 'b': 'é'},), {}),
+        ('to_nice_yaml', ({'a': [1, {'b': 2}]},), {}),
+    ]
+
+    def test_json_like_ansible(self):
+        "to_json & to_nice_json encode ansible's types like ansible"
+        import datetime
+        from ansible.parsing.yaml.objects import AnsibleVaultEncryptedUnicode
+        from ansible.utils.unsafe_proxy import AnsibleUnsafeText
+        from ansible.vars.hostvars import HostVarsVars
+        ansible_filters = FilterModule().filters()
+        vault = AnsibleVaultEncryptedUnicode(b'$ANSIBLE_VAULT;1.1;AES256\n6162')
+        value = {
+            'unsafe': AnsibleUnsafeText('{{ x }}'),
+            'list': [AnsibleUnsafeText('y'), 1],
+            'time': datetime.datetime(2020, 1, 2, 3, 4, 5),
+            'hostvars': HostVarsVars({'a': 1}, loader=None),
+        }
+        for name, args, kwargs in [
+            ('to_json', (value,), {}),
+            ('to_json', (value,), {'preprocess_unsafe': True}),
+            ('to_nice_json', (value,), {'preprocess_unsafe': True}),
+            ('to_json', ([vault],), {'vault_to_text': False}),
+        ]:
+            with self.subTest(name=name, kwargs=kwargs):
+                expected = ansible_filters[name](*args, **kwargs)
+                self.assertEqual(filters.load(name)(*args, **kwargs), expected)
+
+    def test_like_ansible(self):
+        ansible_filters = FilterModule().filters()
+        for name, args, kwargs in self.calls:
+            with self.subTest(name=name, args=args, kwargs=kwargs):
+                expected = ansible_filters[name](*args, **kwargs)
+                self.assertEqual(filters.load(name)(*args, **kwargs), expected)
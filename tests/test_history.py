@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from isna import history
+from isna.playbook import task_time
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'sub', 'history.sqlite')
+
+    def record(self, template='a.yml', seconds=1.0, returncode=0):
+        hist = history.History('each', path=self.path)
+        hist.record_run(template, 'key', 'h1', returncode, seconds)
+        hist.record_tasks([task_time('p', 't', 'h1', seconds / 2)])
+        hist.close(returncode, {'render': [1, 0.5]})
+        self.assertIsNone(hist.error)
+
+    def test_record(self):
+        self.record()
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute('SELECT mode, returncode FROM commands').fetchall(),
+                         [('each', 0)])
+        self.assertEqual(db.execute('SELECT template, key, host, returncode, seconds FROM runs')
+                         .fetchall(), [('a.yml', 'key', 'h1', 0, 1.0)])
+        self.assertEqual(db.execute('SELECT play, task, host, seconds FROM tasks').fetchall(),
+                         [('p', 't', 'h1', 0.5)])
+        self.assertEqual(db.execute('SELECT name, calls, seconds FROM phases').fetchall(),
+                         [('render', 1, 0.5)])
+        db.close()
+
+    def test_nothing_recorded(self):
+        history.History('each', path=self.path).close(0)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_ttl(self):
+        self.record()
+        hist = history.History('each', path=self.path, ttl=1)
+        hist.start += 10
+        hist.record_run('b.yml', 'key', 'h1', 0, 1.0)
+        hist.close(0)
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute('SELECT template FROM runs').fetchall(), [('b.yml',)])
+        self.assertEqual(db.execute('SELECT count(*) FROM commands').fetchone(), (1,))
+        self.assertEqual(db.execute('SELECT count(*) FROM phases').fetchone(), (0,))
+        db.close()
+
+    def test_error(self):
+        with open(os.path.dirname(self.path), 'w'):
+            pass  # A file where the directory should be
+        hist = history.History('each', path=self.path)
+        hist.record_run('a.yml', 'key', 'h1', 0, 1.0)
+        from contextlib import redirect_stderr
+        from io import StringIO
+        err = StringIO()
+        with redirect_stderr(err):
+            hist.close(0)
+        self.assertIsNotNone(hist.error)
+        self.assertIn('could not record', err.getvalue())
+
+    def test_stats(self):
+        for seconds in (1.0, 2.0, 3.0, 4.0):
+            self.record(seconds=seconds)
+        self.record('b.yml', returncode=2)
+        templates, hosts, tasks = history.stats(path=self.path)
+        self.assertEqual(templates[0], ('TEMPLATE', 'RUNS', 'FAILED', 'P50', 'P95', 'TREND'))
+        self.assertEqual(templates[1], [('a.yml', 4, 0, 2.0, 4.0, '+200%'),
+                                        ('b.yml', 1, 1, 1.0, 1.0, None)])
+        self.assertEqual(hosts[1], [('h1', 5, 1, 2.0, 4.0, '+0%')])
+        self.assertEqual(tasks[1], [('p', 't', 5, 1.0, 2.0, '+0%')])
+        templates, hosts, tasks = history.stats(days=1, path=self.path)
+        self.assertEqual(len(templates[1]), 2)
+
+    def test_percentile(self):
+        self.assertEqual(history.percentile([3, 1, 2], 50), 2)
+        self.assertEqual(history.percentile([1], 95), 1)
+        self.assertEqual(history.percentile(list(range(1, 101)), 95), 95)
+        self.assertEqual(history.percentile([1, 2], 0), 1)
+
+    def test_trend(self):
+        self.assertIsNone(history.trend([1, 2, 3]))
+        self.assertEqual(history.trend([2, 2, 1, 1]), '-50%')
+        self.assertEqual(history.trend([1, 1, 5, 1, 1]), '+0%')
@@ -0,0 +1,90 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from isna import index
+from isna import playbook as pb
+from isna.config import cfg
+
+
+class TestTemplateIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.templ_dir = os.path.join(self.tmpdir, 'templates')
+        shutil.copytree(self.data_dir, self.templ_dir)
+        self.index_path = os.path.join(self.tmpdir, 'index.json')
+
+    def get_index(self):
+        return index.TemplateIndex(self.templ_dir, *cfg['templ_dirs'], path=self.index_path)
+
+    def test_names(self):
+        idx = self.get_index()
+        pbm = pb.PBMaker(self.templ_dir, *cfg['templ_dirs'])
+        self.assertEqual(idx.names(), pbm.list_templates())
+        self.assertEqual(idx.names(cfg['templ_ext']), pbm.list_templates(cfg['templ_ext']))
+        self.assertIn('create-user.yml', idx.names())
+
+    def test_is_template(self):
+        idx = self.get_index()
+        self.assertTrue(idx.is_template('create-user.yml'))
+        self.assertTrue(idx.is_template('playbook1.yml'))
+        self.assertFalse(idx.is_template('nope-create-nothin.yml'))
+        self.assertFalse(idx.is_template('create-user.yml', ['json']))
+
+    def test_refresh(self):
+        self.get_index().names()
+        self.assertTrue(os.path.isfile(self.index_path))
+        os.mkdir(os.path.join(self.templ_dir, 'sub'))
+        with open(os.path.join(self.templ_dir, 'sub', 'new.yml'), 'w') as fout:
+            fout.write('<@ new_var @>')
+        # Bump the mtime, in case the filesystem's resolution is coarse
+        os.utime(self.templ_dir, (1, 1))
+        idx = self.get_index()
+        self.assertIn('sub/new.yml', idx.names())
+        self.assertEqual(idx.variables('sub/new.yml'), {'new_var'})
+
+    def test_variables(self):
+        idx = self.get_index()
+        self.assertEqual(idx.variables('include-parent.yml'), {'alpha', 'delta', 'epsilon'})
+        # A warm index doesn't need jinja
+        with mock.patch('isna.playbook.PBMaker') as pbmaker:
+            idx = self.get_index()
+            self.assertEqual(idx.variables('include-parent.yml'), {'alpha', 'delta', 'epsilon'})
+            self.assertFalse(pbmaker.called)
+        # Changing an included template updates the variables
+        shared = os.path.join(self.templ_dir, 'include-shared.yml')
+        with open(shared, 'w') as fout:
+            fout.write('<@ zeta @>')
+        os.utime(shared, (1, 1))
+        idx = self.get_index()
+        self.assertEqual(idx.variables('include-parent.yml'), {'alpha', 'delta', 'zeta'})
+
+    def test_prune(self):
+        "Saving an index deletes the indexes of other dir sets which weren't used for ttl seconds"
+        import time
+        with mock.patch.dict('os.environ', XDG_CACHE_HOME=self.tmpdir):
+            cache = os.path.join(self.tmpdir, 'isna')
+            os.mkdir(cache)
+            for name, age in (('templates-old.json', 3600), ('templates-new.json', 60), ('other.json', 3600)):
+                path = os.path.join(cache, name)
+                with open(path, 'w') as fout:
+                    fout.write('{}')
+                os.utime(path, (time.time() - age, time.time() - age))
+            idx = index.TemplateIndex(self.templ_dir, ttl=600)
+            idx.names()
+            self.assertEqual(sorted(os.listdir(cache)),
+                             sorted(['other.json', 'templates-new.json', os.path.basename(idx.path)]))
+            # An index in use is written again now & then, so it isn't pruned
+            os.utime(idx.path, (1, 1))
+            index.TemplateIndex(self.templ_dir, ttl=600).names()
+            self.assertGreater(os.stat(idx.path).st_mtime, time.time() - 60)
+            index.TemplateIndex(self.templ_dir, ttl=600).names()
+            self.assertTrue(os.path.exists(idx.path))
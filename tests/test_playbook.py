@@ -28,11 +28,103 @@ class TestJinjaEnv(unittest.TestCase):
         loader = pb.get_env()
         self.assertIsInstance(loader, jinja2.Environment)
 
-    def test_get_undefined(self):
-        env = pb.get_env(self.data_dir)
-        templ = env.get_template('playbook1.yml')
-        undef = pb.get_undefined(templ)
-        self.assertCountEqual(undef, {'alpha', 'beta', 'gamma'})
+    def test_bytecode_cache(self):
+        import tempfile
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': tmpdir}):
+                env = pb.get_env(self.data_dir, bytecode_cache=True)
+                self.assertIsInstance(env.bytecode_cache, jinja2.FileSystemBytecodeCache)
+                out = env.get_template('playbook1.yml').render(alpha=1, beta=2, gamma=3)
+                cache_dir = env.bytecode_cache.directory
+                self.assertTrue(os.listdir(cache_dir))
+                env = pb.get_env(self.data_dir, bytecode_cache=True)
+                out2 = env.get_template('playbook1.yml').render(alpha=1, beta=2, gamma=3)
+                self.assertEqual(out, out2)
+        env = pb.get_env(self.data_dir, bytecode_cache=False)
+        self.assertIsNone(env.bytecode_cache)
+
+    def test_bytecode_cache_filters(self):
+        "Templates loaded from the bytecode cache still get the filters of isna.filters"
+        import tempfile
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.dict('os.environ', {'XDG_CACHE_HOME': tmpdir}):
+                for i in range(2):
+                    pbm = pb.PBMaker(self.data_dir)
+                    out = pbm.render('playbook-filter.yml')
+                    self.assertIn(os.path.expanduser('~'), out)
+
+    def test_filters(self):
+        "Filters of isna.filters are loaded without ansible, others from ansible"
+        import subprocess
+        import sys
+        import tempfile
+        code = (
+            'import sys; from isna.playbook import PBMaker; '
+            'out = PBMaker(sys.argv[1]).render(sys.argv[2]); '
+            'print("ansible" in sys.modules, out.strip())'
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ, XDG_CACHE_HOME=tmpdir,
+                       PYTHONPATH=os.path.dirname(os.path.dirname(pb.__file__)))
+            templates = {
+                'isna.yml': "<@ 'x' | password_hash('sha512', 'salt') | length > 20 @>",
+                'ansible.yml': '<@ [1, [2, [3]]] | flatten | to_json @>',
+            }
+            for name, source in templates.items():
+                with open(os.path.join(tmpdir, name), 'w') as fout:
+                    fout.write(source)
+            res = subprocess.run([sys.executable, '-c', code, tmpdir, 'isna.yml'], env=env,
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            self.assertEqual(res.stdout, 'False True\n')
+            try:
+                import ansible  # noqa
+            except ImportError:
+                return
+            res = subprocess.run([sys.executable, '-c', code, tmpdir, 'ansible.yml'], env=env,
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            self.assertEqual(res.stdout, 'True [1, 2, 3]\n')
+
+
+class TestAnsibleArgs(unittest.TestCase):
+
+    def test_from_ssh(self):
+        args = pb.AnsibleArgs.from_ssh()
+        self.assertEqual(args, {'ansible_connection': 'local'})
+        args = pb.AnsibleArgs.from_ssh(user='me', host='h', port=2222)
+        self.assertEqual(args, {'ansible_user': 'me', 'ansible_port': 2222})
+
+    def test_from_ssh_control(self):
+        from isna.util import SSHControl
+        control = SSHControl(persist='5m', directory='/some/dir')
+        args = pb.AnsibleArgs.from_ssh(user='me', host='h', control=control)
+        self.assertIn('ControlPath=/some/dir/%C', args['ansible_ssh_common_args'])
+        self.assertIn('ControlPersist=5m', args['ansible_ssh_common_args'])
+
+
+class TestCallbackPlugins(unittest.TestCase):
+    "isna's callback dir is added to the callback plugin path which ansible would use"
+
+    def test_callback_plugins(self):
+        import tempfile
+        from unittest import mock
+        join = os.pathsep.join
+        with mock.patch.object(pb, '_ansible_cfg', return_value=None):
+            self.assertEqual(pb._callback_plugins({}),
+                             join([pb._callback_dir, pb._default_callback_plugins]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = {'ANSIBLE_CONFIG': tmpdir}
+            with open(os.path.join(tmpdir, 'ansible.cfg'), 'w') as fout:
+                fout.write('[defaults]\ncallback_plugins = plugins:/abs/plugins ; mine\n')
+            self.assertEqual(pb._callback_plugins(env),
+                             join([pb._callback_dir, os.path.join(tmpdir, 'plugins'), '/abs/plugins']))
+            env['ANSIBLE_CALLBACK_PLUGINS'] = '/env/plugins'
+            self.assertEqual(pb._callback_plugins(env), join([pb._callback_dir, '/env/plugins']))
+            with mock.patch.dict('os.environ', env), \
+                    pb.AnsiblePlaybook('- hosts: all', ['localhost']) as apb:
+                self.assertEqual(apb.environment['ANSIBLE_CALLBACK_PLUGINS'],
+                                 join([pb._callback_dir, '/env/plugins']))
 
 
 class TestPBMaker(unittest.TestCase):
@@ -65,6 +157,46 @@ class TestPBMaker(unittest.TestCase):
         all_vars = pbm.all_vars(self.ex_templ_name)
         self.assertCountEqual(all_vars, self.ex_all_vars)
 
+    def test_template_info(self):
+        pbm = pb.PBMaker(self.data_dir)
+        info = pbm.template_info(self.ex_templ_name)
+        self.assertIsInstance(info.template, jinja2.Template)
+        self.assertIsInstance(info.ast, jinja2.nodes.Template)
+        self.assertCountEqual(info.variables, self.ex_all_vars)
+        self.assertIs(pbm.get_template(self.ex_templ_name), info.template)
+
+    def test_single_parse(self):
+        "Variables & rendering of a template only parse its source once"
+        from unittest import mock
+        for bytecode_cache in (False, True):
+            pbm = pb.PBMaker(self.data_dir)
+            pbm._environment = pb.get_env(self.data_dir, bytecode_cache=bytecode_cache)
+            with mock.patch.object(pbm.environment, 'parse', wraps=pbm.environment.parse) as parse:
+                pbm.all_vars(self.ex_templ_name)
+                pbm.undef_vars(self.ex_templ_name)
+                pbm.render(self.ex_templ_name, alpha=1, beta=2, gamma=3)
+                self.assertEqual(parse.call_count, 1)
+
+    def test_all_vars_includes(self):
+        pbm = pb.PBMaker(self.data_dir)
+        self.assertCountEqual(pbm.all_vars('include-child.yml'), {'beta', 'delta', 'epsilon'})
+        self.assertCountEqual(pbm.all_vars('include-parent.yml'), {'alpha', 'delta', 'epsilon'})
+        self.assertEqual(
+            pbm.dependencies('include-parent.yml'),
+            ['include-parent.yml', 'include-child.yml', 'include-shared.yml'],
+        )
+        out = pbm.render('include-parent.yml', alpha='A', delta='D', epsilon='E')
+        self.assertEqual(out.split(), ['A', 'b', 'D', 'E', 'E'])
+
+    def test_all_vars_shared_once(self):
+        "Templates included more than once are only parsed once"
+        from unittest import mock
+        pbm = pb.PBMaker(self.data_dir)
+        with mock.patch.object(pbm.environment, 'parse', wraps=pbm.environment.parse) as parse:
+            pbm.all_vars('include-parent.yml')
+            pbm.all_vars('include-child.yml')
+            self.assertEqual(parse.call_count, 3)
+
     def test_undef_vars(self):
         pbm = pb.PBMaker(self.data_dir)
         undef = pbm.undef_vars(self.ex_templ_name)
@@ -93,3 +225,271 @@ class TestPBMaker(unittest.TestCase):
         res = '\n'.join([str(i) for i, x in enumerate(exv)])
         out = pbm.render(self.ex_templ_name, **new_d)
         self.assertEqual(res, out)
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_merge_playbooks(self):
+        pb1 = '---\n- hosts: all\n  tasks: []\n'
+        pb2 = '- hosts: all\n  name: b1\n- hosts: all\n  name: b2\n'
+        txt, names = pb.merge_playbooks([('one.yml', pb1), ('two.yml', pb2)])
+        import yaml
+        plays = yaml.safe_load(txt)
+        self.assertEqual(len(plays), 3)
+        self.assertEqual([x.get('name') for x in plays], [None, 'b1', 'b2'])
+        self.assertEqual(names, ['one.yml', 'two.yml', 'two.yml'])
+
+    def test_merge_playbooks_tags(self):
+        vault = ('- hosts: all\n'
+                 '  vars:\n'
+                 '    secret: !vault |\n'
+                 '      $ANSIBLE_VAULT;1.1;AES256\n'
+                 '      6238\n'
+                 "    other: !unsafe '{{ x }}'\n"
+                 '  tasks: []\n')
+        pb2 = '- {hosts: all, name: b1}\n'
+        txt, names = pb.merge_playbooks([('vault.yml', vault), ('two.yml', pb2)])
+        self.assertEqual(txt, '---\n' + vault + pb2)
+        txt, names = pb.merge_playbooks([('vault.yml', vault), ('two.yml', pb2)],
+                                        [{'other': 1, 'row': 'a'}, {'row': 'b'}])
+        self.assertEqual(names, ['vault.yml', 'two.yml'])
+        self.assertIn('secret: !vault |\n      $ANSIBLE_VAULT;1.1;AES256\n      6238\n', txt)
+        import yaml
+        loader = type('Loader', (yaml.SafeLoader,), {})
+        loader.add_multi_constructor('!', lambda loader, tag, node: (tag, node.value))
+        plays = yaml.load(txt, Loader=loader)
+        self.assertEqual(plays[0]['vars'], {'secret': ('vault', '$ANSIBLE_VAULT;1.1;AES256\n6238\n'),
+                                            'other': 1, 'row': 'a'})
+        self.assertEqual(plays[1], {'hosts': 'all', 'name': 'b1', 'vars': {'row': 'b'}})
+
+    def test_play_results(self):
+        events = [
+            {'event': 'play_start', 'play': 'p1', 'time': 10.0},
+            {'event': 'ok', 'host': 'h', 'task': 't', 'time': 11.0},
+            {'event': 'ignored', 'host': 'h', 'task': 't', 'time': 12.0},
+            {'event': 'play_start', 'play': 'p2', 'time': 13.0},
+            {'event': 'failed', 'host': 'h', 'task': 't', 'time': 14.0},
+            {'event': 'play_start', 'play': 'p3', 'time': 15.0},
+            {'event': 'stats', 'time': 16.0},
+        ]
+        res = pb.play_results(events, ['a.yml', 'a.yml', 'b.yml'])
+        self.assertEqual([x.returncode for x in res], [0, 2, None])
+        self.assertEqual([x.duration for x in res], [2.0, 1.0, 1.0])
+        self.assertEqual([x.template for x in res], ['a.yml', 'a.yml', 'b.yml'])
+        res = pb.play_results(events)
+        self.assertEqual([x.template for x in res], [None] * 3)
+
+    def test_host_results(self):
+        events = [
+            {'event': 'play_start', 'play': 'p1', 'time': 10.0},
+            {'event': 'ok', 'host': 'h1', 'task': 't', 'time': 11.0},
+            {'event': 'ok', 'host': 'h1', 'task': 't', 'time': 11.0},
+            {'event': 'unreachable', 'host': 'h2', 'task': 't', 'time': 11.0},
+            {'event': 'stats', 'time': 16.0},
+        ]
+        res = pb.host_results(events)
+        self.assertEqual(res, {'h1': {'ok': 2}, 'h2': {'unreachable': 1}})
+
+    def test_become_failures(self):
+        events = [
+            {'event': 'failed', 'host': 'h1', 'task': 't', 'time': 11.0, 'text': 'Missing sudo password'},
+            {'event': 'failed', 'host': 'h2', 'task': 't', 'time': 11.0, 'text': 'No such file'},
+            {'event': 'failed', 'host': 'h3', 'task': 't', 'time': 11.0},
+            {'event': 'unreachable', 'host': 'h4', 'task': 't', 'time': 11.0, 'text': 'Permission denied'},
+            {'event': 'ok', 'host': 'h5', 'task': 't', 'time': 11.0},
+        ]
+        self.assertEqual(pb.become_failures(events), {'h1'})
+
+    def test_task_times(self):
+        events = [
+            {'event': 'play_start', 'play': 'p1', 'time': 10.0},
+            {'event': 'start', 'host': 'h1', 'task': 't1', 'time': 10.0},
+            {'event': 'ok', 'host': 'h1', 'task': 't1', 'time': 11.0, 'duration': 1.0},
+            {'event': 'changed', 'host': 'h2', 'task': 't1', 'time': 13.0, 'duration': 3.0},
+            {'event': 'play_start', 'play': 'p2', 'time': 13.0},
+            {'event': 'failed', 'host': 'h1', 'task': 't2', 'time': 15.0, 'duration': 2.0},
+            {'event': 'skipped', 'host': 'h2', 'task': 't2', 'time': 15.0, 'duration': None},
+            {'event': 'stats', 'time': 16.0},
+        ]
+        self.assertEqual(pb.task_times(events), [
+            ('p1', 't1', 'h2', 3.0),
+            ('p2', 't2', 'h1', 2.0),
+            ('p1', 't1', 'h1', 1.0),
+        ])
+
+
+class TestStream(unittest.TestCase):
+    "Test AnsiblePlaybook.stream using the ansible-playbook stub in tests/data/bin"
+
+    def setUp(self):
+        from unittest import mock
+        bin_dir = os.path.join(os.path.dirname(__file__), 'data', 'bin')
+        path = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        patcher = mock.patch.dict('os.environ', {'PATH': path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stream(self):
+        with pb.AnsiblePlaybook('---\n', ['h1', 'failhost']) as apb:
+            events = list(apb.stream())
+        self.assertEqual(apb.returncode, 2)
+        self.assertTrue(all(isinstance(x, pb.run_event) for x in events))
+        kinds = [x.kind for x in events]
+        self.assertEqual(kinds, ['play_start', 'task_start', 'start', 'ok',
+                                 'start', 'failed', 'stats'])
+        self.assertEqual(pb.host_results(events), {'h1': {'ok': 1}, 'failhost': {'failed': 1}})
+        self.assertEqual([x.returncode for x in pb.play_results(events)], [2])
+
+    def test_capture(self):
+        with pb.AnsiblePlaybook('---\n', ['h1']) as apb:
+            events = list(apb.stream(capture=True))
+        self.assertEqual(apb.returncode, 0)
+        output = [x.text for x in events if x.kind == 'output']
+        self.assertEqual(output, ['PLAY [all]', 'ok: [h1]'])
+        self.assertEqual(len(events), 5 + len(output))
+
+    def test_close_early(self):
+        import time
+        start = time.monotonic()
+        with pb.AnsiblePlaybook('---\n', ['slowhost']) as apb:
+            stream = apb.stream()
+            for ev in stream:
+                if ev.kind == 'start':
+                    break
+            stream.close()
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIsNone(apb.returncode)
+
+    def test_storage(self):
+        for storage in ('disk', 'tmpfs', 'memfd'):
+            with self.subTest(storage=storage):
+                apb = pb.AnsiblePlaybook('---\n', ['h1'], secret='x')
+                apb.storage = storage
+                with apb:
+                    path = apb.tempfile_path(apb.temp_playbook)
+                    with open(apb.tempfile_path(apb.temp_extra_vars)) as fin:
+                        self.assertIn('secret', fin.read())
+                    out = apb.run(capture=True)
+                    events = apb.report()
+                self.assertEqual(out.returncode, 0)
+                self.assertEqual(pb.host_results(events), {'h1': {'ok': 1}})
+                if storage == 'memfd':
+                    self.assertTrue(path.startswith('/dev/fd/'))
+                else:
+                    self.assertFalse(os.path.exists(path))
+                if storage == 'tmpfs' and pb._tmpfs_dir() is not None:
+                    self.assertEqual(os.path.dirname(path), pb._tmpfs_dir())
+
+    def test_from_dict(self):
+        ev = pb.run_event.from_dict({'event': 'ok', 'host': 'h', 'task': 't',
+                                     'time': 1.0, 'duration': 0.5, 'other': 1})
+        self.assertEqual(ev, pb.run_event('ok', None, 't', 'h', 1.0, 0.5, None))
+
+
+class TestAsyncStream(unittest.TestCase):
+    "Test AsyncAnsiblePlaybook using the ansible-playbook stub in tests/data/bin"
+
+    setUp = TestStream.setUp
+
+    def arun(self, coro):
+        import asyncio
+        return asyncio.run(coro)
+
+    async def collect(self, hosts, **kwargs):
+        async with pb.AsyncAnsiblePlaybook('---\n', hosts) as apb:
+            events = [ev async for ev in apb.stream(**kwargs)]
+        return apb.returncode, events
+
+    def test_stream(self):
+        rc, events = self.arun(self.collect(['h1', 'failhost'], capture=True))
+        self.assertEqual(rc, 2)
+        self.assertEqual(pb.host_results(events), {'h1': {'ok': 1}, 'failhost': {'failed': 1}})
+        output = [x.text for x in events if x.kind == 'output']
+        self.assertEqual(output, ['PLAY [all]', 'ok: [h1]', 'failed: [failhost]'])
+
+    def test_run(self):
+        async def run():
+            async with pb.AsyncAnsiblePlaybook('---\n', ['h1']) as apb:
+                return await apb.run(capture=True)
+        out = self.arun(run())
+        self.assertEqual(out.returncode, 0)
+        self.assertEqual(out.stdout, 'PLAY [all]\nok: [h1]\n')
+
+    def test_timeout(self):
+        import asyncio
+        import time
+        start = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError):
+            self.arun(self.collect(['slowhost'], timeout=0.5))
+        self.assertLess(time.monotonic() - start, 10)
+
+    def test_cancel(self):
+        import asyncio
+
+        async def cancel():
+            task = asyncio.ensure_future(self.collect(['slowhost']))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.arun(asyncio.wait_for(cancel(), 10))
+
+    def test_concurrent(self):
+        import asyncio
+
+        async def many():
+            runs = [self.collect(['h{}'.format(i)]) for i in range(50)]
+            return await asyncio.gather(*runs)
+        results = self.arun(many())
+        self.assertEqual([rc for rc, _ in results], [0] * 50)
+        for i, (_, events) in enumerate(results):
+            self.assertEqual(pb.host_results(events), {'h{}'.format(i): {'ok': 1}})
+
+
+try:
+    import ansible
+except ImportError:
+    ansible = None
+
+
+@unittest.skipIf(ansible is None, 'ansible is not installed')
+class TestInProcess(unittest.TestCase):
+    "Run playbooks on localhost with InProcessPlaybook"
+    playbook = (
+        '- hosts: all\n'
+        '  gather_facts: no\n'
+        '  tasks:\n'
+        '    - debug: msg={{ msg }}\n'
+        '    - fail: msg=oops\n'
+        '      when: fail | bool\n'
+    )
+
+    def get_pb(self, fail=False):
+        import sys
+        return pb.InProcessPlaybook(
+            self.playbook, ['localhost'], ansible_connection='local',
+            ansible_python_interpreter=sys.executable, msg='hello', fail=fail,
+        )
+
+    def test_run(self):
+        with self.get_pb() as apb:
+            out = apb.run(capture=True)
+            events = apb.report()
+        self.assertEqual(out.returncode, 0)
+        self.assertIn('hello', out.stdout)
+        self.assertEqual(pb.host_results(events), {'localhost': {'ok': 1, 'skipped': 1}})
+
+    def test_stream(self):
+        with self.get_pb(fail=True) as apb:
+            events = list(apb.stream(capture=True))
+        self.assertEqual(apb.returncode, 2)
+        self.assertEqual(pb.host_results(events), {'localhost': {'ok': 1, 'failed': 1}})
+        output = '\n'.join(x.text for x in events if x.kind == 'output')
+        self.assertIn('oops', output)
+
+    def test_parse_error(self):
+        with pb.InProcessPlaybook('- hosts: all\n  tasks: [{nosuchmodule: }]\n',
+                                  ['localhost']) as apb:
+            out = apb.run(capture=True)
+        self.assertEqual(out.returncode, 4)
+        self.assertIn('ERROR!', out.stdout)
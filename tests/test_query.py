@@ -0,0 +1,90 @@
+import io
+import unittest
+from unittest import mock
+
+from isna import query
+from isna import util
+
+
+class Lines(io.StringIO):
+    "A StringIO which counts the lines read"
+    read_lines = 0
+
+    def readline(self, size=-1):
+        self.read_lines += 1
+        return super().readline(size)
+
+
+class TestPipeVars(unittest.TestCase):
+    inputs = (
+        '{"a": 1, "b": [1, 2,\n 3], "c": {"d": "x;y"}, "e": 12345678901234567890}',
+        'a=1; b=two; c=[1,\n 2]',
+        'username=woofdawg;new_usr_password=xx;',
+        'cmd=echo a\\; echo b;user=root\\;x',
+        '',
+        '  \n',
+        '{}',
+    )
+
+    def parse(self, text):
+        return dict(query._PipeVars(io.StringIO(text)))
+
+    def test_like_dict_from_str(self):
+        for chunk_size in (1, 3, 2**16):
+            for text in self.inputs:
+                with self.subTest(text=text, chunk_size=chunk_size), \
+                        mock.patch.object(query._PipeVars, 'chunk_size', chunk_size):
+                    expected = util.dict_from_str(text) if text.strip() else {}
+                    self.assertEqual(self.parse(text), expected)
+
+    def test_json_lines(self):
+        self.assertEqual(self.parse('{"a": 1}\n{"b": 2}\n\n{"c": 3}'), {'a': 1, 'b': 2, 'c': 3})
+
+    def test_invalid(self):
+        for text in ('{"a" 1}', '{"a": 1,}', '{"a": 1} x', '{1: 2}', '{"a": [1, 2'):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                self.parse(text)
+
+    def test_newline(self):
+        "A newline is read as a space, also inside a json string"
+        text = '{"a": "x\ny", "b": 1}\n'
+        self.assertEqual(self.parse(text), {'a': 'x y', 'b': 1})
+        self.assertEqual(self.parse(text), util.dict_from_str(text))
+
+    def test_large(self):
+        with mock.patch.object(query._PipeVars, 'chunk_size', 10):
+            self.assertEqual(self.parse('{"a": "%s"}' % ('x' * 10000)), {'a': 'x' * 10000})
+
+
+class TestInputQuery(unittest.TestCase):
+
+    def inpq(self, text):
+        fin = Lines(text)
+        with mock.patch.object(query.InputQuery, 'input_file', fin):
+            return query.InputQuery(), fin
+
+    def test_last_wins(self):
+        "Like --vars, a variable given twice keeps its last value"
+        inpq, fin = self.inpq('{"a": 1}\n{"b": 2}\n{"a": 3}\n')
+        self.assertEqual(inpq('a').result, 3)
+        self.assertEqual(inpq.data, {'a': 3, 'b': 2})
+        inpq, fin = self.inpq('a=1; b=2; a=3')
+        self.assertEqual(inpq('a').result, 3)
+
+    def test_missing(self):
+        inpq, fin = self.inpq('a=1')
+        self.assertEqual(inpq('b', default='x').result, 'x')
+        with self.assertRaises(query.InputQuery.InputError):
+            inpq('c')
+
+    def test_invalid(self):
+        inpq, fin = self.inpq('{"a": 1} x')
+        with self.assertRaises(query.InputQuery.InputError):
+            inpq('a')
+
+    def test_read_pipe(self):
+        fin = Lines('a=1')
+        with mock.patch.object(query.InputQuery, 'input_file', fin):
+            inpq = query.InputQuery(read_pipe=False)
+        self.assertEqual(inpq.data, {})
+        self.assertEqual(fin.read_lines, 0)
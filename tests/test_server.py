@@ -0,0 +1,134 @@
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import isna
+from isna import server
+
+SRC_DIR = os.path.dirname(os.path.dirname(isna.__file__))
+BIN_DIR = os.path.join(os.path.dirname(__file__), 'data', 'bin')
+CLIENT = 'import sys; from isna.server import forward; sys.exit(forward(sys.argv[2:], sys.argv[1]))'
+
+
+class TestServer(unittest.TestCase):
+    "Run an 'isna serve' server and forward commands to it"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, 'run', 'server.sock')
+        env = dict(os.environ)
+        env['XDG_CACHE_HOME'] = cls.tmpdir.name
+        env['XDG_DATA_HOME'] = cls.tmpdir.name
+        env['PYTHONPATH'] = os.pathsep.join([SRC_DIR] + [x for x in [env.get('PYTHONPATH')] if x])
+        cls.env = env
+        cmd = [sys.executable, '-c', 'from isna.server import serve; serve({!r})'.format(cls.path)]
+        cls.proc = subprocess.Popen(cmd, env=env, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+        cls.proc.stdout.readline()  # 'isna: serving on ...'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.terminate()
+        cls.proc.wait()
+        cls.proc.stdout.close()
+        cls.tmpdir.cleanup()
+
+    def client(self, *argv, cwd=None, env=None):
+        cmd = [sys.executable, '-c', CLIENT, self.path] + list(argv)
+        return subprocess.run(cmd, cwd=cwd, env=dict(self.env, **(env or {})),
+                              stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_socket(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(server.serve(self.path), 1)  # Already running
+
+    def test_ls(self):
+        res = self.client('ls', 'temp')
+        self.assertEqual(res.returncode, 0)
+        self.assertIn('create-user.yml', res.stdout.split())
+        res = self.client('ls', 'vars', 'create-user.yml')
+        self.assertEqual(res.stdout.split(), ['is_admin', 'new_usr_password', 'username'])
+
+    def test_error(self):
+        res = self.client('nonexistent.yml')
+        self.assertEqual(res.returncode, 1)
+        self.assertIn('Validation failed', res.stderr)
+        res = self.client('--no-such-option')
+        self.assertEqual(res.returncode, 1)
+        self.assertIn('Usage:', res.stderr)
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as cwd:
+            with open(os.path.join(cwd, 'noop.yml'), 'w') as fout:
+                fout.write('- hosts: all\n  tasks: []\n')
+            log = os.path.join(cwd, 'ansible.log')
+            env = {'PATH': BIN_DIR + os.pathsep + os.environ['PATH'], 'ANSIBLE_STUB_LOG': log}
+            res = self.client('noop.yml', cwd=cwd, env=env)
+            self.assertEqual(res.returncode, 0)
+            self.assertIn('ok: [localhost]', res.stdout)
+            self.assertTrue(os.path.exists(log))
+
+    def test_no_server(self):
+        self.assertIsNone(server.forward(['ls', 'temp'], self.path + '.missing'))
+
+    def test_opt_in(self):
+        "Commands are only forwarded if $ISNA_SERVER, or else cfg['server'], is true"
+        from contextlib import redirect_stdout
+        from io import StringIO
+        from unittest import mock
+        from isna import cli2
+        from isna.config import cfg
+        with mock.patch.object(server, 'forward', return_value=7) as forward:
+            with redirect_stdout(StringIO()):
+                self.assertEqual(cli2.main(['ls', 'temp']), 0)
+            forward.assert_not_called()
+            with mock.patch.dict(cfg, server=True):
+                self.assertEqual(cli2.main(['ls', 'temp']), 7)
+            forward.assert_called_once_with(['ls', 'temp'])
+            with mock.patch.dict('os.environ', ISNA_SERVER='yes'):
+                self.assertEqual(cli2.main(['ls', 'temp']), 7)
+            with mock.patch.dict(cfg, server=True), mock.patch.dict('os.environ', ISNA_SERVER='no'), \
+                    redirect_stdout(StringIO()):
+                self.assertEqual(cli2.main(['ls', 'temp']), 0)
+            self.assertEqual(forward.call_count, 2)
+
+
+class TestSharedPBMaker(unittest.TestCase):
+
+    def test_warm(self):
+        "warm() parses the templates of the default dirs and of its templ_dirs"
+        from unittest import mock
+        from isna.cli import get_templ_dirs
+        from isna.playbook import PBMaker
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'a.yml'), 'w') as fout:
+                fout.write('<@ x @>')
+            with mock.patch.dict(PBMaker._shared, clear=True), \
+                    mock.patch.dict('os.environ', XDG_CACHE_HOME=tmpdir):
+                server.warm([tmpdir])
+                self.assertEqual(set(PBMaker._shared),
+                                 {tuple(get_templ_dirs([])), tuple(get_templ_dirs([tmpdir]))})
+                self.assertIn('a.yml', PBMaker.shared(*get_templ_dirs([tmpdir]))._templates)
+
+    def test_shared(self):
+        from isna.playbook import PBMaker
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'a.yml')
+            with open(path, 'w') as fout:
+                fout.write('<@ x @>')
+            pbm1 = PBMaker.shared(tmpdir)
+            pbm1['x'] = 1
+            self.assertEqual(pbm1.all_vars('a.yml'), {'x'})
+            pbm2 = PBMaker.shared(tmpdir)
+            self.assertIs(pbm2.template_info('a.yml'), pbm1.template_info('a.yml'))
+            self.assertNotIn('x', pbm2)
+            mtime = os.stat(path).st_mtime
+            with open(path, 'w') as fout:
+                fout.write('<@ y @>')
+            os.utime(path, (mtime + 1, mtime + 1))
+            self.assertEqual(PBMaker.shared(tmpdir).all_vars('a.yml'), {'y'})
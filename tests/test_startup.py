@@ -0,0 +1,105 @@
+"""Startup benchmark for the isna command line
+
+Each command is run in a fresh interpreter with 'python -X importtime'.
+The test fails if a command imports a module it shouldn't need,
+or if the modules it imports take longer than the command's budget.
+Commands are measured with a cold cache and again with a warm cache.
+"""
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+
+import isna
+
+SRC_DIR = os.path.dirname(os.path.dirname(isna.__file__))
+BIN_DIR = os.path.join(os.path.dirname(__file__), 'data', 'bin')
+
+# Budget for the import time (in microseconds) of the modules which an
+# isna command imports beyond the interpreter's own startup.
+BUDGET = 150000
+HEAVY = ('jinja2', 'ansible', 'yaml')
+
+RUN_CLI = 'import sys; from isna.cli2 import main; sys.exit(main({argv!r}))'
+VALIDATE = (
+    'import isna.cli2, isna.cli; from docopt import docopt; '
+    'isna.cli.Validate(docopt(isna.cli2.__doc__, argv={argv!r}))'
+)
+
+COMMANDS = [
+    # (name, code, modules forbidden with a cold cache, ... with a warm cache)
+    ('help', RUN_CLI.format(argv=['--help']), ('isna.cli', 'schema') + HEAVY, ()),
+    ('ls hosts', RUN_CLI.format(argv=['ls', 'hosts']), ('schema',) + HEAVY, ()),
+    ('ls temp', RUN_CLI.format(argv=['ls', 'temp']), ('schema',) + HEAVY, ()),
+    ('ls vars', RUN_CLI.format(argv=['ls', 'vars', 'create-user.yml']), ('ansible', 'yaml'), HEAVY),
+    ('validate', VALIDATE.format(argv=['--vars=a=1', 'create-user.yml']), HEAVY, ()),
+    ('render', RUN_CLI.format(argv=['render', '--vars=username=a;new_usr_password=b;is_admin=no',
+                                    'create-user.yml']), ('ansible', 'yaml'), ()),
+]
+
+
+def importtime(code, env):
+    "Run code with -X importtime. Return a dict of top-level module -> cumulative time"
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    res = subprocess.run(cmd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    if res.returncode not in (0, None):
+        raise RuntimeError(res.stderr)
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def imported(code, env):
+    "Return all modules imported by code"
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    res = subprocess.run(cmd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, universal_newlines=True)
+    return {
+        line.split('|')[-1].strip() for line in res.stderr.splitlines()
+        if line.startswith('import time:')
+    }
+
+
+class TestStartup(unittest.TestCase):
+
+    def get_env(self):
+        """Environment with an empty cache dir & the stubs in tests/data/bin
+
+        XDG_RUNTIME_DIR is empty too, so the commands aren't forwarded to
+        an 'isna serve' server which may be running.
+        """
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        env = dict(os.environ)
+        env['XDG_CACHE_HOME'] = tmpdir.name
+        env['XDG_RUNTIME_DIR'] = tmpdir.name
+        env['PATH'] = BIN_DIR + os.pathsep + env.get('PATH', '')
+        pypath = [SRC_DIR] + [x for x in [env.get('PYTHONPATH')] if x]
+        env['PYTHONPATH'] = os.pathsep.join(pypath)
+        return env
+
+    def assertStartup(self, name, code, env, forbidden, baseline):
+        mods = imported(code, env)
+        for mod in forbidden:
+            msg = '{!r} imports {!r}'.format(name, mod)
+            self.assertFalse(any(x == mod or x.startswith(mod + '.') for x in mods), msg)
+        times = importtime(code, env)
+        total = sum(v for k, v in times.items() if k not in baseline)
+        msg = '{!r} spends {}us on imports (budget: {}us)'.format(name, total, BUDGET)
+        self.assertLess(total, BUDGET, msg)
+
+    def test_cold_and_warm(self):
+        for name, code, cold, warm in COMMANDS:
+            env = self.get_env()
+            baseline = set(importtime('pass', env))
+            with self.subTest(command=name, cache='cold'):
+                self.assertStartup(name, code, env, cold, baseline)
+            with self.subTest(command=name, cache='warm'):
+                self.assertStartup(name, code, env, cold + warm, baseline)
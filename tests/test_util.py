@@ -119,6 +119,13 @@ class TestDictFromStr(unittest.TestCase):
         x = util._json_parse_str(self.simp_s2)
         self.assertIsNone(x)
 
+    def test_json_parse_nan(self):
+        import math
+        self.assertTrue(math.isnan(util._json_parse_str('NaN')))
+        self.assertEqual(util._json_parse_str(' Infinity'), math.inf)
+        self.assertEqual(util._json_parse_str('-Infinity'), -math.inf)
+        self.assertEqual(util.dict_from_str('a=Infinity')['a'], math.inf)
+
     def test_json_parse_str1(self):
         x = util._json_parse_str(self.json_s1)
         self.assertEqual(self.d1, x)
@@ -141,3 +148,260 @@ class TestDictFromStr(unittest.TestCase):
         x = util.dict_from_str(self.simp_s2)
         y = util.dict_from_str(self.json_s2)
         self.assertAllEqual(x, self.d2, y)
+
+    def test_escaped_sep(self):
+        x = util.dict_from_str(r'cmd=echo a\; echo b; user=root')
+        self.assertEqual(x, {'cmd': 'echo a; echo b', 'user': 'root'})
+        x = util.dict_from_str(r'a=[1, "x\;y"]', sep=';')
+        self.assertEqual(x, {'a': [1, 'x;y']})
+        x = util.dict_from_str(r'a=1\, b, c=2', sep=',')
+        self.assertEqual(x, {'a': '1, b', 'c': 2})
+
+    def test_pathological(self):
+        for txt in ('x' * 20000, ';' * 20000, '=' * 20000, 'a=;b=2', '[1, 2]', 'null'):
+            with self.subTest(txt=txt[:10]):
+                x = util.dict_from_str(txt)
+                self.assertEqual(x, {'b': 2} if txt == 'a=;b=2' else {})
+
+
+class TestHosts(unittest.TestCase):
+    "Test util.iter_hosts using the avahi-browse stub in tests/data/bin"
+
+    def setUp(self):
+        import os
+        import tempfile
+        from unittest import mock
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.log = os.path.join(tmpdir.name, 'avahi.log')
+        self.cache_path = os.path.join(tmpdir.name, 'hosts.json')
+        bin_dir = os.path.join(os.path.dirname(__file__), 'data', 'bin')
+        env = {'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''), 'AVAHI_STUB_LOG': self.log}
+        patcher = mock.patch.dict('os.environ', env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def runs(self):
+        import os
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as fin:
+            return len(fin.read().splitlines())
+
+    def test_get_hosts(self):
+        self.assertEqual(util.get_hosts(), ['hund.local', 'kater.local'])
+        self.assertEqual(list(util.iter_hosts()), ['kater.local', 'hund.local'])
+
+    def test_streaming(self):
+        from time import monotonic
+        from unittest import mock
+        with mock.patch.dict('os.environ', {'AVAHI_STUB_DELAY': '0.3', 'AVAHI_STUB_HANG': '1'}):
+            start = monotonic()
+            hosts = util.iter_hosts(timeout=2)
+            self.assertEqual(next(hosts), 'kater.local')
+            self.assertLess(monotonic() - start, 1.5)
+            self.assertEqual(list(hosts), ['hund.local'])
+            self.assertLess(monotonic() - start, 3)
+
+    def test_cache(self):
+        cache = util.HostsCache(path=self.cache_path, ttl=60)
+        self.assertEqual(util.get_hosts(cache=cache), ['hund.local', 'kater.local'])
+        cache = util.HostsCache(path=self.cache_path, ttl=60)
+        self.assertEqual(util.get_hosts(cache=cache), ['hund.local', 'kater.local'])
+        self.assertEqual(self.runs(), 1)
+        cache.ttl = -1
+        util.get_hosts(cache=cache)
+        self.assertEqual(self.runs(), 2)
+        # Hosts aren't cached if the caller stops early
+        cache = util.HostsCache(path=self.cache_path + '.2', ttl=60)
+        hosts = util.iter_hosts(cache=cache)
+        next(hosts)
+        hosts.close()
+        self.assertIsNone(cache.get('.local'))
+
+
+class TestNeedsPass(unittest.TestCase):
+    "Test util.NeedsPass using the ssh stub in tests/data/bin"
+
+    @classmethod
+    def setUpClass(cls):
+        import os
+        bin_dir = os.path.join(os.path.dirname(__file__), 'data', 'bin')
+        cls.path = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+    def setUp(self):
+        from unittest import mock
+        patcher = mock.patch.dict('os.environ', {'PATH': self.path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ssh(self):
+        res = util.NeedsPass.ssh(user='me', hostname='okhost', sudo='root')
+        self.assertTrue(res.ssh_success)
+        self.assertFalse(res.ssh_needs_pw)
+        self.assertFalse(res.sudo_needs_pw)
+        res = util.NeedsPass.ssh(user='me', hostname='needpw')
+        self.assertTrue(res.ssh_needs_pw)
+        with self.assertRaises(ConnectionError):
+            util.NeedsPass.ssh(user='me', hostname='refused')
+
+    def test_ssh_many(self):
+        hosts = ['okhost', 'needpw', 'sudopw', 'refused', 'slow']
+        targets = [dict(user='me', hostname=x, sudo='root') for x in hosts]
+        from time import monotonic
+        start = monotonic()
+        res = util.NeedsPass.ssh_many(targets, timeout=1)
+        self.assertLess(monotonic() - start, 4)
+        self.assertEqual([x.host for x in res], hosts)
+        self.assertEqual([x.ssh_success for x in res], [True, False, True, False, False])
+        self.assertEqual([x.ssh_needs_pw for x in res], [False, True, False, None, None])
+        self.assertEqual([x.sudo_needs_pw for x in res], [False, None, True, None, None])
+        self.assertIsNone(res[-1].ssh_retcode)
+
+    def test_ssh_cache(self):
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'needs_pass.json')
+            cache = util.NeedsPassCache(path=path, ttl=60)
+            res = util.NeedsPass.ssh(user='me', hostname='needpw', port=22, cache=cache)
+            self.assertTrue(res.ssh_needs_pw)
+            self.assertTrue(os.path.isfile(path))
+
+            cache = util.NeedsPassCache(path=path, ttl=60)
+            self.assertEqual(cache.get('me', 'needpw', 22), res)
+            self.assertIsNone(cache.get('me', 'needpw', 2222))
+            self.assertIsNone(cache.get('me', 'needpw', 22, sudo='root'))
+            # Cached results are used without running ssh
+            from unittest import mock
+            with mock.patch.object(util.NeedsPass, '_ssh') as _ssh:
+                self.assertEqual(util.NeedsPass.ssh(user='me', hostname='needpw', cache=cache), res)
+                self.assertEqual(util.NeedsPass.ssh_many([dict(user='me', hostname='needpw')], cache=cache), [res])
+                self.assertFalse(_ssh.called)
+
+            cache.invalidate('needpw')
+            cache.save()
+            self.assertIsNone(util.NeedsPassCache(path=path, ttl=60).get('me', 'needpw', 22))
+
+    def test_run_cache(self):
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'runs.json')
+            key = util.RunCache.key(['abc'], {'x': 1}, ['host'])
+            self.assertEqual(key, util.RunCache.key(['abc'], {'x': 1}, ['host']))
+            self.assertNotEqual(key, util.RunCache.key(['abc'], {'x': 2}, ['host']))
+            cache = util.RunCache(path=path, ttl=60)
+            self.assertIsNone(cache.get(key))
+            cache.put(key, 0, templates=['a.yml'])
+            cache.save()
+            entry = util.RunCache(path=path, ttl=60).get(key)
+            self.assertEqual(entry['returncode'], 0)
+            self.assertEqual(entry['templates'], ['a.yml'])
+            self.assertIsNone(util.RunCache(path=path, ttl=-1).get(key))
+            self.assertIsNotNone(util.RunCache(path=path, ttl=None).get(key))
+
+    def test_render_cache(self):
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = util.RenderCache(directory=tmpdir, ttl=60)
+            self.assertIsNone(cache.get('a'))
+            cache.put('a', 'txt')
+            self.assertEqual(cache.get('a'), 'txt')
+            self.assertIsNone(util.RenderCache(directory=tmpdir, ttl=-1).get('a'))
+            os.utime(os.path.join(tmpdir, 'a'), (0, 0))
+            cache.put('b', 'txt')
+            self.assertEqual(os.listdir(tmpdir), ['b'])
+
+    def test_write_atomic_mode(self):
+        import os
+        import stat
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'file')
+            util.write_atomic(path, 'a')
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            os.chmod(path, 0o640)
+            util.write_atomic(path, 'b', mode=0o666)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+            os.unlink(path)
+            umask = os.umask(0o022)
+            try:
+                util.write_atomic(path, 'c', mode=0o666)
+            finally:
+                os.umask(umask)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+            with open(path) as fin:
+                self.assertEqual(fin.read(), 'c')
+
+    def test_ssh_cache_ttl(self):
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'needs_pass.json')
+            cache = util.NeedsPassCache(path=path, ttl=-1)
+            targets = [dict(user='me', hostname='okhost', port=22), dict(user='me', hostname='slow', port=22)]
+            res = util.NeedsPass.ssh_many(targets, timeout=0.5, cache=cache)
+            self.assertEqual([x.ssh_success for x in res], [True, False])
+            self.assertEqual(len(cache.entries), 1)
+            self.assertIsNone(cache.get('me', 'okhost', 22))
+
+    def test_ssh_control(self):
+        import os
+        import tempfile
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = os.path.join(tmpdir, 'ssh.log')
+            control = util.SSHControl(persist='30s', directory=tmpdir)
+            self.assertEqual(control.path, os.path.join(tmpdir, '%C'))
+            with mock.patch.dict('os.environ', {'SSH_STUB_LOG': log, 'SSH_STUB_MASTERS': 'me@running'}):
+                util.NeedsPass.ssh(user='me', hostname='okhost', control=control)
+                util.NeedsPass.ssh_many([dict(user='me', hostname='other')], control=control)
+                util.NeedsPass.ssh(user='me', hostname='running', control=control)
+                util.NeedsPass.ssh_many([dict(user='me', hostname='running')], control=control)
+                control.stop(user='me', hostname='okhost')
+            with open(log) as fin:
+                calls = [x.split() for x in fin.read().splitlines()]
+            opt = '-oControlPath=' + control.path
+            self.assertTrue(all(opt in x for x in calls))
+            # A master is only started if 'ssh -Ocheck' finds none
+            starts = [x[-1] for x in calls if '-oControlMaster=yes' in x]
+            self.assertEqual(starts, ['me@okhost', 'me@other'])
+            self.assertEqual(len([x for x in calls if '-Ocheck' in x]), 4)
+            self.assertTrue(all('-oControlPersist=30s' in x for x in calls if '-fNT' in x))
+            self.assertIn('-Oexit', calls[-1])
+            self.assertIn('ControlPath=' + control.path, control.ansible_args())
+
+
+class TestTimings(unittest.TestCase):
+
+    def test_nested(self):
+        from unittest import mock
+        clock = iter([0.0, 1.0, 3.0, 4.0, 10.0, 12.0])
+        timings = util.Timings()
+        with mock.patch('time.perf_counter', lambda: next(clock)):
+            with timings.phase('outer'):
+                with timings.phase('inner'):
+                    pass
+            with timings.phase('inner'):
+                pass
+        self.assertEqual(timings.phases, {'outer': [1, 2.0], 'inner': [2, 4.0]})
+        table = timings.table(8.0).splitlines()
+        self.assertEqual([x.split() for x in table], [
+            ['PHASE', 'CALLS', 'SECONDS', 'SHARE'],
+            ['inner', '2', '4.000', '50%'],
+            ['outer', '1', '2.000', '25%'],
+            ['other', '-', '2.000', '25%'],
+            ['total', '-', '8.000', '-'],
+        ])
+
+    def test_timed(self):
+        self.assertIsNone(util.timings)
+        with util.timed('x'):
+            pass
+        from unittest import mock
+        with mock.patch.object(util, 'timings', util.Timings()):
+            with util.timed('x'):
+                pass
+            self.assertEqual(util.timings.phases['x'][0], 1)